@@ -1,12 +1,29 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, g
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, has_app_context, jsonify
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
+from follow_graph import FollowGraph
+from text_preprocessing import preprocess_text, tokenize_stream, words, TOPIC_STOP_WORDS, RECOMMENDER_STOP_WORDS
 from cryptography.fernet import Fernet
+import base64
 import collections
+import concurrent.futures
+import contextlib
 import json
+import os
 import sqlite3
+import threading
+import time
 import hashlib
+import heapq
+import itertools
+import math
 import re
 from datetime import datetime
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # in requirements.txt, but rebuild_post_neighbors also works without them
+    np = sparse = None
 
 # imports for flast route
 from flask import render_template, redirect, url_for, session, flash
@@ -16,16 +33,6 @@ from collections import defaultdict
 app = Flask(__name__)
 app.secret_key = '123456789' 
 DATABASE = 'database.sqlite'
-# These are the stop words that I use in the exerceise 3.3 when building a recommendation system.
-STOP_WORDS = {
-    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from',
-    'has', 'he', 'in', 'is', 'it', 'its', 'of', 'on', 'that', 'the',
-    'to', 'was', 'will', 'with', 'i', 'me', 'my', 'you', 'your',
-    'this', 'but', 'what', 'when', 'where', 'who', 'we', 'they',
-    'she', 'her', 'him', 'them', 'their', 'or', 'if', 'so', 'there',
-    'have', 'had', 'can', 'do', 'does', 'am', 'been', 'being', 'not',
-    'just', 'like', 'get', 'got', 'very', 'much', 'more', 'about'
-}
 # Load censorship data
 # WARNING! The censorship.dat file contains disturbing language when decrypted. 
 # If you want to test whether moderation works, 
@@ -37,33 +44,548 @@ with open(ENCRYPTED_FILE_PATH, 'rb') as encrypted_file:
     encrypted_data = encrypted_file.read()
 decrypted_data = fernet.decrypt(encrypted_data)
 MODERATION_CONFIG = json.loads(decrypted_data)
+# Moderated text and scores are stored next to the raw content when it is written. This
+# version is stored with them, so rows that were moderated with an older censorship.dat
+# are moderated again instead of being trusted.
+MODERATION_CONFIG_VERSION = f"{MODERATION_CONFIG.get('version', 0)}-{hashlib.sha256(decrypted_data).hexdigest()[:12]}"
 TIER1_WORDS = MODERATION_CONFIG['categories']['tier1_severe_violations']['words']
 TIER2_PHRASES = MODERATION_CONFIG['categories']['tier2_spam_scams']['phrases']
 TIER3_WORDS = MODERATION_CONFIG['categories']['tier3_mild_profanity']['words']
 
+
+def compile_moderation_patterns(tier1_words, tier2_phrases, tier3_words):
+    """
+    Builds the matchers used by moderate_content from the censorship word lists.
+    This runs once at startup so that moderating a text is a single scan per
+    tier instead of one regex search per dictionary word.
+    """
+    tier1 = [word.lower() for word in tier1_words if word]
+    tier2 = [phrase.lower() for phrase in tier2_phrases if phrase]
+
+    # One alternation for every Tier 1 word, with the same \b guards the
+    # per-word patterns used. The regex engine backtracks through the
+    # alternatives, so it matches exactly when one of the single-word
+    # patterns would have matched.
+    tier1_pattern = None
+    if tier1:
+        tier1_pattern = re.compile(r'\b(?:' + '|'.join(re.escape(word) for word in tier1) + r')\b')
+
+    # Tier 2 is a plain substring check, so the alternation needs no guards.
+    tier2_pattern = None
+    if tier2:
+        tier2_pattern = re.compile('|'.join(re.escape(phrase) for phrase in tier2))
+
+    # Tier 3 is checked against a single cleaned word that only contains \w
+    # characters, so r'\bword\b' can only match when the cleaned word *is* the
+    # profane word. Entries with other characters in them can never match.
+    tier3 = frozenset(
+        word.lower() for word in tier3_words
+        if re.fullmatch(r'\w+', word.lower())
+    )
+    return tier1_pattern, tier2_pattern, tier3
+
+
+TIER1_PATTERN, TIER2_PATTERN, TIER3_WORD_SET = compile_moderation_patterns(
+    TIER1_WORDS, TIER2_PHRASES, TIER3_WORDS
+)
+NON_WORD_CHARS_PATTERN = re.compile(r'[^\w]')
+URL_PATTERN = r'https?://[^\s]+|www\.[^\s]+|[a-zA-Z0-9-]+\.(com|org|net|edu|gov|io)[^\s]*'
+URL_COUNT_PATTERN = re.compile(URL_PATTERN)
+URL_REPLACE_PATTERN = re.compile(URL_PATTERN, re.IGNORECASE)
+MENTION_PATTERN = re.compile(r'@\w+')
+
+# Connection management ============================================================
+# Opening a connection and setting it up costs more than most of the queries the pages
+# run, so connections are kept open and handed out again instead of being opened per
+# request. Requests take one from a small pool and give it back when they end. Code
+# that runs outside a request (CLI commands, scripts, worker processes) gets one
+# connection per thread. Nothing here is shared between processes: a forked child
+# opens its own connections instead of using the ones it inherited.
+
+# Applied to every new connection.
+#  - WAL lets pages keep reading while a write is being committed.
+#  - with WAL, synchronous=NORMAL only syncs at checkpoints, which is still safe
+#    against corruption (the last commits can be lost on a power cut, not on a crash).
+#  - 32 MB page cache and 256 MB of the file memory mapped, the whole database fits.
+#  - temporary b-trees (GROUP BY, DISTINCT, ORDER BY without an index) stay in memory.
+SQLITE_PRAGMAS = [
+    'journal_mode = WAL',
+    'synchronous = NORMAL',
+    'cache_size = -32000',
+    'mmap_size = 268435456',
+    'temp_store = MEMORY',
+]
+SQLITE_BUSY_TIMEOUT = 10
+CONNECTION_POOL_SIZE = 8
+
+_pool_lock = threading.Lock()
+_pool = []
+_pool_pid = os.getpid()
+_thread_connections = threading.local()
+# Connections inherited from the parent process. They are kept referenced so they are
+# never closed (and their locks released) from the child.
+_inherited_connections = []
+
+
+def open_connection():
+    """Opens a new connection to DATABASE with the settings in SQLITE_PRAGMAS."""
+    conn = sqlite3.connect(
+        DATABASE,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        timeout=SQLITE_BUSY_TIMEOUT,
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(f'PRAGMA {pragma}')
+    return conn
+
+
+def acquire_connection():
+    """Takes an idle connection from the pool, or opens a new one if there is none."""
+    global _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _inherited_connections.extend(_pool)
+            _pool.clear()
+            _pool_pid = os.getpid()
+        if _pool:
+            return _pool.pop()
+    return open_connection()
+
+
+def release_connection(conn):
+    """
+    Puts a connection back in the pool. Anything left uncommitted is rolled back,
+    the same as when the connection used to be closed at the end of the request.
+    """
+    if conn.in_transaction:
+        conn.rollback()
+    with _pool_lock:
+        if _pool_pid == os.getpid() and len(_pool) < CONNECTION_POOL_SIZE:
+            _pool.append(conn)
+            return
+    conn.close()
+
+
 def get_db():
     """
-    Connect to the application's configured database. The connection
-    is unique for each request and will be reused if this is called
-    again.
+    Returns the database connection to use. Inside a request (or any app context,
+    like the Flask CLI) this is a pooled connection that is reused if this is called
+    again and released by close_connection(). Outside of one it is the connection
+    of the current thread, which stays open for the thread's lifetime.
     """
-    if 'db' not in g:
-        g.db = sqlite3.connect(
-            DATABASE,
-            detect_types=sqlite3.PARSE_DECLTYPES
+    if has_app_context():
+        # a process forked inside an app context (the workers of precompute_recommendations)
+        # inherits g.db too, but that connection belongs to the parent
+        if 'db' in g and g.db_pid != os.getpid():
+            _inherited_connections.append(g.pop('db'))
+        if 'db' not in g:
+            g.db = acquire_connection()
+            g.db_pid = os.getpid()
+        return g.db
+
+    conn = getattr(_thread_connections, 'conn', None)
+    if conn is None or _thread_connections.pid != os.getpid():
+        if conn is not None:
+            _inherited_connections.append(conn)
+        conn = open_connection()
+        _thread_connections.conn = conn
+        _thread_connections.pid = os.getpid()
+    return conn
+
+
+# Schema migrations ================================================================
+# The schema changes this app makes on top of the original database.sqlite are applied
+# as numbered migrations. Every migration that has run is recorded in the
+# schema_migrations table, so each one runs exactly once per database, in order. They
+# are applied by init_db() at startup and by the `flask migrate` command.
+#
+# Migrations 1 and 2 were plain "create if missing" steps before the runner existed, so
+# they are written to be harmless on a database that already has their changes.
+
+def _add_missing_columns(conn, table, columns):
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for column, column_type in columns:
+        if column not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+
+def _migration_moderation_columns(conn):
+    # Moderate-on-write: the moderated text, score and config version next to the raw content.
+    moderation_columns = [
+        ('moderated_content', 'TEXT'),
+        ('moderation_score', 'INTEGER'),
+        ('moderation_version', 'TEXT'),
+    ]
+    _add_missing_columns(conn, 'posts', moderation_columns)
+    _add_missing_columns(conn, 'comments', moderation_columns)
+    _add_missing_columns(conn, 'users', [
+        ('moderated_profile', 'TEXT'),
+        ('profile_moderation_score', 'INTEGER'),
+        ('profile_moderation_version', 'TEXT'),
+    ])
+
+
+def _migration_user_risk(conn):
+    # Per-user risk score components, kept up to date by the write routes (see
+    # "Materialized risk scores" next to user_risk_analysis).
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_risk (
+            user_id                INTEGER PRIMARY KEY,
+            profile_score          INTEGER NOT NULL DEFAULT 0,
+            post_score_sum         INTEGER NOT NULL DEFAULT 0,
+            post_count             INTEGER NOT NULL DEFAULT 0,
+            comment_score_sum      INTEGER NOT NULL DEFAULT 0,
+            comment_count          INTEGER NOT NULL DEFAULT 0,
+            reaction_sentiment_sum INTEGER NOT NULL DEFAULT 0,
+            reaction_count         INTEGER NOT NULL DEFAULT 0,
+            risk_score             REAL    NOT NULL DEFAULT 0,
+            rescore_after          TIMESTAMP,
+            moderation_version     TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_risk_score ON user_risk (risk_score DESC, user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_risk_rescore_after ON user_risk (rescore_after)')
+
+
+def _migration_access_path_indexes(conn):
+    # The original tables only have their rowid, so every lookup below was a full scan.
+    # Each index matches a WHERE / ORDER BY that the routes run on every page view.
+    conn.executescript('''
+        -- feed ('new'), trending and topic pages: posts ORDER BY created_at
+        CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts (created_at, id);
+        -- user_profile, user_risk_analysis: posts WHERE user_id = ? ORDER BY created_at
+        CREATE INDEX IF NOT EXISTS idx_posts_user_created_at ON posts (user_id, created_at);
+        -- feed, post_detail: comments WHERE post_id = ? ORDER BY created_at
+        CREATE INDEX IF NOT EXISTS idx_comments_post_created_at ON comments (post_id, created_at);
+        -- user_profile, user_risk_analysis: comments WHERE user_id = ? ORDER BY created_at
+        CREATE INDEX IF NOT EXISTS idx_comments_user_created_at ON comments (user_id, created_at);
+        -- feed, post_detail: reactions WHERE post_id = ? GROUP BY reaction_type (covering)
+        CREATE INDEX IF NOT EXISTS idx_reactions_post_type ON reactions (post_id, reaction_type);
+        -- recommend: reactions WHERE user_id = ?
+        CREATE INDEX IF NOT EXISTS idx_reactions_user_post ON reactions (user_id, post_id);
+        -- user_profile, user_followers: follows WHERE followed_id = ?
+        CREATE INDEX IF NOT EXISTS idx_follows_followed_follower ON follows (followed_id, follower_id);
+    ''')
+
+
+def _migration_unique_follows_reactions(conn):
+    # A user can follow someone once and have one reaction per post. The routes already
+    # assume this, but nothing enforced it and database.sqlite has duplicate reactions.
+    # The lowest id is kept, since that is the row add_reaction updates and the feed shows.
+    conn.execute('''
+        DELETE FROM follows WHERE rowid NOT IN (
+            SELECT MIN(rowid) FROM follows GROUP BY follower_id, followed_id
+        )
+    ''')
+    conn.execute('''
+        DELETE FROM reactions WHERE id NOT IN (
+            SELECT MIN(id) FROM reactions GROUP BY post_id, user_id
+        )
+    ''')
+    # These also cover "WHERE follower_id = ? AND followed_id = ?" and
+    # "WHERE post_id = ? AND user_id = ?".
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS uq_follows_follower_followed ON follows (follower_id, followed_id)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS uq_reactions_post_user ON reactions (post_id, user_id)')
+    # The removed reactions were counted in the stored risk components.
+    rebuild_user_risk(conn)
+
+
+def _migration_post_topics(conn):
+    # Settings that belong to the database rather than to the code, like the version
+    # of TOPICS that post_topics was built with.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    # The topic of every post, classified once when the post is written. topic_id is
+    # NULL for posts that don't match any topic. created_at is a copy of the post's, so
+    # the trending window can be read from this table alone.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS post_topics (
+            post_id    INTEGER PRIMARY KEY,
+            topic_id   INTEGER,
+            created_at TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_post_topics_created_at ON post_topics (created_at, topic_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_post_topics_topic_created_at ON post_topics (topic_id, created_at)')
+
+
+def _migration_topic_engagement(conn):
+    # Posts, reactions and comments per topic, bucketed by the hour the post was created
+    # in. A reaction or comment counts in the bucket of the post it is on.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS topic_engagement (
+            topic_id  INTEGER NOT NULL,
+            hour      TIMESTAMP NOT NULL,
+            posts     INTEGER NOT NULL DEFAULT 0,
+            reactions INTEGER NOT NULL DEFAULT 0,
+            comments  INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (topic_id, hour)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_topic_engagement_hour ON topic_engagement (hour, topic_id)')
+    rebuild_topic_engagement(conn)
+
+
+def _migration_post_terms(conn):
+    # The words of every post, for recommend() (see "Post term index" next to it).
+    # WITHOUT ROWID keeps the rows in (term, post_id) order, so the postings of a term
+    # are read in one range scan.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS post_terms (
+            term    TEXT NOT NULL,
+            post_id INTEGER NOT NULL,
+            tf      INTEGER NOT NULL,
+            PRIMARY KEY (term, post_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_post_terms_post ON post_terms (post_id)')
+    # init_db() fills it, because post_terms_version isn't set yet
+
+
+def _migration_user_interests(conn):
+    # How often every interest word occurs in the posts a user reacted to, for recommend()
+    # (see "User interest profiles" next to it). first_reaction_id and first_pos say where
+    # the user first came across the word, which orders words with the same count.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_interests (
+            user_id           INTEGER NOT NULL,
+            term              TEXT NOT NULL,
+            count             INTEGER NOT NULL,
+            first_reaction_id INTEGER NOT NULL,
+            first_pos         INTEGER NOT NULL,
+            PRIMARY KEY (user_id, term)
+        ) WITHOUT ROWID
+    ''')
+    # the position of the first occurrence of the term in the post
+    _add_missing_columns(conn, 'post_terms', [('first_pos', 'INTEGER NOT NULL DEFAULT 0')])
+    # both are filled by init_db(), post_terms_version and user_interests_version change with this
+
+
+def _migration_post_neighbors(conn):
+    # The most similar posts of every post by who reacted to them, for the 'itemcf'
+    # recommendations (see "Item-item neighbours"). init_db() fills it the first time.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS post_neighbors (
+            post_id     INTEGER NOT NULL,
+            neighbor_id INTEGER NOT NULL,
+            similarity  REAL NOT NULL,
+            PRIMARY KEY (post_id, neighbor_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_recommendations(conn):
+    # The recommendations of every user computed ahead of time, per mode and best first
+    # (see "Precomputed recommendations").
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS recommendations (
+            user_id     INTEGER NOT NULL,
+            mode        TEXT NOT NULL,
+            rank        INTEGER NOT NULL,
+            post_id     INTEGER NOT NULL,
+            score       REAL NOT NULL,
+            computed_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, mode, rank)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_follow_suggestions(conn):
+    # The "people you may know" suggestions of the users who follow the most accounts,
+    # computed ahead of time (see "People you may know").
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS follow_suggestions (
+            user_id      INTEGER NOT NULL,
+            rank         INTEGER NOT NULL,
+            suggested_id INTEGER NOT NULL,
+            mutual_count INTEGER NOT NULL,
+            computed_at  TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, rank)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_lda_checkpoints(conn):
+    # The topic models saved by topic_modeling.py (train and update), with the last post and
+    # comment they were trained on, so an update only reads what was written after them.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS lda_checkpoints (
+            version         INTEGER PRIMARY KEY,
+            kind            TEXT NOT NULL,
+            model_path      TEXT NOT NULL,
+            dictionary_path TEXT NOT NULL,
+            max_post_id     INTEGER NOT NULL,
+            max_comment_id  INTEGER NOT NULL,
+            documents       INTEGER NOT NULL,
+            created_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
         )
-        g.db.row_factory = sqlite3.Row
+    ''')
 
-    return g.db
+
+def _migration_post_reactions(conn):
+    # The number of reactions of every post that has any, for the popular posts of the
+    # recommended feed (see popular_posts). The index has them in the order they are shown.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS post_reactions (
+            post_id        INTEGER PRIMARY KEY,
+            reaction_count INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_post_reactions_count ON post_reactions (reaction_count DESC, post_id)')
+    rebuild_post_reactions(conn)
+
+
+MIGRATIONS = [
+    (1, 'moderation columns', _migration_moderation_columns),
+    (2, 'user_risk table', _migration_user_risk),
+    (3, 'access path indexes', _migration_access_path_indexes),
+    (4, 'unique follows and reactions', _migration_unique_follows_reactions),
+    (5, 'post_topics and app_meta tables', _migration_post_topics),
+    (6, 'topic_engagement table', _migration_topic_engagement),
+    (7, 'post_terms table', _migration_post_terms),
+    (8, 'user_interests table', _migration_user_interests),
+    (9, 'post_neighbors table', _migration_post_neighbors),
+    (10, 'recommendations table', _migration_recommendations),
+    (11, 'follow_suggestions table', _migration_follow_suggestions),
+    (12, 'lda_checkpoints table', _migration_lda_checkpoints),
+    (13, 'post_reactions table', _migration_post_reactions),
+]
+
+
+def applied_migrations(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version    INTEGER PRIMARY KEY,
+            name       TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+        )
+    ''')
+    return {row[0] for row in conn.execute('SELECT version FROM schema_migrations')}
+
+
+def migrate(conn):
+    """
+    Applies the migrations that have not run on this database yet, in order, each in
+    its own transaction. Returns the (version, name) of every migration applied.
+    """
+    applied = applied_migrations(conn)
+    conn.commit()
+    newly_applied = []
+    for version, name, apply in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            apply(conn)
+            conn.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (version, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        newly_applied.append((version, name))
+    return newly_applied
+
+
+def init_db():
+    """
+    Brings the database up to the schema this version of the app expects, and
+    refreshes the tables derived from the censorship config, TOPICS or the post
+    tokenization if they have changed.
+    """
+    conn = get_db()
+    migrate(conn)
+
+    # user_risk is filled in from the content tables the first time, and again
+    # whenever the censorship config changes the scores it was built with.
+    if conn.execute('SELECT 1 FROM user_risk WHERE moderation_version IS NOT ? LIMIT 1',
+                    (MODERATION_CONFIG_VERSION,)).fetchone():
+        rebuild_user_risk(conn)
+    else:
+        missing = conn.execute('SELECT id FROM users WHERE id NOT IN (SELECT user_id FROM user_risk)').fetchall()
+        if missing:
+            rebuild_user_risk(conn, [row['id'] for row in missing])
+
+    # The same for post_topics, whenever TOPICS or the text preprocessing changes.
+    if get_meta(conn, 'topics_version') != topics_version():
+        rebuild_post_topics(conn)
+    else:
+        missing = conn.execute('SELECT id FROM posts WHERE id NOT IN (SELECT post_id FROM post_topics)').fetchall()
+        if missing:
+            rebuild_post_topics(conn, [row['id'] for row in missing])
+
+    if get_meta(conn, 'post_terms_version') != POST_TERMS_VERSION:
+        rebuild_post_terms(conn)
+    if get_meta(conn, 'user_interests_version') != user_interests_version():
+        rebuild_user_interests(conn)
+        # the stored keyword recommendations were ranked with the old profiles
+        conn.execute("DELETE FROM recommendations WHERE mode != 'itemcf'")
+    # post_neighbors is a batch job (flask rebuild-post-neighbors), only built here the first time
+    if get_meta(conn, 'post_neighbors_built_at') is None:
+        rebuild_post_neighbors(conn)
+    conn.commit()
+
+
+def get_meta(conn, key, default=None):
+    row = conn.execute('SELECT value FROM app_meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(conn, key, value):
+    conn.execute('INSERT INTO app_meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                 (key, value))
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Applies pending schema migrations to the database."""
+    conn = get_db()
+    newly_applied = migrate(conn)
+    current = max(applied_migrations(conn), default=0)
+    for version, name in newly_applied:
+        click.echo(f'applied migration {version}: {name}')
+    click.echo(f'schema is at version {current}')
+
+
+# The lookups the routes run on every page view. `flask db-explain` prints how SQLite
+# executes each of them, to check they use an index rather than a full table scan.
+EXPLAIN_QUERIES = {
+    'feed follow check': ('SELECT 1 FROM follows WHERE follower_id = ? AND followed_id = ?', (1, 2)),
+    'profile follower count': ('SELECT COUNT(*) FROM follows WHERE followed_id = ?', (1,)),
+    'profile following count': ('SELECT COUNT(*) FROM follows WHERE follower_id = ?', (1,)),
+    'post reactions': ('SELECT reaction_type, COUNT(*) FROM reactions WHERE post_id = ? GROUP BY reaction_type', (1,)),
+    'user reaction on post': ('SELECT reaction_type FROM reactions WHERE user_id = ? AND post_id = ?', (1, 1)),
+    'post comments': ('SELECT c.id, c.content FROM comments c JOIN users u ON c.user_id = u.id WHERE c.post_id = ? ORDER BY c.created_at ASC', (1,)),
+    'feed new': ('SELECT p.id FROM posts p JOIN users u ON p.user_id = u.id ORDER BY p.created_at DESC, p.id DESC LIMIT 10', ()),
+    'profile posts': ('SELECT id FROM posts WHERE user_id = ? ORDER BY created_at DESC', (1,)),
+    'profile comments': ('SELECT id FROM comments WHERE user_id = ? ORDER BY created_at DESC LIMIT 100', (1,)),
+    'reacted posts': ('SELECT DISTINCT p.id FROM posts p JOIN reactions r ON p.id = r.post_id WHERE r.user_id = ?', (1,)),
+    'popular posts': ('SELECT pr.post_id FROM post_reactions pr JOIN posts p ON p.id = pr.post_id WHERE p.user_id != ? ORDER BY pr.reaction_count DESC, pr.post_id ASC LIMIT 50', (1,)),
+    'item neighbours': ('SELECT n.neighbor_id, SUM(n.similarity) FROM reactions r JOIN post_neighbors n ON n.post_id = r.post_id WHERE r.user_id = ? GROUP BY n.neighbor_id', (1,)),
+}
+
+
+@app.cli.command('db-explain')
+def explain_command():
+    """Prints the query plan of the hot lookups in EXPLAIN_QUERIES."""
+    conn = get_db()
+    for label, (query, params) in EXPLAIN_QUERIES.items():
+        click.echo(label)
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params):
+            click.echo(f'    {row[-1]}')
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    """Closes the database again at the end of the request."""
+    """Gives the database connection back to the pool at the end of the request."""
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        release_connection(db)
 
 
 def query_db(query, args=(), one=False, commit=False):
@@ -92,6 +614,142 @@ def query_db(query, args=(), one=False, commit=False):
         print(f"Database error: {e}")
         return None
 
+# Keyset pagination ================================================================
+# Paging with LIMIT/OFFSET makes SQLite walk past every row of the earlier pages, so
+# deep pages get slower and slower. Instead, the "next" and "previous" links carry an
+# opaque cursor with the sort key of the last (or first) row on the current page, and
+# the next page starts right after it. The old ?page= links still work through OFFSET.
+
+def encode_cursor(values, direction='next'):
+    """Packs the sort key of a row into a URL-safe cursor token."""
+    values = [str(value) if isinstance(value, datetime) else value for value in values]
+    payload = json.dumps({'k': values, 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, key_length):
+    """
+    Unpacks a cursor token into (values, direction). Returns None for a missing or
+    malformed token, so the caller can fall back to the first page.
+    """
+    if not token:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        values, direction = payload['k'], payload['d']
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(values, list) or len(values) != key_length or direction not in ('next', 'prev'):
+        return None
+    if not all(cursor_value_ok(value) for value in values):
+        return None
+    return values, direction
+
+
+def cursor_value_ok(value):
+    """
+    Whether a cursor value can be bound into the query. A tampered token could hold lists, dicts
+    or ints too big for SQLite, and sqlite3 raises for those (OverflowError, which query_db doesn't
+    catch). bool is a subclass of int but it's never a real key value either. json also reads
+    NaN and Infinity, which would compare with nothing.
+    """
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return -2 ** 63 <= value < 2 ** 63
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return isinstance(value, str)
+
+
+def keyset_query_parts(key_columns, cursor):
+    """
+    Builds the pieces of a query that pages through rows ordered by key_columns,
+    all descending. Returns (condition, params, order_by, reverse): condition is
+    None when there is no cursor, and reverse tells the caller to flip the fetched
+    rows back into descending order (paging backwards fetches them ascending).
+    """
+    descending = ', '.join(f'{column} DESC' for column in key_columns)
+    if cursor is None:
+        return None, [], descending, False
+    values, direction = cursor
+    columns = ', '.join(key_columns)
+    placeholders = ', '.join('?' * len(values))
+    if direction == 'prev':
+        ascending = ', '.join(f'{column} ASC' for column in key_columns)
+        return f'({columns}) > ({placeholders})', list(values), ascending, True
+    return f'({columns}) < ({placeholders})', list(values), descending, False
+
+
+def page_cursors(rows, key):
+    """Returns the (previous, next) cursor tokens for a page of rows, key(row) being its sort key."""
+    if not rows:
+        return None, None
+    return encode_cursor(key(rows[0]), 'prev'), encode_cursor(key(rows[-1]), 'next')
+
+
+# Follow graph =====================================================================
+# Follow checks and follower counts are answered from a FollowGraph (see follow_graph.py) held
+# in memory, loaded from the follows table the first time it is needed and updated by
+# follow_user and unfollow_user. It belongs to the process, so it is only right when one process
+# serves the app, as with `flask run` or app.py. Set FOLLOW_GRAPH to False to query the follows
+# table instead, e.g. when several worker processes write follows.
+
+app.config.setdefault('FOLLOW_GRAPH', True)
+_follow_graph = None
+_follow_graph_lock = threading.Lock()
+
+
+def get_follow_graph():
+    """Returns the in-memory follow graph, or None when FOLLOW_GRAPH is off."""
+    global _follow_graph
+    if not app.config['FOLLOW_GRAPH']:
+        return None
+    if _follow_graph is None:
+        with _follow_graph_lock:
+            if _follow_graph is None:
+                _follow_graph = FollowGraph.load(get_db())
+    return _follow_graph
+
+
+def is_following(follower_id, followed_id):
+    graph = get_follow_graph()
+    if graph is not None:
+        return graph.is_following(follower_id, followed_id)
+    return query_db('SELECT 1 FROM follows WHERE follower_id = ? AND followed_id = ?',
+                    (follower_id, followed_id), one=True) is not None
+
+
+def followed_among(follower_id, user_ids):
+    """The ids among user_ids that the user follows, as a set. One query for all of them without the graph."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    graph = get_follow_graph()
+    if graph is not None:
+        return {user_id for user_id in user_ids if graph.is_following(follower_id, user_id)}
+    return {row['followed_id'] for row in query_db(
+        f"SELECT followed_id FROM follows WHERE follower_id = ? AND followed_id IN ({','.join('?' * len(user_ids))})",
+        [follower_id] + user_ids)}
+
+
+def follow_counts(user_id):
+    """Returns (number of followers, number of users followed) of the user."""
+    graph = get_follow_graph()
+    if graph is not None:
+        return graph.follower_count(user_id), graph.following_count(user_id)
+    return (query_db('SELECT COUNT(*) FROM follows WHERE followed_id = ?', (user_id,), one=True)[0],
+            query_db('SELECT COUNT(*) FROM follows WHERE follower_id = ?', (user_id,), one=True)[0])
+
+
+def followed_ids(user_id):
+    """The ids of the users the user follows."""
+    graph = get_follow_graph()
+    if graph is not None:
+        return graph.following(user_id)
+    return [row['followed_id'] for row in query_db('SELECT followed_id FROM follows WHERE follower_id = ?', (user_id,))]
+
+
 @app.template_filter('datetimeformat')
 def datetimeformat(value):
     if isinstance(value, datetime):
@@ -141,97 +799,180 @@ TOPICS = {
     9:{'name': 'Agreement & Positivity', 'keywords': ['lets', 'real', 'great', 'change', 'kindness']}
 }
 
-# STOP WORDS
+# TEXT PREPROCESSING
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
-# Common English words that don't help with topic classification We remove these during text 
-# preprocessing to focus on meaningful words This is the same list used in Exercise 4.1
-STOP_WORDS = {
-    'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've",
-    "you'll", "you'd", 'your', 'yours', 'yourself', 'yourselves', 'he', 'him', 'his',
-    'himself', 'she', "she's", 'her', 'hers', 'herself', 'it', "it's", 'its', 'itself',
-    'they', 'them', 'their', 'theirs', 'themselves', 'what', 'which', 'who', 'whom',
-    'this', 'that', "that'll", 'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be',
-    'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does', 'did', 'doing', 'a',
-    'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at',
-    'by', 'for', 'with', 'about', 'against', 'between', 'into', 'through', 'during',
-    'before', 'after', 'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on',
-    'off', 'over', 'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when',
-    'where', 'why', 'how', 'all', 'both', 'each', 'few', 'more', 'most', 'other', 'some',
-    'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 's',
-    't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now', 'd', 'll',
-    'm', 'o', 're', 've', 'y', 'get', 'got', 'like', 'also', 'would', 'could', 'going',
-    'know', 'think', 'one', 'much', 'even', 'many', 'way', 'see', 'really', 'something',
-    'make', 'made', 'want', 'well', 'still', 'back'
-}
-
+# Here i use the same preprocesing i dused in exerceise 4.1 in order to prepare the texts for topic classification:
+# lowercase, remove the urls, special characters and numbers, split into tokens and remove the stop words and the
+# words with less than 3 characters. It lives in text_preprocessing.py now so the exercises and the app share it.
+# The stop words are TOPIC_STOP_WORDS, the exercise 4.1 list without the negations (see text_preprocessing.py).
+def preprocess_topic_text(text):
+    return preprocess_text(text, TOPIC_STOP_WORDS)
 
-# TEXT PREPROCESSING FUNCTION
+# TOPIC CLASSIFICATION FUNCTION
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
-def preprocess_text(text):
-   # Here i use the same preprocesing i dused in exerceise 4.1 in order to prepare the texts for topic classification
-   # I first convert them to lowercase, remove the urls and special characters and numners and then split them into 
-   # individual words that we call tokens. finally, we remove the stopwords and only keep words with more than 2 characters.
-    
-    # I convert everything to lowercase "Hello World" becomes "hello world"
-    text = text.lower()
-    
-    # I remove URLs using regex: both http://... and www... patterns re deleted
-    text = re.sub(r'http\S+|www\S+', '', text)
-    
-    # i remove everything except letters and spaces
-    # "hello123 world!" becomes "hello world"
-    text = re.sub(r'[^a-z\s]', '', text)
-    # split text into individual words
-    # "hello world" becomes ["hello", "world"]
-    tokens = text.split()
-    # keep only meaningful words (not stop words, length >= 3)
-    processed = []
+def build_topic_keyword_index(topics):
+    # Instead of going through every topic and checking every token against its keyword list, I turn
+    # TOPICS around once: every keyword points to the topics that have it. Then classifying is one pass
+    # over the tokens, and the cost doesn't grow with the number of topics.
+    # Topic ids are listed in TOPICS order, which is also how ties between topics are broken.
+    keyword_index = defaultdict(list)
+    for topic_id, topic_data in topics.items():
+        # a keyword that is listed twice in one topic still only counts once per token
+        for keyword in dict.fromkeys(topic_data['keywords']):
+            keyword_index[keyword].append(topic_id)
+    topic_order = {topic_id: position for position, topic_id in enumerate(topics)}
+    return {keyword: tuple(topic_ids) for keyword, topic_ids in keyword_index.items()}, topic_order
+
+
+TOPIC_KEYWORD_INDEX, TOPIC_ORDER = build_topic_keyword_index(TOPICS)
+
+
+def classify_tokens(tokens):
+    # a sentence needs at least 2 words to make a reasonable classification
+    if len(tokens) < 2:
+        return None
+
+    # I count keyword matches only for the topics that have the token as a keyword
+    topic_scores = defaultdict(int)
     for token in tokens:
-        # skip stop words 
-        if token in STOP_WORDS:
-            continue 
-    # skip very short words
-        if len(token) < 3:
-            continue  
-        processed.append(token)
-    return processed
+        for topic_id in TOPIC_KEYWORD_INDEX.get(token, ()):
+            topic_scores[topic_id] += 1
+
+    # I can only classify if I find at least one keyword match. The topic with the highest score wins,
+    # and if topics have the same score the one that comes first in TOPICS wins.
+    if not topic_scores:
+        return None
+    return min(topic_scores, key=lambda topic_id: (-topic_scores[topic_id], TOPIC_ORDER[topic_id]))
+
 
-# TOPIC CLASSIFICATION FUNCTION
-# >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 def classify_post_topic(content):
     
     # Here we determine which topic every post belongs to. We do this based on keyword matchin. 
-    # First I preprocess the content of the post and then for each topic, i cound how many keywords appear
+    # First I preprocess the content of the post and then I count how many keywords of each topic appear
     #in the post. From what we get, we can easily catagorize each post based on the most keyword matches.
     # finally, I also consider a situation that there is a post that doesn't match any topic. 
-    # clean the text
-    tokens = preprocess_text(content)
-    
-    # a sentence needs at least 2 words to make a reasonable classification
-    if len(tokens) < 2:
-        return None
-    
-    # I have to count keyword matches for each topic
-    topic_scores = {}
-    
-    for topic_id, topic_data in TOPICS.items():
-        keywords = topic_data['keywords']
-        score = sum(1 for token in tokens if token in keywords)
-        topic_scores[topic_id] = score
-    
-    # now I find the topic with the highest score
-    max_score = max(topic_scores.values())
-    
-    # I can only classify if I find at least one keyword match
-    if max_score > 0:
-        return max(topic_scores.items(), key=lambda x: x[1])[0]
-    return None
+    return classify_tokens(preprocess_topic_text(content))
+
+
+def classify_post_topics(contents):
+    # The same as classify_post_topic for many texts at once, for backfills and offline jobs.
+    # Returns a list with the topic id (or None) of every text, in the same order.
+    return [classify_tokens(tokens) for tokens in tokenize_stream(contents, TOPIC_STOP_WORDS)]
+
+
+# PRECOMPUTED POST TOPICS
+# >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+# Classifying a post means preprocessing all of its text, so instead of classifying every post in
+# the window on every page view, each post is classified once when it is written and the topic is
+# kept in the post_topics table. The trending and topic pages only read that table.
+# When TOPICS or the preprocessing changes the stored topics are out of date, topics_version()
+# changes with them and init_db() (or `flask rebuild-post-topics`) classifies everything again.
+
+def topics_version():
+    # the stop words are part of it because preprocess_topic_text uses them
+    topics_definition = json.dumps([TOPICS, sorted(TOPIC_STOP_WORDS)], sort_keys=True)
+    return hashlib.sha256(topics_definition.encode('utf-8')).hexdigest()[:12]
+
+
+# created_at is copied in SQL so it is stored exactly as it is in posts
+STORE_POST_TOPIC_SQL = '''
+    INSERT OR REPLACE INTO post_topics (post_id, topic_id, created_at)
+    SELECT id, ?, created_at FROM posts WHERE id = ?
+'''
+
+
+def store_post_topic(conn, post_id, content):
+    conn.execute(STORE_POST_TOPIC_SQL, (classify_post_topic(content or ''), post_id))
+
+
+def rebuild_post_topics(conn, post_ids=None):
+    # classifies the given posts again, or all posts if post_ids is None. The caller commits.
+    if post_ids is None:
+        conn.execute('DELETE FROM post_topics')
+        rows = conn.execute('SELECT id, content FROM posts').fetchall()
+    else:
+        rows = []
+        for chunk in _chunked(list(post_ids), SQL_IN_CHUNK_SIZE):
+            rows.extend(conn.execute(f"SELECT id, content FROM posts WHERE id IN ({','.join('?' * len(chunk))})",
+                                     chunk).fetchall())
+    topic_ids = classify_post_topics([row['content'] for row in rows])
+    conn.executemany(STORE_POST_TOPIC_SQL, [(topic_id, row['id']) for topic_id, row in zip(topic_ids, rows)])
+    if post_ids is None:
+        set_meta(conn, 'topics_version', topics_version())
+    rebuild_topic_engagement(conn)
+    return len(rows)
+
+
+# HOURLY TOPIC ENGAGEMENT
+# >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+# Summing the reactions and comments of every post in the window still grows with the number of
+# posts. The topic_engagement table keeps the counts per topic per hour (the hour the post was
+# created in), and the write routes add to and subtract from it. A trending window is then a sum
+# over at most 24 * days * 10 small rows.
+
+def hour_bucket_sql(column):
+    return f"strftime('%Y-%m-%d %H:00:00', {column})"
+
+
+def rebuild_topic_engagement(conn):
+    # recounts the whole table from post_topics. The caller commits.
+    conn.execute('DELETE FROM topic_engagement')
+    conn.execute(f'''
+        INSERT INTO topic_engagement (topic_id, hour, posts, reactions, comments)
+        SELECT pt.topic_id, {hour_bucket_sql('pt.created_at')}, COUNT(*),
+               SUM((SELECT COUNT(*) FROM reactions r WHERE r.post_id = pt.post_id)),
+               SUM((SELECT COUNT(*) FROM comments c WHERE c.post_id = pt.post_id))
+        FROM post_topics pt
+        WHERE pt.topic_id IS NOT NULL
+        GROUP BY 1, 2
+    ''')
+
+
+def adjust_topic_engagement(conn, post_id, posts=0, reactions=0, comments=0):
+    # adds the given deltas to the bucket of the post's topic and hour. Posts without
+    # a topic have no bucket, so nothing happens for them.
+    conn.execute(f'''
+        INSERT INTO topic_engagement (topic_id, hour, posts, reactions, comments)
+        SELECT topic_id, {hour_bucket_sql('created_at')}, ?, ?, ?
+        FROM post_topics WHERE post_id = ? AND topic_id IS NOT NULL
+        ON CONFLICT (topic_id, hour) DO UPDATE SET
+            posts = posts + excluded.posts,
+            reactions = reactions + excluded.reactions,
+            comments = comments + excluded.comments
+    ''', (posts, reactions, comments, post_id))
+
+
+def forget_post_in_topic_engagement(conn, post_id):
+    # takes a post that is about to be deleted, with its reactions and comments, out of its bucket
+    counts = conn.execute('''
+        SELECT (SELECT COUNT(*) FROM reactions WHERE post_id = ?) AS reactions,
+               (SELECT COUNT(*) FROM comments WHERE post_id = ?) AS comments
+    ''', (post_id, post_id)).fetchone()
+    adjust_topic_engagement(conn, post_id, posts=-1, reactions=-counts['reactions'], comments=-counts['comments'])
+
+
+def forget_comment_in_topic_engagement(conn, comment_id):
+    # takes a comment that is about to be deleted out of the bucket of its post
+    comment = conn.execute('SELECT post_id FROM comments WHERE id = ?', (comment_id,)).fetchone()
+    if comment:
+        adjust_topic_engagement(conn, comment['post_id'], comments=-1)
+
+
+@app.cli.command('rebuild-post-topics')
+def rebuild_post_topics_command():
+    """Classifies every post again and stores the topics in post_topics."""
+    conn = get_db()
+    count = rebuild_post_topics(conn)
+    conn.commit()
+    click.echo(f'post_topics rebuilt for {count} posts (topics version {topics_version()})')
+
 
 # MAIN TRENDING ALGORITHM >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 
 def get_trending_topics(days=7, top_n=5):
     # Here I gfind the top 5 rending topics in the past 7 days. to do so, I follow this process:
-    # First I quesry the database and find the posts from past 7 days, and classify them into topics. 
+    # First I quesry the database and find the posts from past 7 days, with the topics they were classified into
+    # when they were posted (see post_topics). 
     # For all the topics, I count the number of posts, their reactions, and total number fo comments.
     # In the next step, I have a trending score that is calculated using a weighted formula. Now, I just have to 
     # rank the topics based on their score and return the top 5. 
@@ -239,57 +980,57 @@ def get_trending_topics(days=7, top_n=5):
     # 3 because they show the most active engagement with content on soicail media. Many people will passively
     # like a post, but only the posts that receive the most comments are actually popular.
     
+    # days can be a fraction, days=1/24 is the last hour.
+
     db = get_db()
     cutoff_date = datetime.now() - timedelta(days=days)
-    
-    # query: I get all posts created after the cutoff date
-    posts = db.execute("select id, content, created_at from posts where created_at >= ? order by created_at DESC", (cutoff_date,)).fetchall()
-    
-    # data structure to organize information by topic
-    topic_data = defaultdict(lambda: {
-        'posts': [],           # list of post objects
-        'post_ids': [],        # list of post IDs for querying
-        'total_reactions': 0,  # count of reactions
-        'total_comments': 0 }) # count of comments
-    
-    # classifying each post and organize by topic
-    for post in posts:
-        topic_id = classify_post_topic(post['content'])        
-        if topic_id is not None:
-            topic_data[topic_id]['posts'].append(post)
-            topic_data[topic_id]['post_ids'].append(post['id'])
-    
-    #  calculating engagement metrics for each topic
-    for topic_id in topic_data.keys():
-        # get all post IDs for this topic
-        post_ids = topic_data[topic_id]['post_ids']
-        # Now I create SQL placeholders for IN clause: if post_ids = [1, 2, 3], placeholders = "?,?,?"
-        placeholders = ','.join('?' * len(post_ids))      
-        # query: count total reactions for all posts in this topic
-        reactions = db.execute(f"select count(*) as count from reactions where post_id IN ({placeholders})", post_ids).fetchone()
-        
-        # store reaction count (or 0 if None)
-        topic_data[topic_id]['total_reactions'] = reactions['count'] if reactions else 0
-        
-        # query: count total comments for all posts in this topic
-        comments = db.execute(f"select count(*) as count from comments where post_id IN ({placeholders})", post_ids).fetchone()
-        
-        # store comment count (or 0 if None)
-        topic_data[topic_id]['total_comments'] = comments['count'] if comments else 0
-    
+    # the hourly buckets (see topic_engagement) that are completely inside the window start here
+    cutoff_hour = cutoff_date.replace(minute=0, second=0, microsecond=0)
+    full_hours_start = cutoff_hour if cutoff_hour == cutoff_date else cutoff_hour + timedelta(hours=1)
+
+    # query: I sum the hourly buckets inside the window. The hour the window starts in is only partly
+    # inside it, so for that one hour I count the posts from post_topics instead.
+    # For every topic I also get its newest post, topics with the same score are ordered by that.
+    latest_post_sql = "(select max(created_at) from post_topics latest where latest.topic_id = {}.topic_id) as latest_post_at"
+    bucket_rows = db.execute(f"""
+        select te.topic_id, sum(te.posts) as post_count, sum(te.reactions) as total_reactions,
+               sum(te.comments) as total_comments, {latest_post_sql.format('te')}
+        from topic_engagement te
+        where te.hour >= ?
+        group by te.topic_id
+    """, (full_hours_start,)).fetchall()
+    partial_hour_rows = db.execute(f"""
+        select pt.topic_id, count(*) as post_count,
+               sum((select count(*) from reactions r where r.post_id = pt.post_id)) as total_reactions,
+               sum((select count(*) from comments c where c.post_id = pt.post_id)) as total_comments,
+               {latest_post_sql.format('pt')}
+        from post_topics pt
+        where pt.created_at >= ? and pt.created_at < ? and pt.topic_id is not null
+        group by pt.topic_id
+    """, (cutoff_date, full_hours_start)).fetchall()
+
+    topic_data = defaultdict(lambda: {'post_count': 0, 'total_reactions': 0, 'total_comments': 0, 'latest_post_at': None})
+    for row in list(bucket_rows) + list(partial_hour_rows):
+        data = topic_data[row['topic_id']]
+        data['post_count'] += row['post_count']
+        data['total_reactions'] += row['total_reactions']
+        data['total_comments'] += row['total_comments']
+        data['latest_post_at'] = row['latest_post_at']
+
     # step 3: calculate trending scores and prepare results
     trending_topics = []
-    
-    for topic_id, data in topic_data.items():
-        # skip topics with no posts
-        if not data['posts']:
+
+    for topic_id, data in sorted(topic_data.items(), key=lambda item: str(item[1]['latest_post_at']), reverse=True):
+        # skip topics with no posts (buckets stay behind at 0 when posts are deleted), and topics
+        # that are no longer in TOPICS (post_topics is rebuilt on the next start)
+        if data['post_count'] <= 0 or topic_id not in TOPICS:
             continue
-        
+
         # extract metrics
-        post_count = len(data['posts'])
+        post_count = data['post_count']
         reactions = data['total_reactions']
         comments = data['total_comments']
-        
+
         # calculate trending score using weighted formula that I explained at the beggining of this process.
         trending_score = (post_count * 1.0) + (reactions * 2.0) + (comments * 3.0)
         
@@ -312,34 +1053,199 @@ def get_trending_topics(days=7, top_n=5):
 
 # HELPER FUNCTION: GET POSTS BY TOPIC >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 
-def get_posts_by_topic(topic_id, days=7, limit=20):
+def get_posts_by_topic(topic_id, days=7, limit=20, cursor=None):
 # Now that we have the posts and topics that are trending, I have to create a function to get the recent posts
 # that belong to a topic. when the user clicks on a topic to see the posts, this is used. 
-# This is how the process is: We get all the posts from past 7 days, then classify them and only get the posts 
-# from the topics that have been requested. Then finally we only show 5 posts. 
+# This is how the process is: We get the posts from past 7 days that were classified into the requested topic
+# when they were posted (see post_topics). Then finally we only show 5 posts. 
+# cursor is a decoded cursor (see decode_cursor) of (created_at, post id), to get the page before or after it.
     
     # get database connection
     db = get_db()
     # calculate cutoff date
     cutoff_date = datetime.now() - timedelta(days=days)
     
-    # query: get all recent posts with user info and engagement counts
-    # we use subqueries to count reactions and comments for each post
-    posts = db.execute("select p.*, u.username,(select count(*) from reactions where post_id = p.id) as reaction_count,(SELECT COUNT(*) from comments where post_id = p.id) as comment_count from posts p join users u ON p.user_id = u.id where p.created_at >= ? order by p.created_at DESC", (cutoff_date,)).fetchall()
-    
-    # filter posts by topic and only keep thoswe that belong to the trending topics. 
-    topic_posts = []
-    for post in posts:
-        post_topic = classify_post_topic(post['content'])    
-        if post_topic == topic_id:
-            topic_posts.append(post)          
-            # If we reach the limit of the number of posts, here 5 posts, we stop the process. 
-            # of courwsew this can easily be changed to get a higher or lower number of posts. 
-            if len(topic_posts) >= limit:
-                break   
+    keyset_condition, keyset_params, order_by, _ = keyset_query_parts(['pt.created_at', 'pt.post_id'], cursor)
+    conditions = ['pt.topic_id = ?', 'pt.created_at >= ?']
+    if keyset_condition:
+        conditions.append(keyset_condition)
+
+    # query: get the recent posts of this topic with user info and engagement counts
+    # the topic of every post is already in post_topics, so the filtering happens in SQL, reading the
+    # (topic_id, created_at) index newest first. The inner query stops after `limit` posts, and only
+    # then we use subqueries to count reactions and comments, so they run for the shown posts only.
+    topic_posts = db.execute(f"""
+        select page.*,
+               (select count(*) from reactions where post_id = page.id) as reaction_count,
+               (select count(*) from comments where post_id = page.id) as comment_count
+        from (
+            select p.*, u.username, pt.created_at as topic_created_at, pt.post_id as topic_post_id
+            from post_topics pt
+            join posts p ON p.id = pt.post_id
+            join users u ON p.user_id = u.id
+            where {' and '.join(conditions)}
+            order by {order_by}
+            limit ?
+        ) page
+        order by page.topic_created_at DESC, page.topic_post_id DESC
+    """, [topic_id, cutoff_date] + keyset_params + [limit]).fetchall()
     return topic_posts
 
 
+# CACHING TRENDING RESULTS >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+# The trending pages show the same thing to everyone and it barely changes from one minute to the
+# next, so the results are cached in memory. A result is fresh for TRENDING_CACHE_TTL seconds. After
+# that, the old result is still served while a background thread computes the new one, so no visitor
+# waits for it (stale-while-revalidate). Only results older than TRENDING_CACHE_STALE_TTL are
+# recomputed while the visitor waits. Deleting a post clears the cache, so a deleted post doesn't
+# stay on the topic pages. The cache is per process, with several worker processes each has its own.
+# It holds at most TRENDING_CACHE_SIZE results, the oldest ones are dropped first.
+
+app.config.setdefault('TRENDING_CACHE_TTL', 60)
+app.config.setdefault('TRENDING_CACHE_STALE_TTL', 600)
+app.config.setdefault('TRENDING_CACHE_SIZE', 1000)
+
+
+class TTLCache:
+    """
+    A thread-safe in-memory cache with a time to live and background refresh. Its settings
+    are read from app.config every time they are used, ttl from <setting>_TTL, stale_ttl from
+    <setting>_STALE_TTL (the same as ttl if it isn't set) and max_entries from <setting>_SIZE.
+
+    get(key, compute) returns the cached value for key if it is younger than ttl. If it
+    is younger than stale_ttl it is returned too, and compute() runs on a background
+    thread (inside an app context, so it can use get_db()) to replace it. Otherwise
+    compute() runs right away, once per key even if many threads ask at the same time.
+
+    At most max_entries values are kept. Values older than stale_ttl are dropped when
+    the next value is stored, and past max_entries the oldest ones are dropped first.
+    """
+
+    def __init__(self, setting):
+        self.setting = setting
+        # key -> (value, time it was computed), in the order they were computed
+        self._entries = collections.OrderedDict()
+        # key -> [lock, number of threads using it], only while a value is being computed
+        self._key_locks = {}
+        self._refreshing = set()
+        # bumped by clear(), so a refresh that started before it doesn't store an old value
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+    @property
+    def ttl(self):
+        return app.config[f'{self.setting}_TTL']
+
+    @property
+    def stale_ttl(self):
+        return app.config.get(f'{self.setting}_STALE_TTL', self.ttl)
+
+    @property
+    def max_entries(self):
+        return app.config[f'{self.setting}_SIZE']
+
+    def get(self, key, compute):
+        with self._lock:
+            entry = self._entries.get(key)
+            age = time.monotonic() - entry[1] if entry is not None else None
+            if age is not None and age < self.ttl:
+                self._counters['hits'] += 1
+                return entry[0]
+            if age is not None and age < self.stale_ttl:
+                self._counters['stale_hits'] += 1
+                start_refresh = key not in self._refreshing
+                if start_refresh:
+                    self._refreshing.add(key)
+                    generation = self._generation
+            else:
+                self._counters['misses'] += 1
+                key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+                key_lock[1] += 1
+                entry = None
+
+        if entry is not None:
+            if start_refresh:
+                threading.Thread(target=self._refresh, args=(key, compute, generation), daemon=True).start()
+            return entry[0]
+
+        try:
+            with key_lock[0]:
+                # another thread may have computed it while this one was waiting for the lock
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                        return entry[0]
+                    generation = self._generation
+                value = compute()
+                self._store(key, value, generation)
+            return value
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[key]
+
+    def _refresh(self, key, compute, generation):
+        try:
+            with app.app_context():
+                value = compute()
+        except Exception:
+            app.logger.exception('Refreshing cached %r failed, the stale value is kept', key)
+            with self._lock:
+                self._counters['refresh_errors'] += 1
+        else:
+            self._store(key, value, generation)
+            with self._lock:
+                self._counters['refreshes'] += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _store(self, key, value, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            now = time.monotonic()
+            stale_ttl, max_entries = self.stale_ttl, self.max_entries
+            self._entries.pop(key, None)
+            self._entries[key] = (value, now)
+            # the oldest values are first, so this stops at the first one that is kept
+            while self._entries:
+                oldest_key, (_, computed_at) = next(iter(self._entries.items()))
+                if now - computed_at < stale_ttl and len(self._entries) <= max_entries:
+                    break
+                del self._entries[oldest_key]
+                self._counters['evictions'] += 1
+
+    def discard(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._counters['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = {name: self._counters[name]
+                     for name in ('hits', 'stale_hits', 'misses', 'refreshes', 'refresh_errors', 'invalidations',
+                                  'evictions')}
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['stale_hits']) / lookups if lookups else 0.0
+        stats['ttl'] = self.ttl
+        stats['stale_ttl'] = self.stale_ttl
+        stats['max_entries'] = self.max_entries
+        return stats
+
+
+trending_cache = TTLCache('TRENDING_CACHE')
+
+
 #>>>>>>>>>>>>>>> end of Trending algorithm >>>>>>>>>>>>>>>>>
 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 
@@ -361,17 +1267,35 @@ def feed():
     params = []
 
     #  2. Build the Query 
-    where_clause = ""
+    conditions = []
     if show == 'following' and current_user_id:
-        where_clause = "WHERE p.user_id IN (SELECT followed_id FROM follows WHERE follower_id = ?)"
+        conditions.append("p.user_id IN (SELECT followed_id FROM follows WHERE follower_id = ?)")
         params.append(current_user_id)
 
+    # The 'new' and 'popular' feeds are paged with a cursor (see encode_cursor) when the
+    # link has one, and with the page number otherwise.
+    if sort == 'popular':
+        key_columns = ['IFNULL(r.total_reactions, 0)', 'p.created_at', 'p.id']
+        row_key = lambda row: [row['total_reactions'], row['created_at'], row['id']]
+    else:
+        key_columns = ['p.created_at', 'p.id']
+        row_key = lambda row: [row['created_at'], row['id']]
+    cursor = decode_cursor(request.args.get('cursor'), len(key_columns))
+    keyset_condition, keyset_params, order_by, reverse = keyset_query_parts(key_columns, cursor)
+    if keyset_condition:
+        conditions.append(keyset_condition)
+        params.extend(keyset_params)
+        offset = 0
+    where_clause = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
     # Add the pagination parameters to the query arguments
     pagination_params = (POSTS_PER_PAGE, offset)
+    prev_cursor = next_cursor = None
 
     if sort == 'popular':
         query = f"""
             SELECT p.id, p.content, p.created_at, u.username, u.id as user_id,
+                   p.moderated_content, p.moderation_score, p.moderation_version,
                    IFNULL(r.total_reactions, 0) as total_reactions
             FROM posts p
             JOIN users u ON p.user_id = u.id
@@ -379,63 +1303,84 @@ def feed():
                 SELECT post_id, COUNT(*) as total_reactions FROM reactions GROUP BY post_id
             ) r ON p.id = r.post_id
             {where_clause}
-            ORDER BY total_reactions DESC, p.created_at DESC
+            ORDER BY {order_by}
             LIMIT ? OFFSET ?
         """
         final_params = params + list(pagination_params)
         posts = query_db(query, final_params)
+        if reverse:
+            posts.reverse()
+        prev_cursor, next_cursor = page_cursors(posts, row_key)
     elif sort == 'recommended':
-        posts = recommend(current_user_id, show == 'following' and current_user_id)
+        # ?algo=tfidf scores the recommendations with TF-IDF weights instead of keyword overlap,
+        # and ?algo=itemcf by what the people who reacted to the same posts reacted to
+        algo = request.args.get('algo', 'overlap')
+        mode = algo if algo in RECOMMEND_MODES else 'overlap'
+        # pages of the user's cached ranking (see recommendation_ranking), which starts with the
+        # ones stored by `flask precompute-recommendations` unless they are stale
+        ranking = recommendation_ranking(current_user_id, show == 'following' and bool(current_user_id), mode)
+        posts = posts_in_order(get_db(), [post_id for post_id, score in ranking.page(offset, POSTS_PER_PAGE)])
     else:  # Default sort is 'new'
         query = f"""
-            SELECT p.id, p.content, p.created_at, u.username, u.id as user_id
+            SELECT p.id, p.content, p.created_at, u.username, u.id as user_id,
+                   p.moderated_content, p.moderation_score, p.moderation_version
             FROM posts p
             JOIN users u ON p.user_id = u.id
             {where_clause}
-            ORDER BY p.created_at DESC
+            ORDER BY {order_by}
             LIMIT ? OFFSET ?
         """
         final_params = params + list(pagination_params)
         posts = query_db(query, final_params)
+        if reverse:
+            posts.reverse()
+        prev_cursor, next_cursor = page_cursors(posts, row_key)
+
+    #  3. Load Follows, Reactions and Comments for the Whole Page 
+    # Everything below is fetched with one query per kind of data, keyed by the IDs of
+    # the posts on this page, instead of four queries per post.
+    post_ids = [post['id'] for post in posts]
+    post_placeholders = ','.join('?' * len(post_ids))
+
+    # Which of the posters the current user follows
+    followed_user_ids = set()
+    poster_ids = list({post['user_id'] for post in posts if post['user_id'] != current_user_id})
+    if current_user_id and poster_ids:
+        followed_user_ids = followed_among(current_user_id, poster_ids)
+
+    # Which posts the current user reacted to and with what reaction
+    user_reactions = {}
+    if current_user_id and post_ids:
+        for row in query_db(f'SELECT post_id, reaction_type FROM reactions WHERE user_id = ? AND post_id IN ({post_placeholders}) ORDER BY id',
+                            [current_user_id] + post_ids):
+            user_reactions.setdefault(row['post_id'], row['reaction_type'])
+
+    reactions_by_post = defaultdict(list)
+    comments_by_post = defaultdict(list)
+    if post_ids:
+        for row in query_db(f'SELECT post_id, reaction_type, COUNT(*) as count FROM reactions WHERE post_id IN ({post_placeholders}) GROUP BY post_id, reaction_type ORDER BY post_id, reaction_type',
+                            post_ids):
+            reactions_by_post[row['post_id']].append(row)
+        for row in query_db(f'SELECT c.post_id, c.id, c.content, c.created_at, u.username, u.id as user_id, c.moderated_content, c.moderation_score, c.moderation_version FROM comments c JOIN users u ON c.user_id = u.id WHERE c.post_id IN ({post_placeholders}) ORDER BY c.post_id, c.created_at ASC, c.id ASC',
+                            post_ids):
+            comments_by_post[row['post_id']].append(row)
 
     posts_data = []
     for post in posts:
-        # Determine if the current user follows the poster
-        followed_poster = False
-        if current_user_id and post['user_id'] != current_user_id:
-            follow_check = query_db(
-                'SELECT 1 FROM follows WHERE follower_id = ? AND followed_id = ?',
-                (current_user_id, post['user_id']),
-                one=True
-            )
-            if follow_check:
-                followed_poster = True
-
-        # Determine if the current user reacted to this post and with what reaction
-        user_reaction = None
-        if current_user_id:
-            reaction_check = query_db(
-                'SELECT reaction_type FROM reactions WHERE user_id = ? AND post_id = ?',
-                (current_user_id, post['id']),
-                one=True
-            )
-            if reaction_check:
-                user_reaction = reaction_check['reaction_type']
-
-        reactions = query_db('SELECT reaction_type, COUNT(*) as count FROM reactions WHERE post_id = ? GROUP BY reaction_type', (post['id'],))
-        comments_raw = query_db('SELECT c.id, c.content, c.created_at, u.username, u.id as user_id FROM comments c JOIN users u ON c.user_id = u.id WHERE c.post_id = ? ORDER BY c.created_at ASC', (post['id'],))
         post_dict = dict(post)
-        post_dict['content'], _ = moderate_content(post_dict['content'])
+        post_dict['content'], _ = stored_moderation(post_dict['content'], post_dict.get('moderated_content'),
+                                                    post_dict.get('moderation_score'), post_dict.get('moderation_version'))
         comments_moderated = []
-        for comment in comments_raw:
+        for comment in comments_by_post[post['id']]:
             comment_dict = dict(comment)
-            comment_dict['content'], _ = moderate_content(comment_dict['content'])
+            comment_dict['content'], _ = stored_moderation(comment_dict['content'], comment_dict['moderated_content'],
+                                                           comment_dict['moderation_score'], comment_dict['moderation_version'])
             comments_moderated.append(comment_dict)
         posts_data.append({
             'post': post_dict,
-            'reactions': reactions,
-            'user_reaction': user_reaction,
-            'followed_poster': followed_poster,
+            'reactions': reactions_by_post[post['id']],
+            'user_reaction': user_reactions.get(post['id']),
+            'followed_poster': post['user_id'] in followed_user_ids,
             'comments': comments_moderated
         })
 
@@ -445,7 +1390,10 @@ def feed():
                            current_sort=sort,
                            current_show=show,
                            page=page, # Pass current page number
+                           current_algo=request.args.get('algo') if sort == 'recommended' else None,
                            per_page=POSTS_PER_PAGE, # Pass items per page
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
                            reaction_emojis=REACTION_EMOJIS,
                            reaction_types=REACTION_TYPES)
 
@@ -453,6 +1401,15 @@ def feed():
 #>>>>>>>>>>>>>>>>>>>>>>flask routes>>>>>>>>>>>>>>>>>>>
 
 
+# the trending pages look at the last 7 days, or at the number of days in ?days= (1 to 30)
+TRENDING_DAYS_DEFAULT = 7
+TRENDING_DAYS_MAX = 30
+
+def trending_days():
+    days = request.args.get('days', TRENDING_DAYS_DEFAULT, type=int)
+    return min(max(days, 1), TRENDING_DAYS_MAX)
+
+
 # Trending topic page
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 @app.route('/trending')
@@ -463,8 +1420,9 @@ def trending():
     if 'user_id' not in session:
         # If the user is not logged in, I send them to login page to login and then show the result. 
         return redirect(url_for('login'))
-    trending_topics = get_trending_topics(days=7, top_n=5)
-    return render_template('trending.html',trending_topics=trending_topics)
+    days = trending_days()
+    trending_topics = trending_cache.get(('trending', days, 5), lambda: get_trending_topics(days=days, top_n=5))
+    return render_template('trending.html',trending_topics=trending_topics, days=days)
 
 
 # ROUTE 2: TOPIC DETAIL PAGE
@@ -485,8 +1443,25 @@ def topic_posts(topic_id):
         flash('Invalid topic')
         return redirect(url_for('trending'))
     topic_name = TOPICS[topic_id]['name']
-    posts = get_posts_by_topic(topic_id, days=7, limit=20)
-    return render_template('topic_posts.html',topic_name=topic_name,posts=posts)
+    days = trending_days()
+    # only the first page is cached, the pages after it are read with a cursor and are cheap anyway
+    cursor = decode_cursor(request.args.get('cursor'), 2)
+    if cursor is None:
+        posts = trending_cache.get(('topic_posts', topic_id, days, 20),
+                                   lambda: get_posts_by_topic(topic_id, days=days, limit=20))
+    else:
+        posts = get_posts_by_topic(topic_id, days=days, limit=20, cursor=cursor)
+    prev_cursor, next_cursor = page_cursors(posts, lambda row: [row['topic_created_at'], row['id']])
+    # no link to the newer posts on the first page, and no link past the end of the list
+    if cursor is None:
+        prev_cursor = None
+    if len(posts) < 20:
+        if cursor is None or cursor[1] == 'next':
+            next_cursor = None
+        else:
+            prev_cursor = None
+    return render_template('topic_posts.html',topic_name=topic_name,posts=posts, topic_id=topic_id, days=days,
+                           prev_cursor=prev_cursor, next_cursor=next_cursor)
 
 #>>>>>>>>>>>>>>>>>>>>>end of flask routes>>>>>>>>>>>>>
 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
@@ -508,14 +1483,19 @@ def add_post():
     # Get content from the submitted form
     content = request.form.get('content')
 
-    # Pass the user's content through the moderation function
-    moderated_content = content
-
     # Basic validation to ensure post is not empty
-    if moderated_content and moderated_content.strip():
+    if content and content.strip():
+        # The raw content is kept so it can be moderated again if the censorship
+        # config changes; the moderated version is what gets shown.
+        moderated_content, moderation_score, moderation_version = moderate_for_storage(content)
         db = get_db()
-        db.execute('INSERT INTO posts (user_id, content) VALUES (?, ?)',
-                   (user_id, moderated_content))
+        cur = db.execute('''INSERT INTO posts (user_id, content, moderated_content, moderation_score, moderation_version)
+                            VALUES (?, ?, ?, ?, ?)''',
+                         (user_id, content, moderated_content, moderation_score, moderation_version))
+        adjust_user_risk(db, user_id, post_score_sum=moderation_score, post_count=1)
+        store_post_topic(db, cur.lastrowid, content)
+        adjust_topic_engagement(db, cur.lastrowid, posts=1)
+        store_post_terms(db, cur.lastrowid, content)
         db.commit()
         flash('Your post was successfully created!', 'success')
     else:
@@ -551,12 +1531,21 @@ def delete_post(post_id):
 
     # If all checks pass, proceed with deletion
     db = get_db()
+    forget_post_in_user_risk(db, post_id)
+    forget_post_in_topic_engagement(db, post_id)
+    forget_post_in_user_interests(db, post_id)
     # To maintain database integrity, delete associated records first
     db.execute('DELETE FROM comments WHERE post_id = ?', (post_id,))
     db.execute('DELETE FROM reactions WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM post_topics WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM post_terms WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM recommendations WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM post_reactions WHERE post_id = ?', (post_id,))
     # Finally, delete the post itself
     db.execute('DELETE FROM posts WHERE id = ?', (post_id,))
     db.commit()
+    trending_cache.clear()
+    recommendation_cache.clear()
 
     flash('Your post was successfully deleted.', 'success')
     # Redirect back to the page the user came from, or the feed as a fallback
@@ -571,41 +1560,39 @@ def user_profile(username):
         abort(404)
 
     user = dict(user_raw)
-    moderated_bio, _ = moderate_content(user.get('profile', ''))
+    moderated_bio, _ = stored_moderation(user.get('profile', ''), user['moderated_profile'],
+                                         user['profile_moderation_score'], user['profile_moderation_version'])
     user['profile'] = moderated_bio
 
-    posts_raw = query_db('SELECT id, content, user_id, created_at FROM posts WHERE user_id = ? ORDER BY created_at DESC', (user['id'],))
+    posts_raw = query_db('SELECT id, content, user_id, created_at, moderated_content, moderation_score, moderation_version FROM posts WHERE user_id = ? ORDER BY created_at DESC', (user['id'],))
     posts = []
     for post_raw in posts_raw:
         post = dict(post_raw)
-        moderated_post_content, _ = moderate_content(post['content'])
+        moderated_post_content, _ = stored_moderation(post['content'], post['moderated_content'],
+                                                      post['moderation_score'], post['moderation_version'])
         post['content'] = moderated_post_content
         posts.append(post)
 
-    comments_raw = query_db('SELECT id, content, user_id, post_id, created_at FROM comments WHERE user_id = ? ORDER BY created_at DESC LIMIT 100', (user['id'],))
+    comments_raw = query_db('SELECT id, content, user_id, post_id, created_at, moderated_content, moderation_score, moderation_version FROM comments WHERE user_id = ? ORDER BY created_at DESC LIMIT 100', (user['id'],))
     comments = []
     for comment_raw in comments_raw:
         comment = dict(comment_raw)
-        moderated_comment_content, _ = moderate_content(comment['content'])
+        moderated_comment_content, _ = stored_moderation(comment['content'], comment['moderated_content'],
+                                                         comment['moderation_score'], comment['moderation_version'])
         comment['content'] = moderated_comment_content
         comments.append(comment)
 
-    followers_count = query_db('SELECT COUNT(*) as cnt FROM follows WHERE followed_id = ?', (user['id'],), one=True)['cnt']
-    following_count = query_db('SELECT COUNT(*) as cnt FROM follows WHERE follower_id = ?', (user['id'],), one=True)['cnt']
+    followers_count, following_count = follow_counts(user['id'])
 
     #  NEW: CHECK FOLLOW STATUS 
     is_currently_following = False # Default to False
     current_user_id = session.get('user_id')
+    # "people you may know" on the user's own profile
+    suggested_users = follow_suggestions(current_user_id) if current_user_id == user['id'] else []
     
     # We only need to check if a user is logged in
     if current_user_id:
-        follow_relation = query_db(
-            'SELECT 1 FROM follows WHERE follower_id = ? AND followed_id = ?',
-            (current_user_id, user['id']),
-            one=True
-        )
-        if follow_relation:
-            is_currently_following = True
+        is_currently_following = is_following(current_user_id, user['id'])
     # --
 
     return render_template('user_profile.html.j2', 
@@ -614,7 +1601,8 @@ def user_profile(username):
                            comments=comments,
                            followers_count=followers_count, 
                            following_count=following_count,
-                           is_following=is_currently_following)
+                           is_following=is_currently_following,
+                           suggested_users=suggested_users)
     
 
 @app.route('/u/<username>/followers')
@@ -648,7 +1636,8 @@ def post_detail(post_id):
     """Displays a single post and its comments, with content moderation applied."""
     
     post_raw = query_db('''
-        SELECT p.id, p.content, p.created_at, u.username, u.id as user_id
+        SELECT p.id, p.content, p.created_at, u.username, u.id as user_id,
+               p.moderated_content, p.moderation_score, p.moderation_version
         FROM posts p
         JOIN users u ON p.user_id = u.id
         WHERE p.id = ?
@@ -661,8 +1650,9 @@ def post_detail(post_id):
     #  Moderation for the Main Post 
     # Convert the raw database row to a mutable dictionary
     post = dict(post_raw)
-    # Unpack the tuple from moderate_content, we only need the moderated content string here
-    moderated_post_content, _ = moderate_content(post['content'])
+    # Unpack the tuple from stored_moderation, we only need the moderated content string here
+    moderated_post_content, _ = stored_moderation(post['content'], post['moderated_content'],
+                                                  post['moderation_score'], post['moderation_version'])
     post['content'] = moderated_post_content
 
     #  Fetch Reactions (No moderation needed) 
@@ -674,14 +1664,15 @@ def post_detail(post_id):
     ''', (post_id,))
 
     #  Fetch and Moderate Comments 
-    comments_raw = query_db('SELECT c.id, c.content, c.created_at, u.username, u.id as user_id FROM comments c JOIN users u ON c.user_id = u.id WHERE c.post_id = ? ORDER BY c.created_at ASC', (post_id,))
+    comments_raw = query_db('SELECT c.id, c.content, c.created_at, u.username, u.id as user_id, c.moderated_content, c.moderation_score, c.moderation_version FROM comments c JOIN users u ON c.user_id = u.id WHERE c.post_id = ? ORDER BY c.created_at ASC', (post_id,))
     
     comments = [] # Create a new list for the moderated comments
     for comment_raw in comments_raw:
         comment = dict(comment_raw) # Convert to a dictionary
         # Moderate the content of each comment
         print(comment['content'])
-        moderated_comment_content, _ = moderate_content(comment['content'])
+        moderated_comment_content, _ = stored_moderation(comment['content'], comment['moderated_content'],
+                                                         comment['moderation_score'], comment['moderation_version'])
         comment['content'] = moderated_comment_content
         comments.append(comment)
 
@@ -712,18 +1703,22 @@ def signup():
         profile = request.form.get('profile', '')
 
         hashed_password = generate_password_hash(password)
+        moderated_profile, profile_score, profile_version = moderate_for_storage(profile)
 
         db = get_db()
         cur = db.cursor()
         try:
             cur.execute(
-                'INSERT INTO users (username, password, location, birthdate, profile) VALUES (?, ?, ?, ?, ?)',
-                (username, hashed_password, location, birthdate, profile)
+                '''INSERT INTO users (username, password, location, birthdate, profile,
+                                      moderated_profile, profile_moderation_score, profile_moderation_version)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                (username, hashed_password, location, birthdate, profile,
+                 moderated_profile, profile_score, profile_version)
             )
-            db.commit()
-
             # 1. Get the ID of the user we just created.
             new_user_id = cur.lastrowid
+            adjust_user_risk(db, new_user_id)
+            db.commit()
 
             # 2. Add user info to the session cookie.
             session.clear() # Clear any old session data
@@ -738,7 +1733,6 @@ def signup():
             flash('Username already taken. Please choose another one.', 'danger')
         finally:
             cur.close()
-            db.close()
             
     return render_template('signup.html.j2')
 
@@ -750,7 +1744,6 @@ def login():
 
         db = get_db()
         user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        db.close()
 
         # 1. Check if the user exists.
         # 2. If user exists, use check_password_hash to securely compare the password.
@@ -788,9 +1781,13 @@ def add_comment(post_id):
 
     # Basic validation to ensure comment is not empty
     if content and content.strip():
+        moderated_content, moderation_score, moderation_version = moderate_for_storage(content)
         db = get_db()
-        db.execute('INSERT INTO comments (post_id, user_id, content) VALUES (?, ?, ?)',
-                   (post_id, user_id, content))
+        db.execute('''INSERT INTO comments (post_id, user_id, content, moderated_content, moderation_score, moderation_version)
+                      VALUES (?, ?, ?, ?, ?, ?)''',
+                   (post_id, user_id, content, moderated_content, moderation_score, moderation_version))
+        adjust_user_risk(db, user_id, comment_score_sum=moderation_score, comment_count=1)
+        adjust_topic_engagement(db, post_id, comments=1)
         db.commit()
         flash('Your comment was added.', 'success')
     else:
@@ -829,6 +1826,8 @@ def delete_comment(comment_id):
 
     # If all checks pass, proceed with deletion
     db = get_db()
+    forget_comments_in_user_risk(db, 'id = ?', (comment_id,))
+    forget_comment_in_topic_engagement(db, comment_id)
     db.execute('DELETE FROM comments WHERE id = ?', (comment_id,))
     db.commit()
 
@@ -853,21 +1852,38 @@ def add_reaction():
         return redirect(request.referrer or url_for('feed'))
 
     db = get_db()
+    # The check and the write below happen in one write transaction, so two requests
+    # reacting at the same time can't both decide to INSERT (reactions are unique per
+    # user and post).
+    db.execute('BEGIN IMMEDIATE')
 
     # Step 1: Check if a reaction from this user already exists on this post.
-    existing_reaction = query_db('SELECT id FROM reactions WHERE post_id = ? AND user_id = ?',
-                                 (post_id, user_id), one=True)
+    existing_reaction = db.execute('SELECT id, reaction_type FROM reactions WHERE post_id = ? AND user_id = ?',
+                                   (post_id, user_id)).fetchone()
+    # The post author's stored risk components follow the reactions on their posts.
+    post_author = db.execute('SELECT user_id FROM posts WHERE id = ?', (post_id,)).fetchone()
+    post_author_id = post_author['user_id'] if post_author else None
 
     if existing_reaction:
         # Step 2: If it exists, UPDATE the reaction_type.
         db.execute('UPDATE reactions SET reaction_type = ? WHERE id = ?',
                    (new_reaction_type, existing_reaction['id']))
+        adjust_user_risk(db, post_author_id,
+                         reaction_sentiment_sum=REACTION_SENTIMENT.get(new_reaction_type, 0) - REACTION_SENTIMENT.get(existing_reaction['reaction_type'], 0))
     else:
         # Step 3: If it does not exist, INSERT a new reaction.
-        db.execute('INSERT INTO reactions (post_id, user_id, reaction_type) VALUES (?, ?, ?)',
-                   (post_id, user_id, new_reaction_type))
+        cur = db.execute('INSERT INTO reactions (post_id, user_id, reaction_type) VALUES (?, ?, ?)',
+                         (post_id, user_id, new_reaction_type))
+        adjust_user_risk(db, post_author_id,
+                         reaction_sentiment_sum=REACTION_SENTIMENT.get(new_reaction_type, 0), reaction_count=1)
+        adjust_topic_engagement(db, post_id, reactions=1)
+        adjust_post_reactions(db, post_id, 1)
+        add_user_interests(db, user_id, post_id, cur.lastrowid)
+        forget_user_recommendations(db, user_id)
 
     db.commit()
+    if not existing_reaction:
+        forget_cached_recommendations(user_id)
 
     return redirect(request.referrer or url_for('feed'))
 
@@ -890,14 +1906,21 @@ def unreact():
 
     # Remove the reaction if it exists
     existing_reaction = query_db(
-        'SELECT id FROM reactions WHERE post_id = ? AND user_id = ?',
+        'SELECT r.id, r.reaction_type, p.user_id AS post_author_id FROM reactions r LEFT JOIN posts p ON p.id = r.post_id WHERE r.post_id = ? AND r.user_id = ?',
         (post_id, user_id),
         one=True
     )
 
     if existing_reaction:
         db.execute('DELETE FROM reactions WHERE id = ?', (existing_reaction['id'],))
+        adjust_user_risk(db, existing_reaction['post_author_id'],
+                         reaction_sentiment_sum=-REACTION_SENTIMENT.get(existing_reaction['reaction_type'], 0), reaction_count=-1)
+        adjust_topic_engagement(db, post_id, reactions=-1)
+        adjust_post_reactions(db, post_id, -1)
+        remove_user_interests(db, user_id, post_id, existing_reaction['id'])
+        forget_user_recommendations(db, user_id)
         db.commit()
+        forget_cached_recommendations(user_id)
         flash("Reaction removed.", "success")
     else:
         flash("No reaction to remove.", "info")
@@ -932,6 +1955,11 @@ def follow_user(user_id):
         db.execute('INSERT INTO follows (follower_id, followed_id) VALUES (?, ?)',
                    (follower_id, user_id))
         db.commit()
+        graph = get_follow_graph()
+        if graph is not None:
+            graph.follow(follower_id, user_id)
+        forget_cached_recommendations(follower_id)
+        suggestion_cache.discard(follower_id)
         username_to_follow = query_db('SELECT username FROM users WHERE id = ?', (user_id,), one=True)['username']
         flash(f"You are now following {username_to_follow}.", "success")
     except sqlite3.IntegrityError:
@@ -954,6 +1982,11 @@ def unfollow_user(user_id):
     cur = db.execute('DELETE FROM follows WHERE follower_id = ? AND followed_id = ?',
                (follower_id, user_id))
     db.commit()
+    graph = get_follow_graph()
+    if graph is not None:
+        graph.unfollow(follower_id, user_id)
+    forget_cached_recommendations(follower_id)
+    suggestion_cache.discard(follower_id)
 
     if cur.rowcount > 0:
         # cur.rowcount tells us if a row was actually deleted
@@ -1000,22 +2033,27 @@ def admin_dashboard():
 
     users_offset = (users_page - 1) * PAGE_SIZE
     
-    # First, get all users to calculate risk, then apply pagination in Python
-    # It's more complex to do this efficiently in SQL if risk calc is Python-side
-    all_users_raw = query_db('SELECT id, username, profile, created_at FROM users')
-    all_users = []
-    for user in all_users_raw:
+    # Risk scores are kept up to date in the user_risk table by the write routes, so the
+    # users can be sorted and paginated in SQL. Only the users whose account age
+    # multiplier changed since they were last scored need to be scored again first.
+    db = get_db()
+    rescore_due_user_risk(db)
+    total_users = query_db('SELECT COUNT(*) as count FROM user_risk', one=True)['count']
+    users_raw = query_db('''
+        SELECT u.id, u.username, u.profile, u.created_at, ur.risk_score
+        FROM user_risk ur JOIN users u ON u.id = ur.user_id
+        ORDER BY ur.risk_score DESC, ur.user_id
+        LIMIT ? OFFSET ?
+    ''', (PAGE_SIZE, users_offset))
+    users = []
+    for user in users_raw:
         user_dict = dict(user)
-        user_risk_score = user_risk_analysis(user_dict['id'])
+        user_risk_score = user_dict['risk_score']
         risk_label, risk_sort_key = get_risk_profile(user_risk_score)
         user_dict['risk_label'] = risk_label
         user_dict['risk_sort_key'] = risk_sort_key
         user_dict['risk_score'] = min(5.0, round(user_risk_score, 2))
-        all_users.append(user_dict)
-
-    all_users.sort(key=lambda x: x['risk_score'], reverse=True)
-    total_users = len(all_users)
-    users = all_users[users_offset : users_offset + PAGE_SIZE]
+        users.append(user_dict)
     total_users_pages = (total_users + PAGE_SIZE - 1) // PAGE_SIZE
 
     # --- Posts Tab Data ---
@@ -1023,16 +2061,24 @@ def admin_dashboard():
     total_posts_count = query_db('SELECT COUNT(*) as count FROM posts', one=True)['count']
     total_posts_pages = (total_posts_count + PAGE_SIZE - 1) // PAGE_SIZE
 
+    posts_condition, posts_params, posts_order_by, posts_reverse = keyset_query_parts(
+        ['p.id'], decode_cursor(request.args.get('posts_cursor'), 1))
     posts_raw = query_db(f'''
-        SELECT p.id, p.content, p.created_at, u.username, u.created_at as user_created_at
+        SELECT p.id, p.content, p.created_at, u.username, u.created_at as user_created_at,
+               p.moderated_content, p.moderation_score, p.moderation_version
         FROM posts p JOIN users u ON p.user_id = u.id
-        ORDER BY p.id DESC -- Order by ID for consistent pagination before risk sort
+        {'WHERE ' + posts_condition if posts_condition else ''}
+        ORDER BY {posts_order_by} -- Order by ID for consistent pagination before risk sort
         LIMIT ? OFFSET ?
-    ''', (PAGE_SIZE, posts_offset))
+    ''', (*posts_params, PAGE_SIZE, 0 if posts_condition else posts_offset))
+    if posts_reverse:
+        posts_raw.reverse()
+    posts_prev_cursor, posts_next_cursor = page_cursors(posts_raw, lambda row: [row['id']])
     posts = []
     for post in posts_raw:
         post_dict = dict(post)
-        _, base_score = moderate_content(post_dict['content'])
+        _, base_score = stored_moderation(post_dict['content'], post_dict['moderated_content'],
+                                          post_dict['moderation_score'], post_dict['moderation_version'])
         final_score = base_score 
         author_created_dt = post_dict['user_created_at']
         author_age_days = (datetime.utcnow() - author_created_dt).days
@@ -1051,16 +2097,24 @@ def admin_dashboard():
     total_comments_count = query_db('SELECT COUNT(*) as count FROM comments', one=True)['count']
     total_comments_pages = (total_comments_count + PAGE_SIZE - 1) // PAGE_SIZE
 
+    comments_condition, comments_params, comments_order_by, comments_reverse = keyset_query_parts(
+        ['c.id'], decode_cursor(request.args.get('comments_cursor'), 1))
     comments_raw = query_db(f'''
-        SELECT c.id, c.content, c.created_at, u.username, u.created_at as user_created_at
+        SELECT c.id, c.content, c.created_at, u.username, u.created_at as user_created_at,
+               c.moderated_content, c.moderation_score, c.moderation_version
         FROM comments c JOIN users u ON c.user_id = u.id
-        ORDER BY c.id DESC -- Order by ID for consistent pagination before risk sort
+        {'WHERE ' + comments_condition if comments_condition else ''}
+        ORDER BY {comments_order_by} -- Order by ID for consistent pagination before risk sort
         LIMIT ? OFFSET ?
-    ''', (PAGE_SIZE, comments_offset))
+    ''', (*comments_params, PAGE_SIZE, 0 if comments_condition else comments_offset))
+    if comments_reverse:
+        comments_raw.reverse()
+    comments_prev_cursor, comments_next_cursor = page_cursors(comments_raw, lambda row: [row['id']])
     comments = []
     for comment in comments_raw:
         comment_dict = dict(comment)
-        _, score = moderate_content(comment_dict['content'])
+        _, score = stored_moderation(comment_dict['content'], comment_dict['moderated_content'],
+                                     comment_dict['moderation_score'], comment_dict['moderation_version'])
         author_created_dt = comment_dict['user_created_at']
         author_age_days = (datetime.utcnow() - author_created_dt).days
         if author_age_days < 7:
@@ -1090,18 +2144,31 @@ def admin_dashboard():
                            total_posts_pages=total_posts_pages,
                            posts_has_next=(posts_page < total_posts_pages),
                            posts_has_prev=(posts_page > 1),
+                           posts_prev_cursor=posts_prev_cursor,
+                           posts_next_cursor=posts_next_cursor,
 
                            # Pagination for Comments
                            comments_page=comments_page,
                            total_comments_pages=total_comments_pages,
                            comments_has_next=(comments_page < total_comments_pages),
                            comments_has_prev=(comments_page > 1),
+                           comments_prev_cursor=comments_prev_cursor,
+                           comments_next_cursor=comments_next_cursor,
 
                            current_tab=current_tab,
                            PAGE_SIZE=PAGE_SIZE)
 
 
 
+@app.route('/admin/cache')
+def admin_cache_stats():
+    """Hit and miss counters of the in-memory caches, as JSON."""
+    if session.get('username') != 'admin':
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify({'trending': trending_cache.stats(), 'recommendations': recommendation_cache.stats(),
+                    'suggestions': suggestion_cache.stats()})
+
+
 @app.route('/admin/delete/user/<int:user_id>', methods=['POST'])
 def admin_delete_user(user_id):
     if session.get('username') != 'admin':
@@ -1114,7 +2181,13 @@ def admin_delete_user(user_id):
     
     db = get_db()
     db.execute('DELETE FROM users WHERE id = ?', (user_id,))
+    db.execute('DELETE FROM user_risk WHERE user_id = ?', (user_id,))
+    db.execute('DELETE FROM user_interests WHERE user_id = ?', (user_id,))
+    forget_user_recommendations(db, user_id)
     db.commit()
+    # the topic pages only show posts of existing users
+    trending_cache.clear()
+    recommendation_cache.clear()
     flash(f'User {user_id} and all their content has been deleted.', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -1126,10 +2199,19 @@ def admin_delete_post(post_id):
         return redirect(url_for('feed'))
 
     db = get_db()
+    forget_post_in_user_risk(db, post_id)
+    forget_post_in_topic_engagement(db, post_id)
+    forget_post_in_user_interests(db, post_id)
     db.execute('DELETE FROM comments WHERE post_id = ?', (post_id,))
     db.execute('DELETE FROM reactions WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM post_topics WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM post_terms WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM recommendations WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM post_reactions WHERE post_id = ?', (post_id,))
     db.execute('DELETE FROM posts WHERE id = ?', (post_id,))
     db.commit()
+    trending_cache.clear()
+    recommendation_cache.clear()
     flash(f'Post {post_id} has been deleted.', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -1141,6 +2223,8 @@ def admin_delete_comment(comment_id):
         return redirect(url_for('feed'))
 
     db = get_db()
+    forget_comments_in_user_risk(db, 'id = ?', (comment_id,))
+    forget_comment_in_topic_engagement(db, comment_id)
     db.execute('DELETE FROM comments WHERE id = ?', (comment_id,))
     db.commit()
     flash(f'Comment {comment_id} has been deleted.', 'success')
@@ -1167,14 +2251,17 @@ def loop_color(user_id):
 # ----- Functions to be implemented are below
 
 # Task 3.1
-def recommend(user_id, filter_following):
+def recommend(user_id, filter_following, mode='overlap'):
     """
     Args:
         user_id: The ID of the current user.
         filter_following: Boolean, True if we only want to see recommendations from followed users.
+        mode: How posts are scored against the user's interests, 'overlap' (number of matching
+            keywords), 'tfidf' (see score_posts_by_keywords) or 'itemcf' (similarity to the posts
+            the user reacted to, see score_posts_by_neighbors).
 
     Returns:
-        A list of 5 recommended posts, in reverse-chronological order.
+        A list of 5 recommended posts, the best recommendation first.
 
     To test whether your recommendation algorithm works, let's pretend we like the DIY topic. Here are some users that often post DIY comment and a few example posts. Make sure your account did not engage with anything else. You should test your algorithm with these and see if your recommendation algorithm picks up on your interest in DIY and starts showing related content.
     
@@ -1186,13 +2273,29 @@ def recommend(user_id, filter_following):
     - http://www.configworks.com/mz/handout_recsys_sac2010.pdf
     - https://www.researchgate.net/publication/227268858_Recommender_Systems_Handbook
     """
-    import sqlite3
-    from collections import Counter
-    import re
-    
-    conn = sqlite3.connect(DATABASE)
-    # I use row_factory to access columns by name instead of index
-    conn.row_factory = sqlite3.Row
+    # The posts are picked and ranked by recommendation_stream(), here I only take the first 5.
+    ranked = itertools.islice(recommendation_stream(user_id, filter_following, mode), 5)
+    return posts_in_order(get_db(), [post_id for post_id, score in ranked])
+
+
+def posts_in_order(conn, post_ids):
+    """Returns the posts with the ids in post_ids in the same order, leaving out deleted posts."""
+    if not post_ids:
+        return []
+    placeholders = ','.join('?' * len(post_ids))
+    posts_by_id = {row['id']: row for row in conn.execute(f'SELECT * FROM posts WHERE id IN ({placeholders})', post_ids)}
+    return [posts_by_id[post_id] for post_id in post_ids if post_id in posts_by_id]
+
+
+def recommendation_stream(user_id, filter_following, mode='overlap'):
+    """
+    Ranks the posts to recommend to the user, see recommend(). Yields (post_id, score) pairs,
+    the best first: the posts that match the user's interests, then the most popular of the
+    other posts. The score is the one of the mode, or the number of reactions for the popular
+    posts. The ranking is computed as far as it is read, and every query goes through get_db(),
+    so the stream can be read a page at a time over several requests.
+    """
+    conn = get_db()
     cursor = conn.cursor()
     
     # In this section we should check and if the filter_following is set to True, we should only 
@@ -1201,8 +2304,7 @@ def recommend(user_id, filter_following):
     following_user_ids = []  
     if filter_following:
         # Get list of users that this user follows
-        cursor.execute("SELECT followee_id FROM follows WHERE follower_id = ? ", (user_id,))
-        following_user_ids = [row['followee_id'] for row in cursor.fetchall()]
+        following_user_ids = followed_ids(user_id)
         
         # If user doesn't follow anyone, I recommend posts from all users
         if not following_user_ids:
@@ -1211,143 +2313,739 @@ def recommend(user_id, filter_following):
     #First, I should find all posts this user has liked/reacted to because these posts show 
     # what content the user is interested in. It is simple, I get the unique posts a user has 
     #reacted to. I say unique because a user may have multiple reactions to a single post.
-    cursor.execute("SELECT DISTINCT p.id, p.content FROM posts p JOIN reactions r ON p.id = r.post_id WHERE r.user_id = ?", (user_id,))
+    cursor.execute("SELECT DISTINCT p.id FROM posts p JOIN reactions r ON p.id = r.post_id WHERE r.user_id = ?", (user_id,))
     reacted_posts = cursor.fetchall()
     
-    # In the following section, I loop through each of the post that the user has reacted to
-    # and convert the content of those posts to lowercase and remove the stop words such as 
-    # "the" or "but" or "an" and also remove the short words that have 1 or 2 character because
-    # they are less likely to have any meaningful significance.
-    # finally, after this processing, we get a list of more meaningful words like the following:
+    # The words of the posts that the user has reacted to are already counted in their interest
+    # profile (see user_interests): the content of those posts converted to lowercase, without the
+    # stop words such as "the" or "but" or "an" and without 1 character words, because they are
+    # less likely to have any meaningful significance. For example:
     #       Input: "I love programming in Python"
     #       After processing: ["love", "programming", "python"]
-
-    all_words = []
-    for post in reacted_posts:
-        content = post['content'] 
-        # If there are posts with no content, I  skip them!   
-        if not content:
-            continue
-        
-        # This extracts the words and removes punctuation and numbers
-        words = re.findall(r'\b[a-z]+\b', content.lower())
-        
-        # Now I remove stop words and short words. Stop words are defined in STOP_WORDS
-        # set at the top of this file
-        meaningful_words = [
-            word for word in words 
-            if word not in STOP_WORDS and len(word) >= 2
-        ]
-        
-        # we now add these keywords to our collection
-        all_words.extend(meaningful_words)
+    # Here I get top 15 most common words to create a diverse recommendation. Words with the same
+    # count are taken in the order the user first came across them.
+    keyword_weights = user_interest_keywords(conn, user_id, top_n=15)
     
     # Here I want to find the user's main interests based on the keyword frequency in the content
     # of the posts they reacted to. If the user has no reactions, we should find something to show,
-    # so decided to show top 5 most popular posts. of course, i make sure the user's own posts are not
-    # shown to them even if they are among the top 5 posts. here is an example: 
+    # so decided to show the most popular posts. of course, i make sure the user's own posts are not
+    # shown to them even if they are among the top posts. here is an example: 
     #       Extracted keywords:["python", "python", "python", "coding", "data", "data"]
     #       Frequency: python(3 times), data(2times), coding(1 times)
     #       Top keywords: ["python", "data", "coding"]
     #       Interpretation: User is interested in Python programming and data  
-    if not all_words:
-        if filter_following and following_user_ids:
-            # Only recommend from users the current user follows
-            placeholders = ','.join('?' * len(following_user_ids))
-            cursor.execute(f"SELECT p.*, COUNT(r.id) as reaction_count FROM posts p LEFT JOIN reactions r ON p.id = r.post_id WHERE p.user_id != ? AND p.user_id IN ({placeholders}) GROUP BY p.id ORDER BY reaction_count DESC LIMIT 5", [user_id] + following_user_ids)
-        else:
-            # Recommend popular posts from all users
-            cursor.execute("SELECT p.*, COUNT(r.id) as reaction_count FROM posts p LEFT JOIN reactions r ON p.id = r.post_id WHERE p.user_id != ? GROUP BY p.id ORDER BY reaction_count DESC LIMIT 5", (user_id,))
-        results = cursor.fetchall()
-        conn.close()
-        # Return full post objects
-        return results
-    
-    # Counter creates a dictionary: {"python": 3, "data": 2, "coding": 1}
-    word_counter = Counter(all_words)
-    
-    # Here I get top 15 most common words to create a diverse recommendation
-    top_keywords = [word for word, count in word_counter.most_common(15)]
+    if not keyword_weights:
+        # Only recommend from users the current user follows, if that filter is on
+        yield from popular_posts(user_id, following_user_ids if filter_following else None)
+        return
     
     # Now, i find the posts that i can recommend. They should not be made by the user and 
     # they should be new to user. Of course, if the filter_following is set to True, we should only 
     # recommend posts from those this user is following and this will become another restricting factor
     # in recommendation process.
-    if filter_following and following_user_ids:
-        # Only get posts from users we follow
-        placeholders = ','.join('?' * len(following_user_ids))
-        cursor.execute(f"SELECT p.id, p.content FROM posts p WHERE p.id NOT IN (SELECT post_id FROM reactions WHERE user_id = ?) AND p.user_id != ? AND p.user_id IN ({placeholders})", [user_id, user_id] + following_user_ids)
-    else:
-        # Get posts from all users
-        cursor.execute("SELECT p.id, p.content FROM posts p WHERE p.id NOT IN (SELECT post_id FROM reactions WHERE user_id = ?) AND p.user_id != ?", (user_id, user_id))
-    
-    candidate_posts = cursor.fetchall()
-    
     # in this section, i create a scoring algorithm to find the best posts to recommend to the user. 
-    # i first extract the words from the candidate posts and check how many of the interest
-    # keywords are in those posts. For each matching, i give +1 score and the higher the accumulative 
-    # score is, the more interesting that post will probably be to the user. 
-    post_scores = []
-    for post in candidate_posts:
-        content = post['content']
-        # I skip posts with no content
-        if not content:
-            continue
-        
-        # This line extracts words from this candidate post
-        post_words = re.findall(r'\b[a-z]+\b', content.lower())
-        
-        # calculating the relevance and giving a score:
-        score = 0
-        for keyword in top_keywords:
-            if keyword in post_words:
-                score += 1
-        
-        # Only include posts with at least one keyword match
-        # Posts with score 0 are not relevant to user's interests
-        if score > 0:
-            post_scores.append((post['id'], score))
-    
-    # Here I sort scores which are the second element of the tuple using a lambda function and 
-    # sorting using the score which is the index 1. the reverse makes the highest score appear first.
-    post_scores.sort(key=lambda x: x[1], reverse=True)
-    
-    # Now, we can get top 5 recommendations as post IDs
-    recommended_post_ids = [post_id for post_id, score in post_scores[:5]]
-    
-    # If we have fewer than 5 recommendations, fill with popular posts to ensure we always
-    # return 5 recommendations when possible
-    if len(recommended_post_ids) < 5:
-        # Collect IDs of posts to exclude (already recommended or already reacted to)
-        excluded_ids = set(recommended_post_ids)
-        excluded_ids.update([post['id'] for post in reacted_posts])
-        
-        placeholders = ','.join('?' * len(excluded_ids)) if excluded_ids else '0'
-        
-        if filter_following and following_user_ids:
-            # Fill with popular posts from users we follow
-            following_placeholders = ','.join('?' * len(following_user_ids))
-            cursor.execute(f"SELECT p.id, COUNT(r.id) as reaction_count FROM posts p LEFT JOIN reactions r ON p.id = r.post_id WHERE p.id NOT IN ({placeholders}) AND p.user_id != ? AND p.user_id IN ({following_placeholders}) GROUP BY p.id ORDER BY reaction_count DESC LIMIT ? ", list(excluded_ids) + [user_id] + following_user_ids + [5 - len(recommended_post_ids)])
-        else:
-            # Fill with popular posts from all users
-            cursor.execute(f"SELECT p.id, COUNT(r.id) as reaction_count FROM posts p LEFT JOIN reactions r ON p.id = r.post_id  WHERE p.id NOT IN ({placeholders}) AND p.user_id != ? GROUP BY p.id ORDER BY reaction_count DESC LIMIT ? ", list(excluded_ids) + [user_id, 5 - len(recommended_post_ids)])
-        additional_posts = cursor.fetchall()
-        recommended_post_ids.extend([row['id'] for row in additional_posts])
-    
-    # Now fetch full post objects for the recommended post IDs
-    if recommended_post_ids:
-        placeholders = ','.join('?' * len(recommended_post_ids))
-        cursor.execute(f"""
-            SELECT * FROM posts 
-            WHERE id IN ({placeholders})
-        """, recommended_post_ids)
-        final_posts = cursor.fetchall()
+    # i check how many of the interest keywords are in those posts. For each matching, i give +1 score
+    # and the higher the accumulative score is, the more interesting that post will probably be to the user.
+    # The words of every post are already in the post_terms index, so only the posts that contain one
+    # of the keywords are looked at (see score_posts_by_keywords, which also has the 'tfidf' mode).
+    # Posts with score 0 are not relevant to user's interests and are left out, and the highest score
+    # comes first.
+    # The 'itemcf' mode scores posts by the reactions of other users instead of the keywords.
+    if mode == 'itemcf':
+        post_scores = score_posts_by_neighbors(conn, user_id,
+                                               following_user_ids if filter_following else None, limit=None)
     else:
-        final_posts = []
+        post_scores = score_posts_by_keywords(conn, user_id, keyword_weights,
+                                              following_user_ids if filter_following else None,
+                                              mode=mode, limit=None)
+    yield from post_scores
     
-    conn.close()
-    # Return full post objects (up to 5)
-    return final_posts[:5]
+    # After the posts that match, I continue with the popular posts so there is always something
+    # more to show, leaving out the ones already recommended or already reacted to.
+    excluded_ids = {post_id for post_id, score in post_scores}
+    excluded_ids.update([post['id'] for post in reacted_posts])
+    for post_id, reaction_count in popular_posts(user_id, following_user_ids if filter_following else None):
+        if post_id not in excluded_ids:
+            yield post_id, reaction_count
+
+
+def popular_posts(user_id, following_user_ids=None, chunk_size=50):
+    """
+    Yields (post_id, number of reactions) for the posts by other users than user_id, and only
+    by following_user_ids when it is given, the most reacted to first and the lowest post id
+    first among equals. They are read chunk_size at a time, continuing after the last one.
+    """
+    conditions = ['p.user_id != ?']
+    params = [user_id]
+    if following_user_ids:
+        conditions.append(f"p.user_id IN ({','.join('?' * len(following_user_ids))})")
+        params.extend(following_user_ids)
+    # the posts with reactions come from the post_reactions index, already in this order, so a
+    # chunk only reads its own rows instead of counting the reactions of every post again
+    last = None
+    while True:
+        after_last = 'AND pr.reaction_count <= ? AND (pr.reaction_count < ? OR pr.post_id > ?)' if last else ''
+        rows = get_db().execute(f'''
+            SELECT pr.post_id, pr.reaction_count
+            FROM post_reactions pr JOIN posts p ON p.id = pr.post_id
+            WHERE {' AND '.join(conditions)} {after_last}
+            ORDER BY pr.reaction_count DESC, pr.post_id ASC
+            LIMIT ?
+        ''', params + ([last[1], last[1], last[0]] if last else []) + [chunk_size]).fetchall()
+        yield from (tuple(row) for row in rows)
+        if len(rows) < chunk_size:
+            break
+        last = rows[-1]
+    # then the posts nobody reacted to, which have no post_reactions row, by id
+    last_id = None
+    while True:
+        after_last = 'AND p.id > ?' if last_id is not None else ''
+        rows = get_db().execute(f'''
+            SELECT p.id, 0 FROM posts p
+            WHERE {' AND '.join(conditions)} {after_last}
+              AND NOT EXISTS (SELECT 1 FROM post_reactions pr WHERE pr.post_id = p.id)
+            ORDER BY p.id ASC
+            LIMIT ?
+        ''', params + ([last_id] if last_id is not None else []) + [chunk_size]).fetchall()
+        yield from (tuple(row) for row in rows)
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+
+def rebuild_post_reactions(conn):
+    """Counts the reactions of every post again into post_reactions. The caller commits."""
+    conn.execute('DELETE FROM post_reactions')
+    conn.execute('''
+        INSERT INTO post_reactions (post_id, reaction_count)
+        SELECT r.post_id, COUNT(*) FROM reactions r JOIN posts p ON p.id = r.post_id GROUP BY r.post_id
+    ''')
+
+
+def adjust_post_reactions(conn, post_id, reactions):
+    # adds reactions to the post's count in post_reactions. A post only has a row there while
+    # it has reactions, so the ones without any can be listed after them.
+    conn.execute('''
+        INSERT INTO post_reactions (post_id, reaction_count)
+        SELECT id, ? FROM posts WHERE id = ?
+        ON CONFLICT (post_id) DO UPDATE SET reaction_count = reaction_count + excluded.reaction_count
+    ''', (reactions, post_id))
+    conn.execute('DELETE FROM post_reactions WHERE post_id = ? AND reaction_count <= 0', (post_id,))
+
+
+# Post term index ================================================================
+# recommend() scores posts by the interest keywords they contain. Instead of tokenizing every
+# candidate post on every call, the words of every post are kept in the post_terms table, one row
+# per (term, post) with the number of times the term occurs in the post (tf). add_post and the
+# delete routes keep it up to date. Scoring is then a lookup of the keyword's postings.
+# POST_TERMS_VERSION names the tokenization; changing how posts are tokenized must bump it, so
+# init_db() indexes every post again.
+
+POST_TERMS_VERSION = '2'
+RECOMMEND_MODES = ('overlap', 'tfidf', 'itemcf')
+
+
+def post_term_counts(content):
+    """
+    Returns {word: (tf, position of its first occurrence)} for the words in content,
+    tokenized the way recommend() does, in the order the words first occur.
+    """
+    terms = {}
+    for position, term in enumerate(words(content)):
+        tf, first_pos = terms.get(term, (0, position))
+        terms[term] = (tf + 1, first_pos)
+    return terms
+
+
+def store_post_terms(conn, post_id, content):
+    conn.executemany('INSERT OR REPLACE INTO post_terms (term, post_id, tf, first_pos) VALUES (?, ?, ?, ?)',
+                     [(term, post_id, tf, first_pos) for term, (tf, first_pos) in post_term_counts(content).items()])
+
+
+def rebuild_post_terms(conn):
+    """Indexes the words of every post again. The caller commits."""
+    conn.execute('DELETE FROM post_terms')
+    for row in conn.execute('SELECT id, content FROM posts').fetchall():
+        store_post_terms(conn, row['id'], row['content'])
+    set_meta(conn, 'post_terms_version', POST_TERMS_VERSION)
+
+
+@app.cli.command('rebuild-post-terms')
+def rebuild_post_terms_command():
+    """Rebuilds the post_terms index used by recommend()."""
+    conn = get_db()
+    rebuild_post_terms(conn)
+    conn.commit()
+    count = conn.execute('SELECT COUNT(*) FROM post_terms').fetchone()[0]
+    click.echo(f'post_terms rebuilt with {count} (term, post) pairs')
+
+
+def score_posts_by_keywords(conn, user_id, keyword_weights, following_user_ids=None, mode='overlap', limit=5):
+    """
+    Scores the posts the user could be recommended against their interest keywords, using
+    the post_terms index. Candidates are posts by other users that the user hasn't reacted
+    to, and only posts by following_user_ids when it is given.
+
+    keyword_weights maps each interest keyword to how often it occurs in the posts the user
+    reacted to. In 'overlap' mode the score of a post is the number of keywords it contains
+    and the weights are ignored. In 'tfidf' mode it is the sum over the keywords it contains
+    of weight * (1 + log(tf)) * idf, so rare words and the user's strongest interests count
+    more.
+
+    Returns up to limit (post_id, score) pairs, or all of them when limit is None, highest
+    score first and lowest post id first among equal scores, leaving out posts that match
+    no keyword.
+    """
+    if not keyword_weights:
+        return []
+    keywords = list(keyword_weights)
+    conditions = [f"pt.term IN ({','.join('?' * len(keywords))})",
+                  'p.user_id != ?',
+                  'p.id NOT IN (SELECT post_id FROM reactions WHERE user_id = ?)']
+    params = keywords + [user_id, user_id]
+    if following_user_ids:
+        conditions.append(f"p.user_id IN ({','.join('?' * len(following_user_ids))})")
+        params.extend(following_user_ids)
+    where_clause = ' AND '.join(conditions)
+
+    if mode == 'overlap':
+        return [tuple(row) for row in conn.execute(f'''
+            SELECT pt.post_id, COUNT(*) AS score
+            FROM post_terms pt JOIN posts p ON p.id = pt.post_id
+            WHERE {where_clause}
+            GROUP BY pt.post_id
+            ORDER BY score DESC, pt.post_id ASC
+            LIMIT ?
+        ''', params + [limit if limit is not None else -1])]
+    if mode != 'tfidf':
+        raise ValueError(f'unknown recommendation mode {mode!r}, expected one of {RECOMMEND_MODES}')
+
+    document_count = conn.execute('SELECT COUNT(DISTINCT post_id) FROM post_terms').fetchone()[0]
+    idf = {row['term']: math.log((1 + document_count) / (1 + row['df'])) + 1
+           for row in conn.execute(f"SELECT term, COUNT(*) AS df FROM post_terms WHERE term IN ({','.join('?' * len(keywords))}) GROUP BY term",
+                                   keywords)}
+    scores = defaultdict(float)
+    for row in conn.execute(f'SELECT pt.post_id, pt.term, pt.tf FROM post_terms pt JOIN posts p ON p.id = pt.post_id WHERE {where_clause}',
+                            params):
+        scores[row['post_id']] += keyword_weights[row['term']] * (1 + math.log(row['tf'])) * idf[row['term']]
+    ranking_key = lambda item: (-item[1], item[0])
+    if limit is None:
+        return sorted(scores.items(), key=ranking_key)
+    return heapq.nsmallest(limit, scores.items(), key=ranking_key)
+
+
+# User interest profiles ==========================================================
+# The interest keywords of a user come from the words of the posts they reacted to. Instead of
+# tokenizing all of those posts on every recommend() call, every user's word counts are kept in
+# the user_interests table. add_reaction and unreact add or subtract the words of the post, and
+# deleting a post subtracts it from everyone who reacted to it.
+# The words are the post's terms from post_terms minus RECOMMENDER_STOP_WORDS and 1-letter words, so the
+# profiles are rebuilt by init_db() when the stop words or the tokenization change.
+# Words with the same count are ordered by where the user first came across them: in the post of
+# their earliest reaction, and then by position in that post. That is the order recommend() used to
+# see them in when it read the reacted posts in the order of the reactions.
+
+def user_interests_version():
+    interests_definition = json.dumps([POST_TERMS_VERSION, sorted(RECOMMENDER_STOP_WORDS)])
+    return hashlib.sha256(interests_definition.encode('utf-8')).hexdigest()[:12]
+
+
+def is_interest_term(term):
+    return term not in RECOMMENDER_STOP_WORDS and len(term) >= 2
+
+
+def add_user_interests(conn, user_id, post_id, reaction_id):
+    """Adds the words of a post the user just reacted to to their interest profile."""
+    conn.executemany('''
+        INSERT INTO user_interests (user_id, term, count, first_reaction_id, first_pos) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, term) DO UPDATE SET
+            count = count + excluded.count,
+            first_pos = CASE WHEN excluded.first_reaction_id < first_reaction_id THEN excluded.first_pos ELSE first_pos END,
+            first_reaction_id = MIN(first_reaction_id, excluded.first_reaction_id)
+    ''', [(user_id, row['term'], row['tf'], reaction_id, row['first_pos'])
+          for row in conn.execute('SELECT term, tf, first_pos FROM post_terms WHERE post_id = ?', (post_id,))
+          if is_interest_term(row['term'])])
+
+
+def remove_user_interests(conn, user_id, post_id, reaction_id):
+    """
+    Subtracts the words of a post from the user's interest profile, when their reaction
+    reaction_id to it is removed (or is about to be).
+    """
+    conn.executemany('UPDATE user_interests SET count = count - ? WHERE user_id = ? AND term = ?',
+                     [(row['tf'], user_id, row['term'])
+                      for row in conn.execute('SELECT term, tf FROM post_terms WHERE post_id = ?', (post_id,))
+                      if is_interest_term(row['term'])])
+    conn.execute('DELETE FROM user_interests WHERE user_id = ? AND count <= 0', (user_id,))
+    # the words the user first came across in this post were also in one of their other reacted posts
+    conn.execute('''
+        UPDATE user_interests SET (first_reaction_id, first_pos) = (
+            SELECT r.id, pt.first_pos
+            FROM reactions r JOIN post_terms pt ON pt.post_id = r.post_id AND pt.term = user_interests.term
+            WHERE r.user_id = user_interests.user_id AND r.id != ?
+            ORDER BY r.id LIMIT 1
+        )
+        WHERE user_id = ? AND first_reaction_id = ?
+    ''', (reaction_id, user_id, reaction_id))
+
+
+def forget_post_in_user_interests(conn, post_id):
+    """Takes a post that is about to be deleted out of the profiles of the users who reacted to it."""
+    for row in conn.execute('SELECT id, user_id FROM reactions WHERE post_id = ?', (post_id,)).fetchall():
+        remove_user_interests(conn, row['user_id'], post_id, row['id'])
+
+
+def rebuild_user_interests(conn):
+    """Recomputes every interest profile from the reactions and post_terms. The caller commits."""
+    conn.execute('DELETE FROM user_interests')
+    # first_pos is taken from the same row as MIN(r.id), the earliest reaction with the term
+    rows = conn.execute('''
+        SELECT r.user_id, pt.term, SUM(pt.tf) AS count, MIN(r.id) AS first_reaction_id, pt.first_pos
+        FROM reactions r
+        JOIN posts p ON p.id = r.post_id
+        JOIN post_terms pt ON pt.post_id = p.id
+        GROUP BY r.user_id, pt.term
+    ''').fetchall()
+    conn.executemany('INSERT INTO user_interests (user_id, term, count, first_reaction_id, first_pos) VALUES (?, ?, ?, ?, ?)',
+                     [tuple(row) for row in rows if is_interest_term(row['term'])])
+    set_meta(conn, 'user_interests_version', user_interests_version())
+
+
+def user_interest_keywords(conn, user_id, top_n=15):
+    """Returns the user's top_n most frequent interest words as {word: count}, most frequent first."""
+    return {row['term']: row['count'] for row in conn.execute('''
+        SELECT term, count FROM user_interests WHERE user_id = ?
+        ORDER BY count DESC, first_reaction_id ASC, first_pos ASC
+        LIMIT ?
+    ''', (user_id, top_n))}
+
+
+def user_interest_mismatches(conn):
+    """
+    Compares the stored profiles with profiles computed from scratch the way recommend()
+    used to, straight from the text of the reacted posts. Returns {user_id: (stored, expected)},
+    with {word: (count, first_reaction_id, first_pos)} profiles, for the users whose profiles differ.
+    """
+    expected = defaultdict(dict)
+    for row in conn.execute('''
+        SELECT r.id, r.user_id, p.content
+        FROM reactions r JOIN posts p ON p.id = r.post_id
+        ORDER BY r.id
+    '''):
+        profile = expected[row['user_id']]
+        for position, term in enumerate(words(row['content'])):
+            if is_interest_term(term):
+                count, first_reaction_id, first_pos = profile.get(term, (0, row['id'], position))
+                profile[term] = (count + 1, first_reaction_id, first_pos)
+    stored = defaultdict(dict)
+    for row in conn.execute('SELECT user_id, term, count, first_reaction_id, first_pos FROM user_interests'):
+        stored[row['user_id']][row['term']] = (row['count'], row['first_reaction_id'], row['first_pos'])
+    return {user_id: (stored[user_id], expected[user_id])
+            for user_id in set(stored) | set(expected)
+            if stored[user_id] != expected[user_id]}
+
+
+@app.cli.command('rebuild-user-interests')
+def rebuild_user_interests_command():
+    """Recomputes the interest profile of every user."""
+    conn = get_db()
+    rebuild_user_interests(conn)
+    conn.commit()
+    users = conn.execute('SELECT COUNT(DISTINCT user_id) FROM user_interests').fetchone()[0]
+    click.echo(f'user_interests rebuilt for {users} users')
+
+
+@app.cli.command('check-user-interests')
+def check_user_interests_command():
+    """Checks the stored interest profiles against the reactions and exits with 1 if any differ."""
+    mismatches = user_interest_mismatches(get_db())
+    for user_id, (stored, expected) in sorted(mismatches.items()):
+        terms = sorted(term for term in set(stored) | set(expected) if stored.get(term) != expected.get(term))
+        diff = ', '.join(f'{term}: {stored.get(term)} != {expected.get(term)}' for term in terms[:5])
+        click.echo(f'user {user_id}: {diff}')
+    if mismatches:
+        click.echo(f'{len(mismatches)} user profiles differ, run `flask rebuild-user-interests` to fix them')
+        raise SystemExit(1)
+    click.echo('all user interest profiles are consistent')
+
+
+# Item-item neighbours =============================================================
+# The 'itemcf' mode of recommend() is collaborative filtering instead of keyword matching: a post
+# is recommended when the people who reacted to the user's posts also reacted to it. Every post is
+# a column of the users x posts reactions matrix, and the similarity of two posts is the cosine of
+# their columns: the number of users who reacted to both, divided by sqrt(reactors of the one *
+# reactors of the other). The top POST_NEIGHBORS_K most similar posts of every post are kept in
+# post_neighbors by a batch job (`flask rebuild-post-neighbors`, run it periodically e.g. from cron),
+# so recommend() only sums the similarities of the neighbours of the posts the user reacted to.
+# Reactions made since the last run are not in the neighbours yet, and deleted posts are left out
+# by the join with posts until the next run.
+# With NumPy and SciPy installed the matrix products are done on a sparse CSR matrix, without them
+# the same numbers are computed in plain Python, which is fine for a database of this size.
+
+POST_NEIGHBORS_K = 20
+
+
+def post_neighbors_sparse(pairs, k):
+    """Returns (post_id, neighbor_id, similarity) rows for the (user_id, post_id) reaction pairs with SciPy."""
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    users, user_index = np.unique(pairs[:, 0], return_inverse=True)
+    posts, post_index = np.unique(pairs[:, 1], return_inverse=True)
+    reactions = sparse.csr_matrix((np.ones(len(pairs), dtype=np.int64), (user_index, post_index)),
+                                  shape=(len(users), len(posts)))
+    reactors = np.asarray(reactions.sum(axis=0)).ravel()
+    # posts x posts, the number of users who reacted to both
+    co_reactions = (reactions.T @ reactions).tocoo()
+    not_self = co_reactions.row != co_reactions.col
+    rows, cols, counts = co_reactions.row[not_self], co_reactions.col[not_self], co_reactions.data[not_self]
+    similarity = counts / np.sqrt(reactors[rows] * reactors[cols])
+    # sorted by post, most similar first and the lowest neighbour id among equals, then the
+    # first k of every post are kept
+    order = np.lexsort((cols, -similarity, rows))
+    rows, cols, similarity = rows[order], cols[order], similarity[order]
+    keep = np.arange(len(rows)) - np.searchsorted(rows, rows) < k
+    return zip(posts[rows[keep]].tolist(), posts[cols[keep]].tolist(), similarity[keep].tolist())
+
+
+def post_neighbors_python(pairs, k):
+    """The same as post_neighbors_sparse, for when NumPy or SciPy is not installed."""
+    posts_by_user = defaultdict(list)
+    for user_id, post_id in pairs:
+        posts_by_user[user_id].append(post_id)
+    reactors = collections.Counter(post_id for user_id, post_id in pairs)
+    co_reactions = defaultdict(collections.Counter)
+    for posts in posts_by_user.values():
+        for post_id in posts:
+            counts = co_reactions[post_id]
+            for other_id in posts:
+                if other_id != post_id:
+                    counts[other_id] += 1
+    for post_id, counts in co_reactions.items():
+        similarities = [(count / math.sqrt(reactors[post_id] * reactors[other_id]), other_id)
+                        for other_id, count in counts.items()]
+        for similarity, other_id in heapq.nsmallest(k, similarities, key=lambda item: (-item[0], item[1])):
+            yield post_id, other_id, similarity
+
+
+def rebuild_post_neighbors(conn, k=POST_NEIGHBORS_K):
+    """Recomputes the top k neighbours of every post from the reactions. The caller commits."""
+    cursor = conn.cursor()
+    cursor.row_factory = None  # plain tuples for the matrix
+    pairs = cursor.execute('SELECT r.user_id, r.post_id FROM reactions r JOIN posts p ON p.id = r.post_id').fetchall()
+    compute = post_neighbors_sparse if sparse is not None else post_neighbors_python
+    conn.execute('DELETE FROM post_neighbors')
+    conn.executemany('INSERT INTO post_neighbors (post_id, neighbor_id, similarity) VALUES (?, ?, ?)',
+                     compute(pairs, k))
+    set_meta(conn, 'post_neighbors_built_at', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    return len(pairs)
+
+
+def score_posts_by_neighbors(conn, user_id, following_user_ids=None, limit=5):
+    """
+    Scores the posts the user could be recommended by their similarity to the posts the user
+    reacted to, the sum of their post_neighbors similarities. Candidates are the same as in
+    score_posts_by_keywords. Returns up to limit (post_id, score) pairs (all of them when limit
+    is None), highest score first and lowest post id first among equal scores.
+    """
+    conditions = ['r.user_id = ?',
+                  'p.user_id != ?',
+                  'n.neighbor_id NOT IN (SELECT post_id FROM reactions WHERE user_id = ?)']
+    params = [user_id, user_id, user_id]
+    if following_user_ids:
+        conditions.append(f"p.user_id IN ({','.join('?' * len(following_user_ids))})")
+        params.extend(following_user_ids)
+    return [tuple(row) for row in conn.execute(f'''
+        SELECT n.neighbor_id AS post_id, SUM(n.similarity) AS score
+        FROM reactions r
+        JOIN post_neighbors n ON n.post_id = r.post_id
+        JOIN posts p ON p.id = n.neighbor_id
+        WHERE {' AND '.join(conditions)}
+        GROUP BY n.neighbor_id
+        ORDER BY score DESC, n.neighbor_id ASC
+        LIMIT ?
+    ''', params + [limit if limit is not None else -1])]
+
+
+@app.cli.command('rebuild-post-neighbors')
+@click.option('--k', default=POST_NEIGHBORS_K, show_default=True, help='Neighbours kept per post.')
+def rebuild_post_neighbors_command(k):
+    """Recomputes the item-item neighbours used by the 'itemcf' recommendations."""
+    conn = get_db()
+    started = time.perf_counter()
+    reactions = rebuild_post_neighbors(conn, k)
+    conn.commit()
+    count = conn.execute('SELECT COUNT(*) FROM post_neighbors').fetchone()[0]
+    click.echo(f'post_neighbors rebuilt from {reactions} reactions with {count} neighbours '
+               f'in {time.perf_counter() - started:.2f}s ({"scipy" if sparse is not None else "plain python"})')
+
+
+# Precomputed recommendations =====================================================
+# The recommended feed is the slowest one to compute, so `flask precompute-recommendations`
+# computes the top RECOMMENDATIONS_STORED recommendations of every user for every mode ahead of
+# time, in a pool of worker processes, and stores them in the recommendations table. The feed
+# shows the stored ones and only ranks posts itself past them, or when they are stale: older than
+# RECOMMENDATIONS_MAX_AGE seconds or missing (new users, or the user reacted since, which deletes
+# them). The "following" feed is always computed live, it depends on who the user follows.
+# A reaction made while the job is working on the user's batch can be overwritten by the job's
+# results, those are then shown until the next run.
+
+RECOMMENDATION_BATCH_SIZE = 50
+RECOMMENDATIONS_STORED = 50
+app.config.setdefault('RECOMMENDATIONS_MAX_AGE', 24 * 60 * 60)
+
+
+def start_recommendation_worker():
+    """Runs first in every worker process, so that it opens its own connection (see get_db)."""
+    get_db()
+
+
+def recommendation_rows(job):
+    """
+    Computes the recommendations table rows of a batch of users for one mode. It runs in the
+    worker processes, with the worker's own connection.
+    """
+    user_ids, mode, computed_at = job
+    rows = []
+    for user_id in user_ids:
+        ranked = itertools.islice(recommendation_stream(user_id, False, mode), RECOMMENDATIONS_STORED)
+        for rank, (post_id, score) in enumerate(ranked, start=1):
+            rows.append((user_id, mode, rank, post_id, score, computed_at))
+    return user_ids, mode, rows
+
+
+def precompute_recommendations(conn, modes=RECOMMEND_MODES, workers=None, batch_size=RECOMMENDATION_BATCH_SIZE):
+    """
+    Recomputes the stored recommendations of every user for the given modes, with workers
+    processes (one per CPU by default, 1 computes them in this process). The results of every
+    batch are committed as soon as they are written. Returns the number of rows written.
+    """
+    user_ids = [row['id'] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+    computed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    jobs = [(user_ids[start:start + batch_size], mode, computed_at)
+            for mode in modes for start in range(0, len(user_ids), batch_size)]
+    written = 0
+    with contextlib.ExitStack() as stack:
+        if workers == 1:
+            results = map(recommendation_rows, jobs)
+        else:
+            pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=start_recommendation_worker)
+            results = stack.enter_context(pool).map(recommendation_rows, jobs)
+        for batch_user_ids, mode, rows in results:
+            conn.execute(f"DELETE FROM recommendations WHERE mode = ? AND user_id IN ({','.join('?' * len(batch_user_ids))})",
+                         [mode] + batch_user_ids)
+            conn.executemany('INSERT INTO recommendations (user_id, mode, rank, post_id, score, computed_at) VALUES (?, ?, ?, ?, ?, ?)',
+                             rows)
+            conn.commit()
+            written += len(rows)
+    return written
+
+
+def stored_recommendations(conn, user_id, mode):
+    """
+    Returns the user's stored (post_id, score) recommendations for the mode, best first, or None
+    if they are stale or one of the posts has been deleted since they were computed.
+    """
+    rows = conn.execute('''
+        SELECT r.post_id, r.score, r.computed_at, p.id IS NULL AS deleted
+        FROM recommendations r LEFT JOIN posts p ON p.id = r.post_id
+        WHERE r.user_id = ? AND r.mode = ?
+        ORDER BY r.rank
+    ''', (user_id, mode)).fetchall()
+    max_age = timedelta(seconds=app.config['RECOMMENDATIONS_MAX_AGE'])
+    if not rows or min(row['computed_at'] for row in rows) < datetime.now() - max_age:
+        return None
+    # the delete routes remove the rows of a deleted post, this is for posts deleted some other way
+    if any(row['deleted'] for row in rows):
+        return None
+    return [(row['post_id'], row['score']) for row in rows]
+
+
+def forget_user_recommendations(conn, user_id):
+    """
+    Deletes the stored recommendations of a user whose reactions changed. The caller drops the
+    cached ones with forget_cached_recommendations() after committing, otherwise a request
+    running in between could cache a ranking of the data from before the commit again.
+    """
+    conn.execute('DELETE FROM recommendations WHERE user_id = ?', (user_id,))
+
+
+@app.cli.command('precompute-recommendations')
+@click.option('--workers', type=int, default=None, help='Worker processes, one per CPU by default.')
+@click.option('--mode', 'modes', multiple=True, type=click.Choice(RECOMMEND_MODES),
+              help='Recommendation mode to compute, all of them by default. Can be repeated.')
+@click.option('--batch-size', default=RECOMMENDATION_BATCH_SIZE, show_default=True, help='Users per worker task.')
+def precompute_recommendations_command(workers, modes, batch_size):
+    """Computes the recommendations of every user and stores them for the recommended feed."""
+    started = time.perf_counter()
+    written = precompute_recommendations(get_db(), modes or RECOMMEND_MODES, workers, batch_size)
+    click.echo(f'stored {written} recommendations in {time.perf_counter() - started:.2f}s')
+
+
+# Recommended feed pages ==========================================================
+# The recommended feed is paged like the others. The ranking of a user is kept in
+# recommendation_cache between requests, so turning a page only reads further down the ranking
+# instead of ranking everything again. It starts with the stored recommendations when they are
+# fresh, and continues with recommendation_stream(). Reacting or (un)following drops the user's
+# cached rankings, and the whole cache expires after RECOMMENDATION_CACHE_TTL seconds. At most
+# RECOMMENDATION_CACHE_SIZE rankings are kept (one per user, feed filter and mode), a ranking can
+# hold every post, so the oldest ones are dropped first past that.
+
+app.config.setdefault('RECOMMENDATION_CACHE_TTL', 300)
+app.config.setdefault('RECOMMENDATION_CACHE_SIZE', 500)
+
+
+class RankedRecommendations:
+    """
+    The recommendations of a user, best first, read from a (post_id, score) stream as far
+    as the pages asked for need. Posts are never repeated, ranked starts it off.
+    """
+
+    def __init__(self, stream, ranked=()):
+        self._stream = stream
+        self._ranked = list(ranked)
+        self._seen = {post_id for post_id, score in self._ranked}
+        self._lock = threading.Lock()
+
+    def page(self, offset, count):
+        """Returns up to count (post_id, score) pairs, starting at position offset."""
+        with self._lock:
+            while len(self._ranked) < offset + count and self._stream is not None:
+                item = next(self._stream, None)
+                if item is None:
+                    self._stream = None
+                elif item[0] not in self._seen:
+                    self._seen.add(item[0])
+                    self._ranked.append(item)
+            return self._ranked[offset:offset + count]
+
+
+# there is no RECOMMENDATION_CACHE_STALE_TTL, an expired ranking is ranked again right away
+recommendation_cache = TTLCache('RECOMMENDATION_CACHE')
+
+
+def recommendation_ranking(user_id, filter_following, mode):
+    """Returns the cached RankedRecommendations of the user for the feed."""
+    def compute():
+        stored = None if filter_following else stored_recommendations(get_db(), user_id, mode)
+        return RankedRecommendations(recommendation_stream(user_id, filter_following, mode), stored or ())
+    return recommendation_cache.get((user_id, bool(filter_following), mode), compute)
+
+
+def forget_cached_recommendations(user_id):
+    recommendation_cache.discard(*[(user_id, filter_following, mode)
+                                   for filter_following in (False, True) for mode in RECOMMEND_MODES])
+
+
+# People you may know ==============================================================
+# The accounts suggested to a user are the ones followed by the accounts the user follows
+# (friends of friends), ranked by how many of the accounts the user follows follow them. The walk
+# over the follow graph stops after SUGGESTION_EDGE_BUDGET follows, so a request never reads more
+# than that. For users who follow more than HEAVY_FOLLOWING accounts the budget would leave most of
+# their follows out, so `flask precompute-suggestions` computes theirs in full ahead of time into
+# follow_suggestions. Those are used until they are older than SUGGESTIONS_MAX_AGE (a day by
+# default) or the user follows all of them. The suggestions of a user are cached for SUGGESTION_CACHE_TTL seconds, and
+# dropped when they follow or unfollow someone. At most SUGGESTION_CACHE_SIZE users' suggestions are
+# cached, the oldest ones are dropped first past that.
+
+SUGGESTIONS_COUNT = 5
+SUGGESTIONS_STORED = 20
+SUGGESTION_EDGE_BUDGET = 20000
+HEAVY_FOLLOWING = 500
+app.config.setdefault('SUGGESTION_CACHE_TTL', 600)
+app.config.setdefault('SUGGESTIONS_MAX_AGE', 24 * 60 * 60)
+app.config.setdefault('SUGGESTION_CACHE_SIZE', 10000)
+
+
+def suggest_follows(user_id, count=SUGGESTIONS_STORED, edge_budget=SUGGESTION_EDGE_BUDGET):
+    """
+    Returns up to count (user_id, mutual follows) pairs of accounts the user doesn't follow
+    yet, the most mutual follows first and the lowest user id first among equals. At most
+    edge_budget follows of the accounts the user follows are looked at, all of them when it
+    is None.
+    """
+    following = followed_ids(user_id)
+    excluded = set(following)
+    excluded.add(user_id)
+    mutual_follows = collections.Counter()
+    remaining = edge_budget
+    for followed_id in following:
+        second_degree = followed_ids(followed_id)
+        if remaining is not None:
+            if remaining <= 0:
+                break
+            second_degree = second_degree[:remaining]
+            remaining -= len(second_degree)
+        mutual_follows.update(candidate for candidate in second_degree if candidate not in excluded)
+    return heapq.nsmallest(count, mutual_follows.items(), key=lambda item: (-item[1], item[0]))
+
+
+def stored_suggestions(conn, user_id):
+    """
+    Returns the user's stored (user_id, mutual follows) suggestions, best first, or None if they
+    are stale: older than SUGGESTIONS_MAX_AGE, or the user already follows every one of them.
+    """
+    rows = conn.execute('SELECT suggested_id, mutual_count, computed_at FROM follow_suggestions WHERE user_id = ? ORDER BY rank',
+                        (user_id,)).fetchall()
+    max_age = timedelta(seconds=app.config['SUGGESTIONS_MAX_AGE'])
+    if not rows or min(row['computed_at'] for row in rows) < datetime.now() - max_age:
+        return None
+    suggested_ids = [row['suggested_id'] for row in rows]
+    if len(followed_among(user_id, suggested_ids)) == len(suggested_ids):
+        return None
+    return [(row['suggested_id'], row['mutual_count']) for row in rows]
+
+
+suggestion_cache = TTLCache('SUGGESTION_CACHE')
+
+
+def follow_suggestions(user_id, count=SUGGESTIONS_COUNT):
+    """Returns the user's top suggestions as dicts with the id, username and mutual_count."""
+    def compute():
+        if follow_counts(user_id)[1] > HEAVY_FOLLOWING:
+            stored = stored_suggestions(get_db(), user_id)
+            if stored is not None:
+                return stored
+        return suggest_follows(user_id)
+    suggestions = suggestion_cache.get(user_id, compute)
+    followed = followed_among(user_id, [suggested_id for suggested_id, _ in suggestions])
+    ranked = [(suggested_id, mutual_count) for suggested_id, mutual_count in suggestions if suggested_id not in followed]
+    if not ranked:
+        return []
+    # follows of deleted users are left in the follows table
+    usernames = {row['id']: row['username'] for row in query_db(
+        f"SELECT id, username FROM users WHERE id IN ({','.join('?' * len(ranked))})",
+        [suggested_id for suggested_id, _ in ranked])}
+    return [{'id': suggested_id, 'username': usernames[suggested_id], 'mutual_count': mutual_count}
+            for suggested_id, mutual_count in ranked if suggested_id in usernames][:count]
+
+
+@app.route('/suggestions')
+def suggestions():
+    """The "people you may know" suggestions of the logged in user, as JSON."""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'login required'}), 401
+    return jsonify({'suggestions': follow_suggestions(user_id)})
+
+
+@app.cli.command('precompute-suggestions')
+@click.option('--min-following', default=HEAVY_FOLLOWING, show_default=True,
+              help='Only users who follow more accounts than this.')
+def precompute_suggestions_command(min_following):
+    """Computes the follow suggestions of the users who follow many accounts, without the edge budget."""
+    conn = get_db()
+    started = time.perf_counter()
+    computed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    user_ids = [row[0] for row in conn.execute(
+        'SELECT follower_id FROM follows GROUP BY follower_id HAVING COUNT(*) > ?', (min_following,))]
+    conn.execute('DELETE FROM follow_suggestions')
+    for user_id in user_ids:
+        conn.executemany('INSERT INTO follow_suggestions (user_id, rank, suggested_id, mutual_count, computed_at) VALUES (?, ?, ?, ?, ?)',
+                         [(user_id, rank, suggested_id, mutual_count, computed_at)
+                          for rank, (suggested_id, mutual_count) in enumerate(suggest_follows(user_id, edge_budget=None), start=1)])
+    conn.commit()
+    suggestion_cache.clear()
+    click.echo(f'follow suggestions stored for {len(user_ids)} users in {time.perf_counter() - started:.2f}s')
+
 
 # Task 3.2 =======================================================================
 def user_risk_analysis(user_id):
@@ -1363,59 +3061,122 @@ def user_risk_analysis(user_id):
             password: admin
         Then, navigate to the /admin endpoint. (http://localhost:8080/admin)
     """
-    import sqlite3
-    from datetime import datetime
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # First I need to get the user profile and the date that the suer joined the platform so 
-    # i have the bio and the age of the account. 
-    cursor.execute("SELECT profile, created_at FROM users WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
-    
-    if not user:
-        conn.close()
-        return 0.0
-    
-    # Now, I get the bio for each user and then pass it through the moderation 
-    # module that I created in exdercise 3.1. This will help us calculate profile score.
-    profile_text = user['profile'] if user['profile'] else ''
-    _, profile_score = moderate_content(profile_text)
-    
+    # The work is done by the bulk version below, this is just the one-user case of it.
+    return user_risk_analysis_many([user_id]).get(user_id, 0.0)
 
-    # We do the same but this time we analyze the posts the user has created and finnaly calculate 
-    # the average score of all posts. Here i used the method "user_id =?" followed by (user_id,)
-    # to prevent sql injection, as instructed by the TA in exercise sessions. The same will be true
-    # about when I calculate the average score for the comments of this user. 
-    cursor.execute("SELECT content FROM posts WHERE user_id = ?", (user_id,))
-    posts = cursor.fetchall()
-    post_scores = []
-    for post in posts:
-        post_content = post['content'] if post['content'] else ''
-        _, post_score = moderate_content(post_content)
-        post_scores.append(post_score)
-    # now we should divide the scores of all posts by the number of the posts. 
-    average_post_score = sum(post_scores) / len(post_scores) if len(post_scores) > 0 else 0.0
-    
 
-    # In this step, I calculate the average score for the comments this user has created. 
-    # just like the process we had for the average post scores.
-    cursor.execute("SELECT content FROM comments WHERE user_id = ?", (user_id,))
-    comments = cursor.fetchall()
-    comment_scores = []
-    for comment in comments:
-        comment_content = comment['content'] if comment['content'] else ''
-        _, comment_score = moderate_content(comment_content)
-        comment_scores.append(comment_score)
-    average_comment_score = sum(comment_scores) / len(comment_scores) if len(comment_scores) > 0 else 0.0
-    
+# How other users' reactions count towards the negative engagement measure (see
+# risk_score_from_components). Reaction types that are not listed here count as 0.
+REACTION_SENTIMENT = {
+    'angry': -1,
+    'sad': 0,
+    'like': 1, 'haha': 1, 'love': 1, 'wow': 1,
+}
+
+# SQLite limits how many ? placeholders one statement can have, so long id lists are
+# split into chunks of this size.
+SQL_IN_CHUNK_SIZE = 500
+
+
+def _chunked(items, size=SQL_IN_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def user_risk_components_many(conn, user_ids=None):
+    """
+    Collects everything the risk score is calculated from, for many users at once,
+    with a handful of grouped queries instead of three or four queries per user.
+
+    Args:
+        conn: an open sqlite3 connection with row_factory = sqlite3.Row.
+        user_ids: the users to analyse, or None for every user.
+
+    Returns:
+        A dict of user_id -> components dict with the keys profile_score,
+        post_score_sum, post_count, comment_score_sum, comment_count,
+        reaction_sentiment_sum, reaction_count and created_at.
+    """
+    if user_ids is None:
+        filters = [('', [])]
+    else:
+        filters = [(f'IN ({",".join("?" * len(chunk))})', list(chunk))
+                   for chunk in _chunked(list(dict.fromkeys(user_ids)))]
+
+    components = {}
+    for condition, params in filters:
+        user_filter = f'WHERE id {condition}' if condition else ''
+        owner_filter = f'AND user_id {condition}' if condition else ''
+
+        # First I need to get the user profile and the date that the suer joined the platform so 
+        # i have the bio and the age of the account. The bio is passed through the moderation 
+        # module that I created in exdercise 3.1 (or its stored result is used when it is up to date).
+        for user in conn.execute(f'''
+            SELECT id, profile, created_at, moderated_profile, profile_moderation_score, profile_moderation_version
+            FROM users {user_filter}
+        ''', params):
+            profile_text = user['profile'] if user['profile'] else ''
+            _, profile_score = stored_moderation(profile_text, user['moderated_profile'],
+                                                 user['profile_moderation_score'], user['profile_moderation_version'])
+            components[user['id']] = {
+                'profile_score': profile_score,
+                'post_score_sum': 0, 'post_count': 0,
+                'comment_score_sum': 0, 'comment_count': 0,
+                'reaction_sentiment_sum': 0, 'reaction_count': 0,
+                'created_at': user['created_at'],
+            }
+
+        # We do the same for the posts and comments the users have created. Rows that already
+        # have a current stored moderation score are summed up in SQL, and only the rest are
+        # moderated here.
+        for table, prefix in (('posts', 'post'), ('comments', 'comment')):
+            for row in conn.execute(f'''
+                SELECT user_id, SUM(moderation_score) AS score_sum, COUNT(*) AS row_count
+                FROM {table}
+                WHERE moderation_version = ? {owner_filter}
+                GROUP BY user_id
+            ''', [MODERATION_CONFIG_VERSION] + params):
+                if row['user_id'] in components:
+                    components[row['user_id']][f'{prefix}_score_sum'] += row['score_sum']
+                    components[row['user_id']][f'{prefix}_count'] += row['row_count']
+            for row in conn.execute(f'''
+                SELECT user_id, content
+                FROM {table}
+                WHERE (moderation_version IS NULL OR moderation_version != ?) {owner_filter}
+            ''', [MODERATION_CONFIG_VERSION] + params):
+                if row['user_id'] in components:
+                    _, score = moderate_content(row['content'] if row['content'] else '')
+                    components[row['user_id']][f'{prefix}_score_sum'] += score
+                    components[row['user_id']][f'{prefix}_count'] += 1
+
+        # And finally the reactions other users have left on their posts, counted per type.
+        reaction_filter = f'WHERE p.user_id {condition}' if condition else ''
+        for row in conn.execute(f'''
+            SELECT p.user_id, r.reaction_type, COUNT(*) AS reaction_count
+            FROM reactions r JOIN posts p ON r.post_id = p.id
+            {reaction_filter}
+            GROUP BY p.user_id, r.reaction_type
+        ''', params):
+            if row['user_id'] in components:
+                user_components = components[row['user_id']]
+                user_components['reaction_sentiment_sum'] += REACTION_SENTIMENT.get(row['reaction_type'], 0) * row['reaction_count']
+                user_components['reaction_count'] += row['reaction_count']
+
+    return components
+
+
+def risk_score_from_components(components, now=None):
+    """Turns the output of user_risk_components_many for one user into the risk score."""
+    # now we should divide the scores of all posts by the number of the posts, and the same
+    # for the comments. 
+    average_post_score = components['post_score_sum'] / components['post_count'] if components['post_count'] > 0 else 0.0
+    average_comment_score = components['comment_score_sum'] / components['comment_count'] if components['comment_count'] > 0 else 0.0
 
     # Now that we have all the scores for profile (a.k.a Bio), comments and posts, 
     # I calculate the weighted average according to the importance of each of these elements
     # as I described before I provided the codes. We should divide the weighted sum by 5 to get the 
     #weighted average. 
-    content_risk_score = ((profile_score * 1) + (average_post_score * 3) + (average_comment_score * 1)) / 5
+    content_risk_score = ((components['profile_score'] * 1) + (average_post_score * 3) + (average_comment_score * 1)) / 5
     
     
     # Now, we should apply the effect of age of the user's accound. Based on this age,
@@ -1426,13 +3187,14 @@ def user_risk_analysis(user_id):
     # and when their violations are caught, they just create new accounds and this age 
     # multiplier can help us catch them much faster because they will be flagged more often 
     # than the mature ones. 
-    created_at_str = user['created_at']
-    try:
-        created_at = datetime.strptime(created_at_str, '%Y-%m-%d %H:%M:%S')
-    except (ValueError, TypeError):
-        created_at = datetime.now()
+    current_time = now or datetime.now()
+    created_at = components['created_at']
+    if not isinstance(created_at, datetime):
+        try:
+            created_at = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+        except (ValueError, TypeError):
+            created_at = current_time
     
-    current_time = datetime.now()
     account_age_days = (current_time - created_at).days
     
     # Here we DEFINE the age multiplier. The accounts that are older than three month old (90 days)
@@ -1463,32 +3225,13 @@ def user_risk_analysis(user_id):
     #  - all the happy reactions such as Like, Love, haha, Wow will receive a +1 because they show that the users are appreciating the post and it is less likely to be a bad or violating one. 
     #For each user, I collect all the reactions on their posts and calculate their weighted average. Then, I divide this sum by the total number of reactions to get a normalized ratio that will range between -1 and +1. This "sentiment ratio" shows the average sentiment of the whole community of users interacting with that user's post on our platform. 
     #Finally, I apply risk penalty based on the user's sentiment ratio. a ratio under -0.3 means almost 65 to 70 percent of the users are not happy with the posts and this can be a good trigger.  -0.3 to -0.5 is considered moderate and receives +0.3 to their risk score.  is the sentiment ratio is between -0.5 and -0.7 i add 0.5 to their risk score and if the sentiment ratio is less than -0.7 i add 1 to their risk score. 
-    
-    cursor.execute("SELECT r.reaction_type FROM reactions r JOIN posts p ON r.post_id = p.id WHERE p.user_id = ?", (user_id,))
-    reactions = cursor.fetchall()
-    sentiment_score = 0
-    total_reactions = 0
-    
-    for reaction in reactions:
-        reaction_type = reaction['reaction_type']
-        total_reactions += 1
-        
-        if reaction_type == 'angry':
-            sentiment_score += -1  
-        elif reaction_type == 'sad':
-            sentiment_score += 0 
-        elif reaction_type in ['like', 'haha', 'love', 'wow']:
-            sentiment_score += 1 
-        else:
-            sentiment_score += 0 #this is for unknown ractions. We can add more reactions if 
-            # we see that they are used on the platform. For the sake of simplicity and 
-            # merely showing how this works, i have only considered the reactions that we have 
-            # on the platform now. 
+    # The weights are in REACTION_SENTIMENT, and the reactions are already summed up per user
+    # by user_risk_components_many.
     
     # For negative sentiment penalty, I first check if teh user has any reactions or not. 
     # I will apply this only if user has received reactions.
-    if total_reactions > 0:
-        sentiment_ratio = sentiment_score / total_reactions
+    if components['reaction_count'] > 0:
+        sentiment_ratio = components['reaction_sentiment_sum'] / components['reaction_count']
         
         # ANow we apply penalty for negative sentiment based on the description I gave above.
         if sentiment_ratio < -0.3:
@@ -1504,9 +3247,167 @@ def user_risk_analysis(user_id):
     if user_risk_score > 5.0:
         user_risk_score = 5.0
     
-    conn.close()
     return user_risk_score
 
+
+def user_risk_analysis_many(user_ids=None):
+    """
+    Args:
+        user_ids: the IDs of the users to analyse, or None for every user.
+
+    Returns:
+        A dict of user_id -> risk score, the same scores user_risk_analysis gives one
+        user at a time. Unknown user IDs are left out.
+    """
+    components = user_risk_components_many(get_db(), user_ids)
+    now = datetime.now()
+    return {user_id: risk_score_from_components(user_components, now)
+            for user_id, user_components in components.items()}
+
+# Materialized risk scores ========================================================
+# The admin dashboard used to score every user on every page load to be able to sort
+# them. Instead, the components above are kept in the user_risk table and updated by
+# the routes that change them (new posts, comments, reactions and deletes), so the
+# dashboard can sort and paginate in SQL.
+#
+# The only part of the score that changes on its own is the account age multiplier,
+# and it only changes when an account turns 30 and 90 days old. rescore_after holds
+# the next such moment for each user, so only those users have to be scored again.
+
+USER_RISK_COMPONENTS = (
+    'profile_score', 'post_score_sum', 'post_count', 'comment_score_sum',
+    'comment_count', 'reaction_sentiment_sum', 'reaction_count',
+)
+
+
+def _rescore_after(created_at):
+    """Returns when the age multiplier of an account created at created_at next changes."""
+    if not isinstance(created_at, datetime):
+        try:
+            created_at = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+        except (ValueError, TypeError):
+            # risk_score_from_components treats these accounts as brand new forever
+            return None
+    now = datetime.now()
+    for days in (30, 90):
+        if (now - created_at).days < days:
+            return (created_at + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    return None
+
+
+def _store_user_risk(conn, components_by_user):
+    now = datetime.now()
+    conn.executemany(f'''
+        INSERT OR REPLACE INTO user_risk (user_id, {', '.join(USER_RISK_COMPONENTS)},
+                                          risk_score, rescore_after, moderation_version)
+        VALUES (?, {', '.join('?' * len(USER_RISK_COMPONENTS))}, ?, ?, ?)
+    ''', [
+        (user_id, *(components[name] for name in USER_RISK_COMPONENTS),
+         risk_score_from_components(components, now), _rescore_after(components['created_at']),
+         MODERATION_CONFIG_VERSION)
+        for user_id, components in components_by_user.items()
+    ])
+
+
+def rebuild_user_risk(conn, user_ids=None):
+    """
+    Recalculates the user_risk rows of the given users (or of everyone) from the
+    posts, comments and reactions tables. The caller commits.
+    """
+    if user_ids is None:
+        conn.execute('DELETE FROM user_risk')
+    _store_user_risk(conn, user_risk_components_many(conn, user_ids))
+
+
+def rescore_user_risk(conn, user_ids):
+    """Recalculates risk_score from the stored components, without touching the content tables."""
+    for chunk in _chunked(list(user_ids)):
+        rows = conn.execute(f'''
+            SELECT ur.user_id, {', '.join('ur.' + name for name in USER_RISK_COMPONENTS)}, u.created_at
+            FROM user_risk ur JOIN users u ON u.id = ur.user_id
+            WHERE ur.user_id IN ({','.join('?' * len(chunk))})
+        ''', chunk).fetchall()
+        _store_user_risk(conn, {row['user_id']: dict(row) for row in rows})
+
+
+def rescore_due_user_risk(conn):
+    """Scores again the users whose account age multiplier has changed since they were last scored."""
+    due = conn.execute('SELECT user_id FROM user_risk WHERE rescore_after <= ?',
+                       (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),)).fetchall()
+    if due:
+        rescore_user_risk(conn, [row['user_id'] for row in due])
+        conn.commit()
+
+
+def adjust_user_risk(conn, user_id, **deltas):
+    """
+    Adds deltas (e.g. post_score_sum=4, post_count=1) to a user's stored components and
+    scores them again. Users without a row yet get one built from scratch instead.
+    The caller commits, so the change lands in the same transaction as the write it
+    belongs to.
+    """
+    if user_id is None:
+        return
+    if not deltas:
+        rebuild_user_risk(conn, [user_id])
+        return
+    assignments = ', '.join(f'{name} = {name} + ?' for name in deltas)
+    cur = conn.execute(f'UPDATE user_risk SET {assignments} WHERE user_id = ?',
+                       (*deltas.values(), user_id))
+    if cur.rowcount:
+        rescore_user_risk(conn, [user_id])
+    else:
+        rebuild_user_risk(conn, [user_id])
+
+
+def forget_comments_in_user_risk(conn, where, params):
+    """Takes the comments matching where (a condition on the comments table) out of their authors' risk components."""
+    per_user = defaultdict(lambda: [0, 0])
+    for comment in conn.execute(f'''
+        SELECT user_id, content, moderated_content, moderation_score, moderation_version
+        FROM comments WHERE {where}
+    ''', params):
+        _, score = stored_moderation(comment['content'] if comment['content'] else '', comment['moderated_content'],
+                                     comment['moderation_score'], comment['moderation_version'])
+        per_user[comment['user_id']][0] += score
+        per_user[comment['user_id']][1] += 1
+    for user_id, (score_sum, count) in per_user.items():
+        adjust_user_risk(conn, user_id, comment_score_sum=-score_sum, comment_count=-count)
+
+
+def forget_post_in_user_risk(conn, post_id):
+    """
+    Takes a post that is about to be deleted, together with its comments and reactions,
+    out of the stored risk components.
+    """
+    post = conn.execute('''
+        SELECT user_id, content, moderated_content, moderation_score, moderation_version
+        FROM posts WHERE id = ?
+    ''', (post_id,)).fetchone()
+    if not post:
+        return
+    _, score = stored_moderation(post['content'] if post['content'] else '', post['moderated_content'],
+                                 post['moderation_score'], post['moderation_version'])
+    sentiment_sum = 0
+    reaction_count = 0
+    for row in conn.execute('SELECT reaction_type, COUNT(*) AS reaction_count FROM reactions WHERE post_id = ? GROUP BY reaction_type', (post_id,)):
+        sentiment_sum += REACTION_SENTIMENT.get(row['reaction_type'], 0) * row['reaction_count']
+        reaction_count += row['reaction_count']
+    adjust_user_risk(conn, post['user_id'], post_score_sum=-score, post_count=-1,
+                     reaction_sentiment_sum=-sentiment_sum, reaction_count=-reaction_count)
+    forget_comments_in_user_risk(conn, 'post_id = ?', (post_id,))
+
+
+@app.cli.command('rebuild-user-risk')
+def rebuild_user_risk_command():
+    """Recalculates the user_risk table from scratch."""
+    conn = get_db()
+    rebuild_user_risk(conn)
+    conn.commit()
+    count = conn.execute('SELECT COUNT(*) FROM user_risk').fetchone()[0]
+    click.echo(f'user_risk rebuilt for {count} users')
+
+
 # Now, I should create the classification of the user based on the score I calculated
 # in the previous section. 
 # I call the users with a risk score of less than 1, as LOW RISK users. Users with risk scores of 
@@ -1540,55 +3441,47 @@ def moderate_content(content):
 
     # TIER 1 ---------------------------------------------------------------
     content_lower=content.lower()
-    for bad_word in TIER1_WORDS:
-        
-        # Here we need to make sure that the Tier1 words are used alone and separately
-        # in the content because othersise we may wrongly flag a word that is 
-        # ok and not rude. 
-        # The pattern I used is:    r'\bhell\b'                       
-        # This will make sure the words are considered separately. 
-        # "go to hell" : it is not Ok because we have the word "hell" and must be moderated. 
-        # However, "hello there" should be left untouched even though there is a "hell" in hello!
-
-        pattern = r'\b' + re.escape(bad_word.lower()) + r'\b'
-        if re.search(pattern, content_lower):
-            return "[content is removed due to severe violation]", 5
+
+    # Here we need to make sure that the Tier1 words are used alone and separately
+    # in the content because othersise we may wrongly flag a word that is 
+    # ok and not rude. 
+    # The pattern I used is:    r'\bhell\b'                       
+    # This will make sure the words are considered separately. 
+    # "go to hell" : it is not Ok because we have the word "hell" and must be moderated. 
+    # However, "hello there" should be left untouched even though there is a "hell" in hello!
+    # All the Tier 1 words are compiled into one pattern (see compile_moderation_patterns)
+    # so the content is scanned once instead of once per word.
+    if TIER1_PATTERN is not None and TIER1_PATTERN.search(content_lower):
+        return "[content is removed due to severe violation]", 5
     
     # TIER 2 ---------------------------------------------------------------
     # For Tier 2 because we are checking the phrases, and not the words, 
     # and therefore it is irrelevant because the chance of having a complete phrase in a 
     # word is zero!
-    for spam_phrase in TIER2_PHRASES:
-        if spam_phrase.lower() in content_lower:
-            return "[content removed due to spam/scam policy]", 5
+    if TIER2_PATTERN is not None and TIER2_PATTERN.search(content_lower):
+        return "[content removed due to spam/scam policy]", 5
     
     
     # TIER 3 ---------------------------------------------------------------
     words = moderated.split()
     cleaned_words = []
     for word in words:
-        word_clean = re.sub(r'[^\w]', '', word.lower())
-        word_found = False
-        for profane_word in TIER3_WORDS:
+        word_clean = NON_WORD_CHARS_PATTERN.sub('', word.lower())
+
+        # Here again we need to make sure the words are separately and not a part of 
+        # another word. Since word_clean only has word characters left in it, that is
+        # the same as looking the whole word up in the Tier 3 set.
+        if word_clean in TIER3_WORD_SET:
             
-            # Here again we need to make sure the words are separately and not a part of 
-            # another word. This is just like the Tier 1 so I do not exxplain repeatedly. 
-            pattern = r'\b' + re.escape(profane_word.lower()) + r'\b'
-            if re.search(pattern, word_clean):
-                
-                # Here I find the bad words that are in Tier 3, I do not remove
-                # the whole content but put asterisks instead of the word. So, that is why
-                # in the line bellow i calculated the length of the bad word that we have identified
-                # and replaced the word buy the same number of asterisks.
-                masked = '*' * len(word)
-                cleaned_words.append(masked)
-                score += 2
-                word_found = True
-                break
-        
-        # If no profanity was found in this word, we do not change the word and leave it as
-        #it is and go to the next word. 
-        if not word_found:
+            # Here I find the bad words that are in Tier 3, I do not remove
+            # the whole content but put asterisks instead of the word. So, that is why
+            # in the line bellow i calculated the length of the bad word that we have identified
+            # and replaced the word buy the same number of asterisks.
+            cleaned_words.append('*' * len(word))
+            score += 2
+        else:
+            # If no profanity was found in this word, we do not change the word and leave it as
+            #it is and go to the next word. 
             cleaned_words.append(word)
     
     # Finally, using the following join operation, I put all the words that were
@@ -1605,11 +3498,10 @@ def moderate_content(content):
     # characters.
     # In the end, [a-zA-Z0-9-]+\.(com|org|net|edu|gov|io)[^\s]*   is the pattern for the
     # domain name and the final domain. I put some most common domains. But I know that 
-    # more domains should be included here. 
-    url_pattern = r'https?://[^\s]+|www\.[^\s]+|[a-zA-Z0-9-]+\.(com|org|net|edu|gov|io)[^\s]*'
-    urls_found = re.findall(url_pattern, moderated)
+    # more domains should be included here. The pattern is URL_PATTERN at the top of the file.
+    urls_found = URL_COUNT_PATTERN.findall(moderated)
     url_count = len(urls_found)
-    moderated = re.sub(url_pattern, '[link removed]', moderated, flags=re.IGNORECASE)
+    moderated = URL_REPLACE_PATTERN.sub('[link removed]', moderated)
     score += url_count * 2
 
     # --------------------------------------------------------------------------
@@ -1638,12 +3530,10 @@ def moderate_content(content):
     # the user is spamming or it was just an honest poor taste in mentioning!
     # --------------------------------------------------------------------------
     
-    # regex pattern to match @mentions such as @sajjad, @user123, @sajjad_ghaemi, @teammarketing
-    mention_pattern = r'@\w+'
-    
+    # MENTION_PATTERN (r'@\w+') matches @mentions such as @sajjad, @user123, @sajjad_ghaemi, @teammarketing
     # Here we should find all @mentions in the content and return
     #  a list like: ['@sajjad', '@aku', '@daniel']
-    mentions = re.findall(mention_pattern, moderated)
+    mentions = MENTION_PATTERN.findall(moderated)
     if len(mentions) >= 5:
         score += 2
     
@@ -1660,6 +3550,75 @@ def moderate_content(content):
 
 
 
+# Moderate-on-write ===============================================================
+# moderate_content used to run on every post, comment and bio each time a page was
+# rendered. Now it runs once when the content is written, and the result is stored in
+# the moderated_content / moderation_score / moderation_version columns. The read
+# paths use the stored result and only fall back to moderating again when the row
+# was moderated with a different censorship config (or not at all yet).
+
+def moderate_for_storage(content):
+    """Returns (moderated, score, version) ready to be written next to the raw content."""
+    moderated, score = moderate_content(content)
+    return moderated, score, MODERATION_CONFIG_VERSION
+
+
+def stored_moderation(content, moderated, score, version):
+    """
+    Returns (moderated, score) for a row, using the stored result when it was
+    produced by the current censorship config.
+    """
+    if version == MODERATION_CONFIG_VERSION:
+        return moderated, score
+    return moderate_content(content)
+
+
+def backfill_moderation(batch_size=500):
+    """
+    Moderates every post, comment and bio that has no stored result for the current
+    censorship config. Rows are processed in id order, batch_size at a time, and each
+    batch is committed on its own so the backfill can be stopped and resumed.
+    Returns the number of rows that were updated per table.
+    """
+    targets = [
+        ('posts', 'content', 'moderated_content', 'moderation_score', 'moderation_version'),
+        ('comments', 'content', 'moderated_content', 'moderation_score', 'moderation_version'),
+        ('users', 'profile', 'moderated_profile', 'profile_moderation_score', 'profile_moderation_version'),
+    ]
+    conn = get_db()
+    updated = {}
+    for table, source, moderated_col, score_col, version_col in targets:
+        updated[table] = 0
+        last_id = 0
+        while True:
+            rows = conn.execute(f'''
+                SELECT id, {source} FROM {table}
+                WHERE id > ? AND ({version_col} IS NULL OR {version_col} != ?)
+                ORDER BY id LIMIT ?
+            ''', (last_id, MODERATION_CONFIG_VERSION, batch_size)).fetchall()
+            if not rows:
+                break
+            conn.executemany(
+                f'UPDATE {table} SET {moderated_col} = ?, {score_col} = ?, {version_col} = ? WHERE id = ?',
+                [(*moderate_for_storage(text), row_id) for row_id, text in rows]
+            )
+            conn.commit()
+            updated[table] += len(rows)
+            last_id = rows[-1][0]
+    return updated
+
+
+@app.cli.command('moderate-backfill')
+@click.option('--batch-size', default=500, show_default=True, help='Rows moderated per transaction.')
+def moderate_backfill_command(batch_size):
+    """Stores moderation results for rows that are missing them or are out of date."""
+    updated = backfill_moderation(batch_size=batch_size)
+    for table, count in updated.items():
+        click.echo(f'{table}: {count} rows moderated (config version {MODERATION_CONFIG_VERSION})')
+
+
+init_db()
+
 if __name__ == '__main__':
     app.run(debug=True, port=8080)
 
@@ -189,42 +189,9 @@ print()
 # We need to preprocess text the same way we did in Exercise 4.1
 # so we can use the LDA model to assign topics
 
-import re
-
-STOP_WORDS = {
-    'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've",
-    "you'll", "you'd", 'your', 'yours', 'yourself', 'yourselves', 'he', 'him', 'his',
-    'himself', 'she', "she's", 'her', 'hers', 'herself', 'it', "it's", 'its', 'itself',
-    'they', 'them', 'their', 'theirs', 'themselves', 'what', 'which', 'who', 'whom',
-    'this', 'that', "that'll", 'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be',
-    'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does', 'did', 'doing', 'a',
-    'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at',
-    'by', 'for', 'with', 'about', 'against', 'between', 'into', 'through', 'during',
-    'before', 'after', 'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on',
-    'off', 'over', 'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when',
-    'where', 'why', 'how', 'all', 'both', 'each', 'few', 'more', 'most', 'other', 'some',
-    'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 's',
-    't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now', 'd', 'll',
-    'm', 'o', 're', 've', 'y', 'ain', 'aren', "aren't", 'couldn', "couldn't", 'didn',
-    "didn't", 'doesn', "doesn't", 'hadn', "hadn't", 'hasn', "hasn't", 'haven', "haven't",
-    'isn', "isn't", 'ma', 'mightn', "mightn't", 'mustn', "mustn't", 'needn', "needn't",
-    'shan', "shan't", 'shouldn', "shouldn't", 'wasn', "wasn't", 'weren', "weren't", 'won',
-    "won't", 'wouldn', "wouldn't", 'get', 'got', 'like', 'also', 'would', 'could', 'going',
-    'know', 'think', 'one', 'much', 'even', 'many', 'way', 'see', 'really', 'something',
-    'make', 'made', 'want', 'well', 'still', 'back', 'im', 'ive', 'dont', 'cant', 'wont'
-}
-
-def preprocess_text(text):
-    # same preprocessing as Exercise 4.1
-    text = text.lower()
-    text = re.sub(r'http\S+|www\S+', '', text)
-    text = re.sub(r'[^a-z\s]', '', text)
-    tokens = text.split()
-    processed = []
-    for token in tokens:
-        if token not in STOP_WORDS and len(token) >= 3:
-            processed.append(token)
-    return processed
+# preprocess_text and the stop words are shared with Exercise 4.1 in text_preprocessing.py
+from text_preprocessing import preprocess_text
+from topic_modeling import existing_artifacts
 
 print("Text preprocessing function ready")
 print()
@@ -236,45 +203,44 @@ print()
 #be to (use LDA model to get topic distribution). Finally, i will (assign the dominant topic).
 
 
-#Assigning topics to posts
-for post_id, content in posts:
-    tokens = preprocess_text(content)
+def assign_topic(sentiment, tokens_count, bow):
     # Skip if there are too few tokens to be analyzed.
-    if len(tokens) < 2:
-        post_sentiments[post_id]['topic'] = None
-        continue
-    bow = dictionary.doc2bow(tokens)
+    if tokens_count < 2:
+        sentiment['topic'] = None
+        return
     # Get topic distribution from LDA model
     doc_topics = lda_model.get_document_topics(bow)
-    
-    # Now i will find the dominant topic that is technically the topic with highest probability
-    if doc_topics:
-        dominant_topic = max(doc_topics, key=lambda x: x[1])
-        topic_id = dominant_topic[0]  # topic ID (0-9)
-        topic_prob = dominant_topic[1]  # probability
-        post_sentiments[post_id]['topic'] = topic_id
-        post_sentiments[post_id]['topic_prob'] = topic_prob
-    else:
-        post_sentiments[post_id]['topic'] = None
 
-# We do the same for the comments: 
-# Assigning topics to comments...
-for comment_id, content in comments:
-    tokens = preprocess_text(content)
-    if len(tokens) < 2:
-        comment_sentiments[comment_id]['topic'] = None
-        continue
-    bow = dictionary.doc2bow(tokens)
-    doc_topics = lda_model.get_document_topics(bow)
-    
+    # Now i will find the dominant topic that is technically the topic with highest probability
     if doc_topics:
         dominant_topic = max(doc_topics, key=lambda x: x[1])
-        topic_id = dominant_topic[0]
-        topic_prob = dominant_topic[1]
-        comment_sentiments[comment_id]['topic'] = topic_id
-        comment_sentiments[comment_id]['topic_prob'] = topic_prob
+        sentiment['topic'] = dominant_topic[0]  # topic ID (0-9)
+        sentiment['topic_prob'] = dominant_topic[1]  # probability
     else:
-        comment_sentiments[comment_id]['topic'] = None
+        sentiment['topic'] = None
+
+
+# Exercise 4.1 saved the bag-of-words of every post and comment in lda_artifacts. If nothing was posted since
+# then, they are the same documents with the same dictionary as the model, so I don't have to preprocess
+# everything again and only read them from there. Otherwise I do it here.
+artifacts = existing_artifacts(DATABASE)
+if artifacts is not None and artifacts.dictionary.token2id == dictionary.token2id:
+    print("Using the bag-of-words saved by Exercise 4.1")
+    sentiments = {'posts': post_sentiments, 'comments': comment_sentiments}
+    for table, doc_id, tokens_count, bow in artifacts.rows():
+        if doc_id in sentiments[table]:
+            assign_topic(sentiments[table][doc_id], tokens_count, bow)
+else:
+    #Assigning topics to posts
+    for post_id, content in posts:
+        tokens = preprocess_text(content)
+        assign_topic(post_sentiments[post_id], len(tokens), dictionary.doc2bow(tokens))
+
+    # We do the same for the comments: 
+    # Assigning topics to comments...
+    for comment_id, content in comments:
+        tokens = preprocess_text(content)
+        assign_topic(comment_sentiments[comment_id], len(tokens), dictionary.doc2bow(tokens))
 
 # STEP 9: Calculate Sentiment by Topic
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
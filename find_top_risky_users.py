@@ -1,8 +1,7 @@
-import sqlite3
-from app import user_risk_analysis, classify_risk, DATABASE
+from app import user_risk_analysis_many, classify_risk, get_db
 
 def find_top_risky_users(top_n=5):   
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()  
     cursor.execute("SELECT id FROM users")
     all_users = cursor.fetchall()
@@ -10,11 +9,12 @@ def find_top_risky_users(top_n=5):
     print(f"Found {len(all_users)} total users in database")
     print()
     
+    # all the scores are calculated in one pass instead of one user_risk_analysis call per user
+    risk_scores = user_risk_analysis_many([user_row[0] for user_row in all_users])
     user_scores = []
     for user_row in all_users:
         user_id = user_row[0]
-        risk_score = user_risk_analysis(user_id)
-        user_scores.append((user_id, risk_score))
+        user_scores.append((user_id, risk_scores.get(user_id, 0.0)))
     
     user_scores.sort(key=lambda x: x[1], reverse=True)
     top_users = user_scores[:top_n]
@@ -24,7 +24,6 @@ def find_top_risky_users(top_n=5):
         for user_id, score in top_users
     ]
     
-    conn.close()
     return top_users_with_labels, user_scores
 
 
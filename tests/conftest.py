@@ -0,0 +1,43 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    # app.py reads database.sqlite and censorship.dat from the working directory and migrates
+    # the database when it's imported, so the tests run it on a copy in a temp directory
+    # instead of touching the real database.
+    work_dir = tmp_path_factory.mktemp('app')
+    for name in ('database.sqlite', 'censorship.dat'):
+        shutil.copy(os.path.join(REPO_DIR, name), work_dir)
+    old_dir = os.getcwd()
+    os.chdir(work_dir)
+    sys.path.insert(0, REPO_DIR)
+    import app
+    yield app
+    os.chdir(old_dir)
+
+
+@pytest.fixture
+def client(app_module):
+    app_module.app.config['TESTING'] = True
+    with app_module.app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def log_in(app_module, client):
+    """Returns a function that puts a user in the client's session, like the login route does."""
+    def log_in(username):
+        with app_module.app.app_context():
+            user = app_module.query_db('SELECT id, username FROM users WHERE username = ?', (username,), one=True)
+        with client.session_transaction() as session:
+            session['user_id'] = user['id']
+            session['username'] = user['username']
+        return user['id']
+    return log_in
@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def make_cache(app_module, monkeypatch):
+    """Returns a function making a TTLCache with its settings in app.config."""
+    def make_cache(ttl, stale_ttl, size):
+        monkeypatch.setitem(app_module.app.config, 'TEST_CACHE_TTL', ttl)
+        monkeypatch.setitem(app_module.app.config, 'TEST_CACHE_STALE_TTL', stale_ttl)
+        monkeypatch.setitem(app_module.app.config, 'TEST_CACHE_SIZE', size)
+        return app_module.TTLCache('TEST_CACHE')
+    return make_cache
+
+
+@pytest.fixture
+def clock(app_module, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app_module.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_cache_keeps_at_most_max_entries(make_cache):
+    cache = make_cache(60, 60, 3)
+    for key in range(5):
+        assert cache.get(key, lambda: key * 10) == key * 10
+    stats = cache.stats()
+    assert stats['entries'] == 3 and stats['evictions'] == 2
+    # the oldest ones were dropped, the newest are still cached
+    assert cache.get(4, lambda: None) == 40
+    assert cache.get(0, lambda: 'again') == 'again'
+    assert not cache._key_locks
+
+
+def test_cache_drops_expired_values(make_cache, clock):
+    cache = make_cache(10, 20, 100)
+    cache.get('old', lambda: 1)
+    clock[0] += 30
+    cache.get('new', lambda: 2)
+    assert list(cache._entries) == ['new']
+
+
+def test_cache_reads_its_settings_when_used(app_module, make_cache, clock, monkeypatch):
+    cache = make_cache(10, 10, 100)
+    cache.get('key', lambda: 1)
+    clock[0] += 15
+    monkeypatch.setitem(app_module.app.config, 'TEST_CACHE_TTL', 60)
+    monkeypatch.setitem(app_module.app.config, 'TEST_CACHE_STALE_TTL', 60)
+    assert cache.get('key', lambda: 2) == 1
+    assert cache.stats()['ttl'] == 60
+
+
+def test_cache_stale_ttl_defaults_to_ttl(app_module, make_cache, monkeypatch):
+    cache = make_cache(30, 30, 100)
+    monkeypatch.delitem(app_module.app.config, 'TEST_CACHE_STALE_TTL')
+    assert cache.stale_ttl == 30
+
+
+def test_cache_computes_once_for_concurrent_misses(make_cache):
+    cache = make_cache(60, 60, 10)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('key', compute))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['value'] * 4 and len(calls) == 1
+    assert not cache._key_locks
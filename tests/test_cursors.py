@@ -0,0 +1,71 @@
+import base64
+import json
+
+import pytest
+
+
+def tampered_cursor(payload):
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+@pytest.mark.parametrize('payload', [
+    {'k': [{'a': 1}, 1], 'd': 'next'},
+    {'k': [[1], 2], 'd': 'prev'},
+    {'k': [True, 1], 'd': 'next'},
+    {'k': [10 ** 30, 1], 'd': 'next'},
+    {'k': [-2 ** 63 - 1, 1], 'd': 'next'},
+    {'k': [float('inf'), 1], 'd': 'next'},
+    {'k': [float('nan'), 1], 'd': 'prev'},
+    [[1], 1, 2],
+    'not a cursor',
+])
+def test_decode_cursor_rejects_tampered_tokens(app_module, payload):
+    assert app_module.decode_cursor(tampered_cursor(payload), 2) is None
+
+
+def test_decode_cursor_round_trip(app_module):
+    token = app_module.encode_cursor(['2025-01-01 10:00:00', 5], 'next')
+    assert app_module.decode_cursor(token, 2) == (['2025-01-01 10:00:00', 5], 'next')
+    token = app_module.encode_cursor([2 ** 63 - 1, -2 ** 63], 'prev')
+    assert app_module.decode_cursor(token, 2) == ([2 ** 63 - 1, -2 ** 63], 'prev')
+
+
+@pytest.mark.parametrize('path, param, payload', [
+    ('/', 'cursor', {'k': [{'a': 1}, 1], 'd': 'next'}),
+    ('/?sort=popular', 'cursor', [[1], 1, 2]),
+    ('/?sort=popular', 'cursor', {'k': [[1], 1, 2], 'd': 'next'}),
+    ('/', 'cursor', {'k': [10 ** 30, 1], 'd': 'next'}),
+    ('/?sort=popular', 'cursor', {'k': [10 ** 30, '2025-01-01 10:00:00', 1], 'd': 'prev'}),
+    ('/admin?tab=posts', 'posts_cursor', {'k': [10 ** 30], 'd': 'next'}),
+    ('/admin?tab=comments', 'comments_cursor', {'k': [float('inf')], 'd': 'next'}),
+])
+def test_tampered_cursor_shows_first_page(client, log_in, path, param, payload):
+    log_in('admin' if path.startswith('/admin') else 'artistic_amy')
+    first_page = client.get(path)
+    separator = '&' if '?' in path else '?'
+    response = client.get(f'{path}{separator}{param}={tampered_cursor(payload)}')
+    assert response.status_code == 200
+    assert response.data == first_page.data
+
+
+def test_admin_tampered_cursor_shows_first_page(client, log_in):
+    log_in('admin')
+    first_page = client.get('/admin')
+    response = client.get(f"/admin?posts_cursor={tampered_cursor({'k': [{'id': 1}], 'd': 'next'})}")
+    assert response.status_code == 200
+    assert response.data == first_page.data
+
+
+@pytest.mark.parametrize('payload', [
+    {'k': [{'a': 1}, 1], 'd': 'next'},
+    {'k': [[1], 1], 'd': 'prev'},
+    {'k': ['2025-01-01 10:00:00'], 'd': 'next'},
+    {'k': ['2025-01-01 10:00:00', 10 ** 30], 'd': 'next'},
+])
+def test_topic_tampered_cursor_shows_first_page(client, log_in, app_module, payload):
+    log_in('artistic_amy')
+    topic_id = next(iter(app_module.TOPICS))
+    first_page = client.get(f'/trending/{topic_id}')
+    response = client.get(f'/trending/{topic_id}?cursor={tampered_cursor(payload)}')
+    assert response.status_code == 200
+    assert response.data == first_page.data
@@ -0,0 +1,53 @@
+import re
+
+import pytest
+
+
+@pytest.fixture
+def count_queries(app_module, monkeypatch):
+    """Records the SQL statements run on the request connections, see statements()."""
+    statements = []
+    acquire_connection = app_module.acquire_connection
+
+    def traced_connection():
+        conn = acquire_connection()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(app_module, 'acquire_connection', traced_connection)
+    yield statements
+    for conn in app_module._pool:
+        conn.set_trace_callback(None)
+
+
+def last_page(app_module):
+    with app_module.app.app_context():
+        total = app_module.query_db('SELECT COUNT(*) FROM posts', one=True)[0]
+    return (total + 9) // 10
+
+
+def shown_posts(response):
+    return len(re.findall(r'id="post-\d+"', response.get_data(as_text=True)))
+
+
+@pytest.mark.parametrize('use_graph', [True, False])
+@pytest.mark.parametrize('sort', ['new', 'popular'])
+def test_feed_query_count_does_not_depend_on_page_size(app_module, client, log_in, count_queries,
+                                                       monkeypatch, use_graph, sort):
+    monkeypatch.setitem(app_module.app.config, 'FOLLOW_GRAPH', use_graph)
+    log_in('artistic_amy')
+    full_page, short_page = f'/?sort={sort}&page=1', f'/?sort={sort}&page={last_page(app_module)}'
+    # the first requests fill the caches of the sidebar and the follow graph
+    client.get(full_page)
+    client.get(short_page)
+
+    counts = {}
+    for path in (full_page, short_page):
+        count_queries.clear()
+        response = client.get(path)
+        assert response.status_code == 200
+        counts[shown_posts(response)] = len(count_queries)
+
+    # a full page and the short last page, loaded with the same number of queries
+    assert len(counts) == 2 and 10 in counts
+    assert len(set(counts.values())) == 1, counts
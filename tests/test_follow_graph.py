@@ -0,0 +1,14 @@
+import pytest
+
+
+@pytest.mark.parametrize('use_graph', [True, False])
+def test_followed_among_matches_the_follows_table(app_module, use_graph, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'FOLLOW_GRAPH', use_graph)
+    with app_module.app.app_context():
+        follows = {(row['follower_id'], row['followed_id'])
+                   for row in app_module.query_db('SELECT follower_id, followed_id FROM follows')}
+        user_ids = [row['id'] for row in app_module.query_db('SELECT id FROM users ORDER BY id')]
+        for follower_id in user_ids[:20]:
+            assert app_module.followed_among(follower_id, user_ids) == \
+                {user_id for user_id in user_ids if (follower_id, user_id) in follows}
+        assert app_module.followed_among(user_ids[0], []) == set()
@@ -0,0 +1,23 @@
+import pytest
+
+
+# (user_id, post_id) reaction pairs with ties in the similarities, and posts with fewer neighbours than k
+REACTIONS = [
+    (1, 10), (1, 11), (1, 12),
+    (2, 10), (2, 11),
+    (3, 11), (3, 12), (3, 13),
+    (4, 13), (4, 14),
+    (5, 10), (5, 14), (5, 15),
+    (6, 16),
+]
+
+
+@pytest.mark.parametrize('k', [1, 2, 20])
+def test_post_neighbors_sparse_matches_python(app_module, k):
+    pytest.importorskip('scipy')
+    expected = list(app_module.post_neighbors_python(REACTIONS, k))
+    result = list(app_module.post_neighbors_sparse(REACTIONS, k))
+    assert [(post_id, neighbor_id) for post_id, neighbor_id, _ in sorted(result)] == \
+        [(post_id, neighbor_id) for post_id, neighbor_id, _ in sorted(expected)]
+    assert [similarity for _, _, similarity in sorted(result)] == \
+        pytest.approx([similarity for _, _, similarity in sorted(expected)])
@@ -0,0 +1,103 @@
+import re
+from datetime import datetime
+
+
+def store_recommendations(app_module, user_id, post_ids, mode='overlap'):
+    """Writes stored recommendations for the user like `flask precompute-recommendations` does."""
+    computed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute('DELETE FROM recommendations WHERE user_id = ?', (user_id,))
+        db.executemany('INSERT INTO recommendations (user_id, mode, rank, post_id, score, computed_at) VALUES (?, ?, ?, ?, ?, ?)',
+                       [(user_id, mode, rank, post_id, 1.0, computed_at) for rank, post_id in enumerate(post_ids, start=1)])
+        db.commit()
+        app_module.recommendation_cache.clear()
+
+
+def other_users_posts(app_module, user_id, count):
+    with app_module.app.app_context():
+        return [row['id'] for row in app_module.query_db(
+            'SELECT id FROM posts WHERE user_id != ? ORDER BY id LIMIT ?', (user_id, count))]
+
+
+def test_stored_recommendations_with_a_missing_post_are_stale(app_module, log_in):
+    user_id = log_in('artistic_amy')
+    post_ids = other_users_posts(app_module, user_id, 5)
+    store_recommendations(app_module, user_id, post_ids + [10 ** 9])
+    with app_module.app.app_context():
+        assert app_module.stored_recommendations(app_module.get_db(), user_id, 'overlap') is None
+    store_recommendations(app_module, user_id, post_ids)
+    with app_module.app.app_context():
+        stored = app_module.stored_recommendations(app_module.get_db(), user_id, 'overlap')
+    assert [post_id for post_id, score in stored] == post_ids
+
+
+def test_deleted_post_leaves_the_stored_recommendations(app_module, client, log_in):
+    user_id = log_in('artistic_amy')
+    post_ids = other_users_posts(app_module, user_id, 15)
+    store_recommendations(app_module, user_id, post_ids)
+
+    log_in('admin')
+    assert client.post(f'/admin/delete/post/{post_ids[0]}').status_code == 302
+    with app_module.app.app_context():
+        assert app_module.query_db('SELECT 1 FROM recommendations WHERE post_id = ?', (post_ids[0],)) == []
+
+    log_in('artistic_amy')
+    page = client.get('/?sort=recommended').get_data(as_text=True)
+    # the deleted post doesn't take a slot, the page is the next 10 stored posts
+    assert [int(post_id) for post_id in re.findall(r'id="post-(\d+)"', page)] == post_ids[1:11]
+
+
+def connection_of_worker(_):
+    import app
+    return id(app.get_db())
+
+
+def test_forked_worker_opens_its_own_connection(app_module):
+    with app_module.app.app_context():
+        parent = app_module.get_db()
+        with app_module.concurrent.futures.ProcessPoolExecutor(1) as pool:
+            assert pool.submit(connection_of_worker, None).result() != id(parent)
+
+
+def test_precompute_with_workers_stores_the_same_rows(app_module):
+    def stored(db):
+        return [tuple(row) for row in db.execute(
+            'SELECT user_id, mode, rank, post_id, score FROM recommendations ORDER BY user_id, mode, rank')]
+
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        written = app_module.precompute_recommendations(db, app_module.RECOMMEND_MODES, workers=1, batch_size=40)
+        in_one_process = stored(db)
+        assert written == len(in_one_process) > 0
+        assert app_module.precompute_recommendations(db, app_module.RECOMMEND_MODES, workers=2, batch_size=40) == written
+        assert stored(db) == in_one_process
+
+
+def popular_posts_by_aggregate(app_module, user_id, following_user_ids=None):
+    """What popular_posts returns, counted from the reactions table in one query."""
+    conditions, params = 'p.user_id != ?', [user_id]
+    if following_user_ids:
+        conditions += f" AND p.user_id IN ({','.join('?' * len(following_user_ids))})"
+        params += following_user_ids
+    return [tuple(row) for row in app_module.query_db(f'''
+        SELECT p.id, COUNT(r.id) AS reaction_count FROM posts p LEFT JOIN reactions r ON p.id = r.post_id
+        WHERE {conditions} GROUP BY p.id ORDER BY reaction_count DESC, p.id ASC
+    ''', params)]
+
+
+def test_popular_posts_follow_the_reactions(app_module, client, log_in):
+    user_id = log_in('artistic_amy')
+    post_id = other_users_posts(app_module, user_id, 1)[0]
+    client.post('/react', data={'post_id': post_id, 'reaction': 'like'})
+    with app_module.app.app_context():
+        following = list(app_module.followed_ids(user_id))
+        for chunk_size in (7, 50):
+            assert list(app_module.popular_posts(user_id, chunk_size=chunk_size)) == \
+                popular_posts_by_aggregate(app_module, user_id)
+        assert list(app_module.popular_posts(user_id, following, chunk_size=7)) == \
+            popular_posts_by_aggregate(app_module, user_id, following)
+
+    client.post('/unreact', data={'post_id': post_id})
+    with app_module.app.app_context():
+        assert list(app_module.popular_posts(user_id, chunk_size=7)) == popular_posts_by_aggregate(app_module, user_id)
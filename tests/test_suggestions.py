@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def store_suggestions(app_module):
+    """Returns a function writing stored suggestions like `flask precompute-suggestions` does."""
+    def store_suggestions(user_id, suggested_ids, computed_at):
+        with app_module.app.app_context():
+            db = app_module.get_db()
+            db.execute('DELETE FROM follow_suggestions WHERE user_id = ?', (user_id,))
+            db.executemany('INSERT INTO follow_suggestions (user_id, rank, suggested_id, mutual_count, computed_at) VALUES (?, ?, ?, ?, ?)',
+                           [(user_id, rank, suggested_id, 1, computed_at.strftime('%Y-%m-%d %H:%M:%S'))
+                            for rank, suggested_id in enumerate(suggested_ids, start=1)])
+            db.commit()
+            app_module.suggestion_cache.clear()
+    yield store_suggestions
+    with app_module.app.app_context():
+        app_module.get_db().execute('DELETE FROM follow_suggestions')
+        app_module.get_db().commit()
+
+
+def follows_of(app_module, user_id):
+    with app_module.app.app_context():
+        followed = app_module.followed_ids(user_id)
+        not_followed = [row['id'] for row in app_module.query_db(
+            'SELECT id FROM users WHERE id != ? AND id NOT IN (SELECT followed_id FROM follows WHERE follower_id = ?) ORDER BY id',
+            (user_id, user_id))]
+    return list(followed), not_followed
+
+
+def stored(app_module, user_id):
+    with app_module.app.app_context():
+        return app_module.stored_suggestions(app_module.get_db(), user_id)
+
+
+def test_fresh_stored_suggestions_are_used(app_module, store_suggestions):
+    followed, not_followed = follows_of(app_module, 1)
+    store_suggestions(1, [followed[0]] + not_followed[:2], datetime.now())
+    assert stored(app_module, 1) == [(followed[0], 1), (not_followed[0], 1), (not_followed[1], 1)]
+
+
+def test_old_stored_suggestions_are_stale(app_module, store_suggestions):
+    _, not_followed = follows_of(app_module, 1)
+    max_age = app_module.app.config['SUGGESTIONS_MAX_AGE']
+    store_suggestions(1, not_followed[:3], datetime.now() - timedelta(seconds=max_age + 60))
+    assert stored(app_module, 1) is None
+
+
+def test_stored_suggestions_all_followed_are_stale(app_module, store_suggestions, monkeypatch):
+    followed, _ = follows_of(app_module, 1)
+    store_suggestions(1, followed[:3], datetime.now())
+    assert stored(app_module, 1) is None
+
+    # a heavy user's widget falls back to suggestions computed on request instead of staying empty
+    monkeypatch.setattr(app_module, 'HEAVY_FOLLOWING', 0)
+    with app_module.app.app_context():
+        expected = app_module.suggest_follows(1)[:app_module.SUGGESTIONS_COUNT]
+        suggestions = app_module.follow_suggestions(1)
+    assert expected
+    assert [(suggestion['id'], suggestion['mutual_count']) for suggestion in suggestions] == expected
@@ -0,0 +1,500 @@
+"""
+A streaming corpus of the posts and comments, for the LDA topic model of exercises 4.1 and 4.2.
+
+exercise_4_1.py used to fetchall() the posts and comments and keep the texts, the token lists and
+the bag-of-words vectors as lists, so its memory grew with several copies of the whole database.
+SQLiteCorpus reads the texts from a cursor with fetchmany(), tokenizes them as it goes
+(text_preprocessing.tokenize_stream) and yields the bag-of-words vectors one at a time. Every
+iteration starts a new query, so gensim can go over it as many times as it needs to (one pass for
+the dictionary, one per LdaModel pass). Only the dictionary and one batch of rows are in memory.
+
+A corpus only reads the posts and comments up to the highest ids there were when it was made, its
+watermark, so all of the passes see the same documents even when new ones are written meanwhile.
+
+Going through SQLiteCorpus still preprocesses every text on every pass, and exercise 4.2 preprocessed
+them all again to find their topics. corpus_artifacts() does it once per watermark: it saves the
+filtered dictionary and the bag-of-words of every post and comment as a Matrix Market corpus with an
+index (gensim's MmCorpus) in ARTIFACTS_DIR, named after the watermark and the preprocessing settings.
+The next run with the same posts and comments loads them instead, which is only the dictionary, the
+index and the ids, and reads the bag-of-words from the file as it goes.
+The watermark only grows when posts and comments are added, so after deleting or editing old ones
+remove ARTIFACTS_DIR to have them built again.
+
+train_lda() trains the model, with LdaModel like exercise 4.1 or with LdaMulticore in --workers
+processes. Running this file trains one from the artifacts and saves it where exercise 4.2 loads it:
+
+    python topic_modeling.py train --workers 3 --passes 15
+
+Training from scratch goes over everything again. Every model saved by this file is also kept as a
+numbered checkpoint in CHECKPOINT_DIR and recorded in the lda_checkpoints table with the watermark
+it was trained up to, and `update` continues the newest one with only the posts and comments written
+after that watermark (LdaModel.update(), online LDA), then saves it as the next checkpoint:
+
+    python topic_modeling.py update
+
+An update keeps the dictionary of the model, so words that are new since it was trained are ignored
+until the next `train`.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from array import array
+
+import numpy as np
+from gensim import corpora
+from gensim.models import LdaModel, LdaMulticore
+
+try:
+    import resource
+except ImportError:  # not on Windows, the peak memory isn't reported there
+    resource = None
+
+from text_preprocessing import LDA_STOP_WORDS, MIN_TOKEN_LENGTH, NON_LETTER_PATTERN, URL_PATTERN, tokenize_stream
+
+DATABASE = 'database.sqlite'
+# the tables the documents come from, in the order they are read
+TEXT_TABLES = ('posts', 'comments')
+FETCH_SIZE = 1000
+# documents with fewer tokens than this are left out, see exercise_4_1.py
+MIN_TOKENS = 3
+# words in fewer documents than NO_BELOW, or in more than the NO_ABOVE fraction of them, are left out
+NO_BELOW = 5
+NO_ABOVE = 0.5
+ARTIFACTS_DIR = 'lda_artifacts'
+# where exercise 4.2 loads the model from
+LDA_MODEL = 'lda_model_10_topics.model'
+LDA_DICTIONARY = 'lda_dictionary.dict'
+NUM_TOPICS = 10
+CHECKPOINT_DIR = 'lda_checkpoints'
+
+
+def watermark(conn):
+    """The highest post id and the highest comment id, (0, 0) for an empty database."""
+    return tuple(conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0] for table in TEXT_TABLES)
+
+
+class SQLiteCorpus:
+    """
+    The bag-of-words vectors of the posts and comments of database, posts first and both in id
+    order. Iterating it needs a dictionary: pass one in, or build one from documents() and set
+    it. len() is known after the first full pass over the documents, and costs one otherwise.
+    """
+
+    def __init__(self, database=DATABASE, dictionary=None, min_tokens=MIN_TOKENS, fetch_size=FETCH_SIZE, upto=None,
+                 after=(0, 0)):
+        """
+        upto is the (max post id, max comment id) to read up to, the current watermark by default,
+        and after is the watermark to start after, to read only what was written since then.
+        """
+        self.database = database
+        self.dictionary = dictionary
+        self.min_tokens = min_tokens
+        self.fetch_size = fetch_size
+        if upto is None:
+            conn = sqlite3.connect(database)
+            try:
+                upto = watermark(conn)
+            finally:
+                conn.close()
+        self.upto = tuple(upto)
+        self.after = tuple(after)
+        self._length = None
+
+    def rows(self):
+        """Yields (table, id, text) of every non-empty post and comment up to the watermark."""
+        conn = sqlite3.connect(self.database)
+        try:
+            for table, min_id, max_id in zip(TEXT_TABLES, self.after, self.upto):
+                cursor = conn.execute(f"SELECT id, content FROM {table} WHERE content != '' AND id > ? AND id <= ? "
+                                      "ORDER BY id", (min_id, max_id))
+                rows = cursor.fetchmany(self.fetch_size)
+                while rows:
+                    for row_id, content in rows:
+                        yield table, row_id, content
+                    rows = cursor.fetchmany(self.fetch_size)
+        finally:
+            conn.close()
+
+    def texts(self):
+        """Yields the text of every non-empty post and comment up to the watermark."""
+        return (content for _, _, content in self.rows())
+
+    def tokenized_rows(self):
+        """Yields (table, id, tokens) of every non-empty post and comment, also the ones with few tokens."""
+        rows, texts = itertools.tee(self.rows())
+        for (table, row_id, _), tokens in zip(rows, tokenize_stream((content for _, _, content in texts), LDA_STOP_WORDS)):
+            yield table, row_id, tokens
+
+    def documents(self):
+        """Yields the tokens of every text that has at least min_tokens of them."""
+        count = 0
+        for tokens in tokenize_stream(self.texts(), LDA_STOP_WORDS):
+            if len(tokens) >= self.min_tokens:
+                count += 1
+                yield tokens
+        self._length = count
+
+    def __iter__(self):
+        if self.dictionary is None:
+            raise ValueError('SQLiteCorpus needs a dictionary to make bag-of-words vectors')
+        doc2bow = self.dictionary.doc2bow
+        for tokens in self.documents():
+            yield doc2bow(tokens)
+
+    def __len__(self):
+        if self._length is None:
+            for _ in self.documents():
+                pass
+        return self._length
+
+
+def artifact_key(upto, min_tokens=MIN_TOKENS, no_below=NO_BELOW, no_above=NO_ABOVE):
+    """The name of the artifacts of the corpus up to the watermark upto, made with these settings."""
+    settings = json.dumps([sorted(LDA_STOP_WORDS), URL_PATTERN.pattern, NON_LETTER_PATTERN.pattern,
+                           MIN_TOKEN_LENGTH, min_tokens, no_below, no_above])
+    return f"corpus-p{upto[0]}-c{upto[1]}-{hashlib.sha256(settings.encode('utf-8')).hexdigest()[:8]}"
+
+
+class CorpusArtifacts:
+    """
+    The saved dictionary and bag-of-words of one watermark, see corpus_artifacts(). Every non-empty
+    post and comment is a row of the corpus, posts first and both in id order, also the documents
+    with fewer than min_tokens tokens, which are left out of the dictionary and the training but are
+    still given a topic by exercise 4.2. ids and token_counts say which post or comment a row is and
+    how many tokens it had before the dictionary was filtered.
+    """
+
+    def __init__(self, directory, key):
+        path = os.path.join(directory, key)
+        with open(path + '.json', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.upto = tuple(self.meta['upto'])
+        self.min_tokens = self.meta['min_tokens']
+        self.dictionary = corpora.Dictionary.load(path + '.dict')
+        self.corpus = corpora.MmCorpus(path + '.mm')
+        self.ids = array('q')
+        self.token_counts = array('i')
+        with open(path + '.ids', 'rb') as f:
+            self.ids.fromfile(f, self.meta['documents'])
+            self.token_counts.fromfile(f, self.meta['documents'])
+
+    def rows(self):
+        """Yields (table, id, token count, bag-of-words) of every document."""
+        for position, bow in enumerate(self.corpus):
+            table = TEXT_TABLES[0] if position < self.meta['posts'] else TEXT_TABLES[1]
+            yield table, self.ids[position], self.token_counts[position], bow
+
+    def training_corpus(self):
+        """The bag-of-words of the documents with at least min_tokens tokens, what SQLiteCorpus iterates."""
+        return TrainingCorpus(self.corpus, self.token_counts, self.min_tokens)
+
+
+class TrainingCorpus:
+    """The rows of a serialized corpus whose documents had at least min_tokens tokens. Can be iterated many times."""
+
+    def __init__(self, corpus, token_counts, min_tokens):
+        self.corpus = corpus
+        self.token_counts = token_counts
+        self.min_tokens = min_tokens
+        self._length = sum(1 for count in token_counts if count >= min_tokens)
+
+    def __iter__(self):
+        for bow, count in zip(self.corpus, self.token_counts):
+            if count >= self.min_tokens:
+                yield bow
+
+    def __len__(self):
+        return self._length
+
+
+def existing_artifacts(database=DATABASE, directory=ARTIFACTS_DIR, min_tokens=MIN_TOKENS, no_below=NO_BELOW,
+                       no_above=NO_ABOVE, upto=None):
+    """The CorpusArtifacts of the database's current watermark (or upto), None if they weren't made yet."""
+    if upto is None:
+        conn = sqlite3.connect(database)
+        try:
+            upto = watermark(conn)
+        finally:
+            conn.close()
+    key = artifact_key(upto, min_tokens, no_below, no_above)
+    if not os.path.exists(os.path.join(directory, key + '.json')):
+        return None
+    return CorpusArtifacts(directory, key)
+
+
+def corpus_artifacts(database=DATABASE, directory=ARTIFACTS_DIR, min_tokens=MIN_TOKENS, no_below=NO_BELOW,
+                     no_above=NO_ABOVE, upto=None):
+    """
+    Loads the CorpusArtifacts of the database's current watermark (or upto), and makes them first
+    if there aren't any: one pass over the texts to build the dictionary from the documents with
+    at least min_tokens tokens, and one to save the bag-of-words of all of them. Artifacts of other
+    watermarks or settings in directory are removed once the new ones are saved.
+    """
+    corpus = SQLiteCorpus(database, min_tokens=min_tokens, upto=upto)
+    key = artifact_key(corpus.upto, min_tokens, no_below, no_above)
+    path = os.path.join(directory, key)
+    if os.path.exists(path + '.json'):
+        return CorpusArtifacts(directory, key)
+
+    os.makedirs(directory, exist_ok=True)
+    dictionary = corpora.Dictionary(corpus.documents())
+    unfiltered_terms = len(dictionary)
+    dictionary.filter_extremes(no_below=no_below, no_above=no_above)
+
+    ids = array('q')
+    token_counts = array('i')
+    post_count = 0
+
+    def bows():
+        nonlocal post_count
+        for table, row_id, tokens in corpus.tokenized_rows():
+            post_count += table == TEXT_TABLES[0]
+            ids.append(row_id)
+            token_counts.append(len(tokens))
+            yield dictionary.doc2bow(tokens)
+
+    # MmCorpus writes <name>.index next to the file, so the temporary name keeps the .mm at the end
+    corpora.MmCorpus.serialize(path + '.tmp.mm', bows(), id2word=dictionary)
+    os.replace(path + '.tmp.mm', path + '.mm')
+    os.replace(path + '.tmp.mm.index', path + '.mm.index')
+    dictionary.save(path + '.dict')
+    with open(path + '.ids', 'wb') as f:
+        ids.tofile(f)
+        token_counts.tofile(f)
+    # the .json is written last, so artifacts that have one are complete
+    meta = {'upto': list(corpus.upto), 'min_tokens': min_tokens, 'no_below': no_below, 'no_above': no_above,
+            'documents': len(ids), 'posts': post_count, 'training_documents': len(corpus),
+            'unfiltered_terms': unfiltered_terms}
+    with open(path + '.tmp.json', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(path + '.tmp.json', path + '.json')
+
+    for name in os.listdir(directory):
+        if name.startswith('corpus-') and not name.startswith(key + '.'):
+            os.remove(os.path.join(directory, name))
+    return CorpusArtifacts(directory, key)
+
+
+class SeededLdaMulticore(LdaMulticore):
+    """
+    LdaMulticore that trains the same model from the same random_state with any number of workers.
+    LdaMulticore sends the chunks to the workers with whatever the model is at that moment in the
+    main process, and every worker starts the inference of its chunks from its own copy of the
+    random state, so the model depends on which worker gets which chunk when. Here the updates are
+    done in batch, once per pass, and the inference of a chunk is seeded from random_state and the
+    chunk itself. What is left is the order the results of the workers are added up in, which only
+    changes the float32 rounding (about 1e-8 in the topic-word probabilities, not the topics).
+    The model is still an LdaMulticore, and LdaModel.load() loads it.
+    """
+
+    def __init__(self, *args, random_state=None, **kwargs):
+        # set before LdaMulticore.__init__, which trains and sends the model to the workers
+        self.chunk_seed = random_state if isinstance(random_state, int) else 0
+        super().__init__(*args, random_state=random_state, batch=True, **kwargs)
+
+    def do_estep(self, chunk, state=None):
+        seed = zlib.crc32(repr((len(chunk), list(chunk[0]))).encode('utf-8')) ^ self.chunk_seed
+        self.random_state = np.random.RandomState(seed & 0xffffffff)
+        return super().do_estep(chunk, state)
+
+
+def peak_rss_mib(who):
+    """The peak resident memory of this process (resource.RUSAGE_SELF) or of its largest finished child, in MiB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def train_lda(corpus, dictionary, num_topics=NUM_TOPICS, workers=0, chunksize=2000, passes=15, iterations=400,
+              eval_every=10, random_state=42):
+    """
+    Trains an LDA model on corpus, with LdaModel when workers is 0 and with SeededLdaMulticore in
+    workers processes otherwise. The same arguments give the same model. Returns the model and the
+    training's {'seconds', 'documents', 'documents_per_second', 'peak_rss_mib', 'worker_peak_rss_mib'},
+    where documents counts every pass.
+    """
+    started = time.perf_counter()
+    if workers:
+        model = SeededLdaMulticore(corpus=corpus, id2word=dictionary, num_topics=num_topics, workers=workers,
+                                   chunksize=chunksize, passes=passes, iterations=iterations, eval_every=eval_every,
+                                   random_state=random_state, per_word_topics=True)
+    else:
+        model = LdaModel(corpus=corpus, id2word=dictionary, num_topics=num_topics, chunksize=chunksize, passes=passes,
+                         iterations=iterations, eval_every=eval_every, random_state=random_state, per_word_topics=True)
+    return model, training_stats(started, len(corpus) * passes, workers)
+
+
+def training_stats(started, documents, workers):
+    """The stats of train_lda() and update_lda(), for a training started at time.perf_counter() started."""
+    seconds = time.perf_counter() - started
+    return {
+        'seconds': seconds,
+        'documents': documents,
+        'documents_per_second': documents / seconds if seconds else 0.0,
+        'peak_rss_mib': peak_rss_mib(resource.RUSAGE_SELF) if resource else None,
+        'worker_peak_rss_mib': peak_rss_mib(resource.RUSAGE_CHILDREN) if resource and workers else None,
+    }
+
+
+def format_training_stats(stats):
+    text = (f"{stats['seconds']:.1f}s, {stats['documents_per_second']:.0f} documents/s "
+            f"({stats['documents']} documents in all passes)")
+    if stats['peak_rss_mib'] is not None:
+        text += f", peak RSS {stats['peak_rss_mib']:.0f} MiB"
+    if stats['worker_peak_rss_mib'] is not None:
+        text += f" (largest worker {stats['worker_peak_rss_mib']:.0f} MiB)"
+    return text
+
+
+def has_checkpoints(conn):
+    """Whether the database has the lda_checkpoints table, which `flask --app app migrate` creates."""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'lda_checkpoints'").fetchone() is not None
+
+
+def open_checkpoints(database):
+    """A connection to database, which must have the lda_checkpoints table."""
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+    if not has_checkpoints(conn):
+        conn.close()
+        raise SystemExit(f'{database} has no lda_checkpoints table, run `flask --app app migrate` first')
+    return conn
+
+
+def latest_checkpoint(conn):
+    """The lda_checkpoints row of the newest checkpoint, None if there isn't any."""
+    return conn.execute('SELECT * FROM lda_checkpoints ORDER BY version DESC LIMIT 1').fetchone()
+
+
+def save_checkpoint(conn, model, dictionary, kind, upto, documents, model_path=LDA_MODEL,
+                    dictionary_path=LDA_DICTIONARY, directory=CHECKPOINT_DIR):
+    """
+    Saves the model and dictionary as the next checkpoint in directory and records it in
+    lda_checkpoints, and saves them to model_path and dictionary_path too, where exercise 4.2
+    loads the current model from. Returns the version of the checkpoint.
+
+    The checkpoint is written last, so model_path is only newer than it when some other model
+    was saved there afterwards (see model_replaced).
+    """
+    version = conn.execute('SELECT COALESCE(MAX(version), 0) + 1 FROM lda_checkpoints').fetchone()[0]
+    os.makedirs(directory, exist_ok=True)
+    checkpoint_model = os.path.join(directory, f'lda_model_v{version}.model')
+    checkpoint_dictionary = os.path.join(directory, f'lda_dictionary_v{version}.dict')
+    model.save(model_path)
+    dictionary.save(dictionary_path)
+    model.save(checkpoint_model)
+    dictionary.save(checkpoint_dictionary)
+    conn.execute('''
+        INSERT INTO lda_checkpoints (version, kind, model_path, dictionary_path, max_post_id, max_comment_id, documents)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (version, kind, checkpoint_model, checkpoint_dictionary, upto[0], upto[1], documents))
+    conn.commit()
+    return version
+
+
+def model_replaced(checkpoint, model_path=LDA_MODEL):
+    """Whether the model at model_path was saved after the checkpoint, by something that didn't record one."""
+    if not os.path.exists(model_path) or not os.path.exists(checkpoint['model_path']):
+        return False
+    return os.stat(model_path).st_mtime_ns > os.stat(checkpoint['model_path']).st_mtime_ns
+
+
+def update_lda(model, corpus, passes=1):
+    """
+    Continues training model with the documents of corpus (LdaModel.update()), passes times over
+    them. Returns the same stats as train_lda(), where documents counts every pass.
+    """
+    started = time.perf_counter()
+    # LdaModel.update() and LdaMulticore.update() both take the passes from the model
+    model.passes = passes
+    model.update(corpus)
+    return training_stats(started, len(corpus) * passes, getattr(model, 'workers', 0))
+
+
+def train_command(arguments):
+    conn = open_checkpoints(arguments.database)
+    artifacts = corpus_artifacts(arguments.database, arguments.artifacts)
+    corpus = artifacts.training_corpus()
+    print(f'{len(corpus)} documents, {len(artifacts.dictionary)} words, watermark {artifacts.upto}')
+    model, stats = train_lda(corpus, artifacts.dictionary, num_topics=arguments.topics, workers=arguments.workers,
+                             chunksize=arguments.chunksize, passes=arguments.passes, iterations=arguments.iterations,
+                             eval_every=arguments.eval_every, random_state=arguments.random_state)
+    print(f'trained in {format_training_stats(stats)}')
+    version = save_checkpoint(conn, model, artifacts.dictionary, 'train', artifacts.upto, len(corpus),
+                              arguments.model, arguments.dictionary, arguments.checkpoints)
+    conn.close()
+    print(f'saved {arguments.model} and {arguments.dictionary}, checkpoint {version}')
+
+
+def update_command(arguments):
+    conn = open_checkpoints(arguments.database)
+    checkpoint = latest_checkpoint(conn)
+    if checkpoint is None:
+        raise SystemExit('there is no checkpoint to update yet, train one with `python topic_modeling.py train`')
+    # updating the checkpoint would overwrite the newer model with an update of an older one
+    if model_replaced(checkpoint, arguments.model) and not arguments.force:
+        raise SystemExit(f'{arguments.model} was saved after checkpoint {checkpoint["version"]} without recording '
+                         f'a checkpoint, train it again with `python topic_modeling.py train` or use --force to '
+                         f'replace it with an update of checkpoint {checkpoint["version"]}')
+    after = (checkpoint['max_post_id'], checkpoint['max_comment_id'])
+    dictionary = corpora.Dictionary.load(checkpoint['dictionary_path'])
+    corpus = SQLiteCorpus(arguments.database, dictionary=dictionary, after=after)
+    if corpus.upto == after:
+        print(f'nothing was written since checkpoint {checkpoint["version"]} (watermark {after})')
+        return
+    model = LdaModel.load(checkpoint['model_path'])
+    print(f'{len(corpus)} new documents since checkpoint {checkpoint["version"]}, watermark {after} -> {corpus.upto}')
+    if len(corpus):
+        stats = update_lda(model, corpus, passes=arguments.passes)
+        print(f'updated in {format_training_stats(stats)}')
+    version = save_checkpoint(conn, model, dictionary, 'update', corpus.upto, len(corpus),
+                              arguments.model, arguments.dictionary, arguments.checkpoints)
+    conn.close()
+    print(f'saved {arguments.model} and {arguments.dictionary}, checkpoint {version}')
+
+
+def main(argv=None):
+    files = argparse.ArgumentParser(add_help=False)
+    files.add_argument('--database', default=DATABASE)
+    files.add_argument('--artifacts', default=ARTIFACTS_DIR, help='folder of the saved corpus')
+    files.add_argument('--model', default=LDA_MODEL)
+    files.add_argument('--dictionary', default=LDA_DICTIONARY)
+    files.add_argument('--checkpoints', default=CHECKPOINT_DIR, help='folder of the numbered checkpoints')
+    parser = argparse.ArgumentParser(description='Topic model of the posts and comments.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    train = commands.add_parser('train', parents=[files], help='train a new model on all the posts and comments')
+    train.add_argument('--workers', type=int, default=0,
+                       help='processes for LdaMulticore, 0 trains with LdaModel in this process')
+    train.add_argument('--topics', type=int, default=NUM_TOPICS)
+    train.add_argument('--chunksize', type=int, default=2000)
+    train.add_argument('--passes', type=int, default=15)
+    train.add_argument('--iterations', type=int, default=400)
+    train.add_argument('--eval-every', type=int, default=10, help='log the perplexity every this many updates, 0 never')
+    train.add_argument('--random-state', type=int, default=42)
+    train.set_defaults(run=train_command)
+
+    update = commands.add_parser('update', parents=[files],
+                                 help='continue the newest checkpoint with the posts and comments written after it')
+    update.add_argument('--passes', type=int, default=1)
+    update.add_argument('--force', action='store_true',
+                        help='update the newest checkpoint even if --model was saved after it')
+    update.set_defaults(run=update_command)
+
+    arguments = parser.parse_args(argv)
+    arguments.run(arguments)
+
+
+if __name__ == '__main__':
+    # run the imported module, so the models it saves refer to topic_modeling.SeededLdaMulticore and not
+    # to __main__, which other scripts can't load them from
+    import topic_modeling
+    topic_modeling.main()